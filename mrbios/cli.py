@@ -1,11 +1,23 @@
 import sys
+import math
 import shlex
 import os.path
 from pathlib import Path
+from datetime import datetime
 
 from .core.project import Project
 from .core.platform import Platform
 from .core.dir_obj import Env, Script
+from .core.build_pool import EnvBuildPool
+from .core.env_cache import shared_env_cache
+from .core.env_pack import pack_env, unpack_env
+from .core.build_profile import summarize_history
+from .core.run_cache import run_cache
+from .core.batch import BatchRun, load_batch_params
+from .core.run_stats import summarize_runs
+from .core.run_history import (
+    RunHistory, get_run_history, export_runs, summarize_runs_by,
+)
 from .utils.template import list_env_templates, list_script_templates
 from .utils.log import console, Confirm, Prompt
 from .utils.user_setting import UserSetting, DEFAULT_SETTING_PATH
@@ -223,23 +235,41 @@ class EnvBuild(SubCLI):
 
     list = ProjectManager.list_envs
 
-    def build(self, env_name: str | None = None):
-        """Build an env."""
+    @staticmethod
+    def _run_parallel(jobs: dict, action: str, n_jobs: int):
+        pool = EnvBuildPool(n_jobs)
+        errors = pool.run(jobs, action)
+        if len(errors) > 0:
+            sys.exit(1)
+
+    def build(self, env_name: str | None = None, from_lock: bool = False):
+        """Build an env.
+
+        :param from_lock: Recreate the env from the lock artifacts
+        captured by the last build, skip the conda solver.
+        """
         name_and_env = self._select_env(env_name)
         if name_and_env is not None:
             env_name, env = name_and_env
             console.log(f"Start building [note]{env_name}[/note]")
-            env.build()
+            env.build(from_lock=from_lock)
             console.log(
                 f"The env [note]{env_name}[/note] "
                 "has aleardy been built.")
 
-    def build_all(self, force: bool = False):
+    def build_all(self, force: bool = False, jobs: int = 1):
         """Build all unbuilt envs.
 
         :param force: Force to build all envs.
+        :param jobs: Number of envs to build concurrently.
         """
         envs = self._proj.get_envs()
+        if jobs > 1:
+            self._run_parallel({
+                name: env.build for name, env in envs.items()
+                if (not env.is_built) or force
+            }, "build", jobs)
+            return
         for name, env in envs.items():
             if (not env.is_built) or force:
                 console.log(
@@ -258,9 +288,18 @@ class EnvBuild(SubCLI):
             console.log(
                 f"The env [note]{env_name}[/note] has aleardy been updated.")
 
-    def update_all(self):
-        """Update all built envs."""
+    def update_all(self, jobs: int = 1):
+        """Update all built envs.
+
+        :param jobs: Number of envs to update concurrently.
+        """
         envs = self._proj.get_envs()
+        if jobs > 1:
+            self._run_parallel({
+                name: env.update for name, env in envs.items()
+                if env.is_built
+            }, "update", jobs)
+            return
         for name, env in envs.items():
             if env.is_built:
                 console.log(
@@ -308,9 +347,18 @@ class EnvBuild(SubCLI):
                 f"The env [note]{env_name}[/note] "
                 "has aleardy been built.")
 
-    def rebuild_all(self):
-        """Rebuild all built envs."""
+    def rebuild_all(self, jobs: int = 1):
+        """Rebuild all built envs.
+
+        :param jobs: Number of envs to rebuild concurrently.
+        """
         envs = self._proj.get_envs()
+        if jobs > 1:
+            self._run_parallel({
+                name: env.rebuild for name, env in envs.items()
+                if env.is_built
+            }, "rebuild", jobs)
+            return
         for name, env in envs.items():
             if env.is_built:
                 env.delete_built()
@@ -321,8 +369,81 @@ class EnvBuild(SubCLI):
                 console.log(
                     f"The env [note]{name}[/note] has aleardy been built.")
 
-    def run(self, command: str, env_name: str | None = None):
-        """Run command under an env."""
+    def pack(self, env_name: str | None = None, out: str | None = None):
+        """Pack a built env to a relocatable archive.
+
+        :param out: Path of the archive, ends with '.tar.gz' or '.tar.zst',
+        default is '<env build name>.tar.gz'.
+        """
+        name_and_env = self._select_env(env_name)
+        if name_and_env is not None:
+            env_name, env = name_and_env
+            if not env.is_built:
+                console.log(
+                    f"[error]The env [blue]{env_name}[/blue] not "
+                    "yet built. Please build it first.[/error]")
+                sys.exit(1)
+            conda_config = env.build_config.conda_config
+            if out is None:
+                out = f"{env.build_name}.tar.gz"
+            pack_env(conda_config.env_path, conda_config.env_name, Path(out))
+
+    def unpack(self, archive: str, dest: str | None = None):
+        """Restore an env from an archive created by `pack`.
+
+        :param dest: Target prefix of the env, under an envs dir,
+        default is '<conda base>/envs/<env name>'.
+        """
+        unpack_env(Path(archive), None if dest is None else Path(dest))
+
+    def gc(self, dry_run: bool = False):
+        """Remove the shared envs which are no longer used by any project.
+
+        :param dry_run: Only print the envs to be removed.
+        """
+        removed = shared_env_cache.gc(dry_run=dry_run)
+        console.log(f"{len(removed)} unused shared envs removed.")
+
+    def stats(self, top: int = 10):
+        """Show the slowest build phases and packages of the latest
+        builds, and the build times of all recorded builds.
+
+        :param top: Number of the slowest phases and packages to show.
+        """
+        histories = {
+            name: env.build_history
+            for name, env in self._proj.get_envs().items()
+        }
+        stats = summarize_history(histories, top=top)
+        if len(stats.trend) == 0:
+            console.log("No recorded builds.")
+            return
+        table = console.table(
+            "Slowest phases", ["env", "phase", "wall(s)", "cpu(s)", "MB"])
+        for env_name, phase, wall, cpu, bytes_ in stats.phases:
+            mb = "-" if bytes_ is None else f"{bytes_ / 1024**2:.1f}"
+            table.add_row(env_name, phase, f"{wall:.1f}", f"{cpu:.1f}", mb)
+        console.print(table)
+        if len(stats.packages) > 0:
+            table = console.table(
+                "Slowest packages", ["env", "package", "source", "time(s)"])
+            for env_name, pkg, source, seconds in stats.packages:
+                table.add_row(env_name, pkg, source, f"{seconds:.1f}")
+            console.print(table)
+        table = console.table(
+            "Build history", ["time", "env", "action", "total(s)"])
+        for env_name, time, action, total in stats.trend:
+            table.add_row(time[:19], env_name, action, f"{total:.1f}")
+        console.print(table)
+
+    def run(
+            self, command: str, env_name: str | None = None,
+            direct: bool | None = None):
+        """Run command under an env.
+
+        :param direct: Run command directly with the cached activated
+        environ, skip the `conda run`.
+        """
         name_and_env = self._select_env(env_name)
         if name_and_env:
             env_name, env = name_and_env
@@ -335,7 +456,7 @@ class EnvBuild(SubCLI):
             console.log(
                 f"Run command [path]{command}[/path] under "
                 f"env [note]{env_name}[/note].")
-            env.run_command(cmd)
+            env.run_command(cmd, direct=direct)
             console.log(
                 f"The command has been successfully "
                 f"run under env [note]{env_name}[/note].")
@@ -370,6 +491,69 @@ class ScriptRun(SubCLI):
             f"The script [note]{script.name}[/note] has been "
             f"successfully run under task [note]{task_name}[/note].")
 
+    def batch(
+            self, task_script: str, params: str, jobs: int = 1,
+            summary: str | None = None, direct: bool = True):
+        """Run a script once per row of the parameter table.
+
+        :param task_script: The task and script name, separated by a '/',
+        like "task1/script1".
+        :param params: TSV file with a header of the argument names,
+        or YAML file of a list of argument mappings.
+        :param jobs: Number of the concurrent runs.
+        :param summary: Path of the summary table,
+        default is '<params>.summary.tsv'. Rows succeeded in it are skipped.
+        :param direct: Run with the cached activated environ,
+        skip the `conda run` startup of each row.
+        """
+        task_name, script = self._get_script(task_script)
+        params_path = Path(params)
+        rows = load_batch_params(params_path)
+        if summary is None:
+            summary = str(params_path.with_name(
+                params_path.stem + ".summary.tsv"))
+        env = script.runner.env
+        if direct:
+            # capture the environ once before the concurrent runs
+            env.snapshot.get_environ()
+
+        def runner_factory():
+            runner = script.runner
+            runner.direct = direct
+            return runner
+
+        console.log(
+            f"Run script [note]{script.name}[/note] under task "
+            f"[note]{task_name}[/note] with {len(rows)} argument sets.")
+        results = BatchRun(
+            runner_factory, rows, Path(summary), n_jobs=jobs).run()
+        if any(r["status"] != "done" for r in results.values()):
+            sys.exit(1)
+
+    def stats(self, task_script: str, last: int | None = None):
+        """Show the percentiles of the resources used by the runs
+        of a script: wall time, CPU time, peak RSS of the process tree,
+        bytes read/written and the mrbios overhead before the start.
+
+        :param task_script: The task and script name, separated by a '/',
+        like "task1/script1".
+        :param last: Only count the latest N runs.
+        """
+        self._get_script(task_script)
+        records = get_run_history(self._proj.path).query(
+            limit=last, script=task_script, status="done,failed")
+        if len(records) == 0:
+            console.log("No recorded runs.")
+            return
+        n_failed = sum(r["status"] != "done" for r in records)
+        table = console.table(
+            f"{task_script}: {len(records)} runs, {n_failed} failed",
+            ["metric", "p50", "p90", "p99", "max"])
+        for name, unit, qs, max_ in summarize_runs(records):
+            table.add_row(
+                f"{name}({unit})", *[f"{v:.2f}" for v in qs + [max_]])
+        console.print(table)
+
     def qt_gui(self, task_script: str):  # pragma: no cover
         """Run a script with Qt GUI.
 
@@ -403,6 +587,132 @@ class ScriptRun(SubCLI):
             "with Dash App.")
 
 
+class RunCacheManager(SubCLI):
+    """Tools for managing the cache of the script outputs."""
+
+    def gc(self, max_size_gb: float | None = None, dry_run: bool = False):
+        """Remove the least recently used entries of the run cache
+        until it's under the size cap.
+
+        :param max_size_gb: Size cap of the cache, default is 50GB.
+        :param dry_run: Only print the number of entries to be removed.
+        """
+        removed = run_cache.evict(max_size_gb, dry_run=dry_run)
+        console.log(f"{len(removed)} run cache entries removed.")
+
+
+class RunHistoryManager(SubCLI):
+    """Tools for querying the history of the script runs.
+
+    The filters of the commands:
+
+    :param script: `task/script`, glob patterns like `task/*` are supported.
+    :param status: running, done, failed or cached, comma separated.
+    :param since: Runs started after it, a date like "2024-01-31",
+    "2024-01-31T20:00" or the time ago like "12h", "7d".
+    :param until: Runs started before it, same format as `since`.
+    :param host: Runs on the host.
+    """
+
+    @property
+    def history(self) -> RunHistory:
+        return get_run_history(self._proj.path)
+
+    def list(
+            self, script: str | None = None, status: str | None = None,
+            since: str | None = None, until: str | None = None,
+            host: str | None = None, limit: int = 20):
+        """List the runs, the latest first.
+
+        :param limit: Max number of the runs to show.
+        """
+        runs = self.history.query(
+            limit=limit, script=script, status=status,
+            since=since, until=until, host=host)
+        if len(runs) == 0:
+            console.log("No recorded runs.")
+            return
+        table = console.table(
+            "Runs", ["id", "start", "script", "status", "exit",
+                     "wall(s)", "peak rss(MB)", "host"])
+        for r in runs:
+            table.add_row(
+                str(r["id"]), _format_time(r["start"]), r["script"],
+                r["status"], _format_value(r["exit_code"]),
+                _format_value(r["wall"]),
+                _format_value(r["max_rss"], 1024**-2),
+                r["host"])
+        console.print(table)
+
+    def summary(
+            self, by: str = "script",
+            script: str | None = None, status: str | None = None,
+            since: str | None = None, until: str | None = None,
+            host: str | None = None):
+        """Aggregate the runs: number of runs and failures,
+        percentiles of the wall time and the max peak RSS.
+
+        :param by: Field to group by, like script, env, host or status.
+        """
+        runs = self.history.query(
+            script=script, status=status,
+            since=since, until=until, host=host)
+        if len(runs) == 0:
+            console.log("No recorded runs.")
+            return
+        table = console.table(
+            f"Runs by {by}", [by, "runs", "failed", "p50 wall(s)",
+                              "p90 wall(s)", "max wall(s)", "peak rss(MB)"])
+        for group, n, n_failed, p50, p90, max_, rss in \
+                summarize_runs_by(runs, by):
+            table.add_row(
+                group, str(n), str(n_failed),
+                _format_value(p50), _format_value(p90),
+                _format_value(max_), _format_value(rss, 1024**-2))
+        console.print(table)
+
+    def export(
+            self, path: str,
+            script: str | None = None, status: str | None = None,
+            since: str | None = None, until: str | None = None,
+            host: str | None = None):
+        """Export the runs to a file.
+
+        :param path: Output path, the format is TSV,
+        or JSON/JSON lines when the suffix is '.json'/'.jsonl'.
+        """
+        runs = self.history.query(
+            script=script, status=status,
+            since=since, until=until, host=host)
+        export_runs(runs, Path(path))
+        console.log(f"{len(runs)} runs exported to [path]{path}[/path]")
+
+    def prune(
+            self, days: float | None = None,
+            max_rows: int | None = None):
+        """Remove the old runs.
+
+        :param days: Remove the runs older than the days.
+        :param max_rows: Only keep the latest N runs.
+        """
+        n = self.history.prune(days, max_rows)
+        console.log(f"{n} runs removed.")
+
+
+def _format_time(timestamp: float | None) -> str:
+    if timestamp is None:
+        return "-"
+    return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _format_value(value: float | None, scale: float = 1.0) -> str:
+    if (value is None) or math.isnan(value):
+        return "-"
+    if isinstance(value, int) and (scale == 1.0):
+        return str(value)
+    return f"{value * scale:.2f}"
+
+
 class PlatformLauncher(SubCLI):
     """Tools for launching the executor platform server."""
 
@@ -427,6 +737,8 @@ class CLI():
         self.project = ProjectManager(self)
         self.env = EnvBuild(self)
         self.script = ScriptRun(self)
+        self.cache = RunCacheManager(self)
+        self.runs = RunHistoryManager(self)
         self.platform = PlatformLauncher(self)
 
     def print_current_project(self):
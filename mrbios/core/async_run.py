@@ -0,0 +1,182 @@
+import asyncio
+import functools
+import os
+import signal
+import time
+import typing as T
+
+
+# Max number of the unread lines kept for each stream,
+# the oldest lines are dropped when the consumer falls behind.
+MAX_BUFFERED_LINES = 10000
+_EOF = None
+
+
+class RunHandle():
+    """Handle of a command running in its own process group.
+
+    The stdout and stderr are read in the background, iterate the lines
+    with `async for line in handle.stdout()`. The whole process group
+    is killed on timeout by a watchdog, even if `wait` is never awaited,
+    on `cancel` or when the task awaiting `wait` is cancelled.
+
+    :param proc: The started process.
+    :param timeout: Seconds since the start before killing the process.
+    """
+    def __init__(
+            self, proc: asyncio.subprocess.Process,
+            timeout: float | None = None,
+            max_lines: int = MAX_BUFFERED_LINES):
+        self.proc = proc
+        self.timeout = timeout
+        self.start_time = time.monotonic()
+        self.dropped = {"stdout": 0, "stderr": 0}
+        self._queues: dict[str, asyncio.Queue] = {
+            "stdout": asyncio.Queue(max_lines),
+            "stderr": asyncio.Queue(max_lines),
+        }
+        self._readers = [
+            asyncio.ensure_future(self._read(name, stream))
+            for name, stream in (
+                ("stdout", proc.stdout), ("stderr", proc.stderr))
+        ]
+        self.timed_out = False
+        self._watchdog = None if timeout is None else \
+            asyncio.ensure_future(self._watch(timeout))
+        self._callbacks: list[T.Callable[[int], None]] = []
+        self._exit_task: asyncio.Future | None = None
+
+    @staticmethod
+    async def start(
+            cmd: list[str], environ: dict[str, str] | None = None,
+            timeout: float | None = None,
+            cwd: str | None = None,
+            cpus: list[int] | None = None) -> "RunHandle":
+        """Start the command in a new process group.
+
+        :param cpus: Bind the process and its children to the CPUs.
+        """
+        preexec_fn = None if cpus is None else \
+            functools.partial(os.sched_setaffinity, 0, cpus)
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, env=environ, cwd=cwd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            start_new_session=True, preexec_fn=preexec_fn)
+        return RunHandle(proc, timeout)
+
+    @property
+    def pid(self) -> int:
+        return self.proc.pid
+
+    @property
+    def returncode(self) -> int | None:
+        return self.proc.returncode
+
+    def add_exit_callback(self, func: T.Callable[[int], None]):
+        """Call the function with the return code in a thread when
+        the process exited, even if `wait` is never awaited."""
+        self._callbacks.append(func)
+        if self._exit_task is None:
+            self._exit_task = asyncio.ensure_future(self._call_exit())
+
+    async def _call_exit(self):
+        code = await asyncio.shield(self.proc.wait())
+        if self._watchdog is not None:
+            await self._watchdog
+        for func in self._callbacks:
+            await asyncio.to_thread(func, code)
+
+    async def _watch(self, timeout: float):
+        """Kill the process group when the timeout is reached."""
+        try:
+            await asyncio.wait_for(self.proc.wait(), timeout)
+        except asyncio.TimeoutError:
+            self.timed_out = True
+            self.kill()
+
+    async def _read(self, name: str, stream: T.Any):
+        queue = self._queues[name]
+
+        def put(item: str | None):
+            if queue.full():
+                queue.get_nowait()
+                self.dropped[name] += 1
+            queue.put_nowait(item)
+        while True:
+            line = await stream.readline()
+            if not line:
+                break
+            put(line.decode(errors="replace").rstrip("\n"))
+        put(_EOF)
+
+    async def _iter(self, name: str) -> T.AsyncIterator[str]:
+        queue = self._queues[name]
+        while True:
+            line = await queue.get()
+            if line is _EOF:
+                # let the other iterators of this stream stop too
+                queue.put_nowait(_EOF)
+                return
+            yield line
+
+    def stdout(self) -> T.AsyncIterator[str]:
+        """Iterate the lines of stdout."""
+        return self._iter("stdout")
+
+    def stderr(self) -> T.AsyncIterator[str]:
+        """Iterate the lines of stderr."""
+        return self._iter("stderr")
+
+    def kill(self, sig: int = signal.SIGKILL):
+        """Kill the whole process group."""
+        if self.proc.returncode is not None:
+            return
+        try:
+            os.killpg(self.proc.pid, sig)
+        except ProcessLookupError:  # pragma: no cover
+            pass
+
+    async def cancel(self, grace: float = 3.0):
+        """Terminate the process group, kill it if it's still alive
+        after the grace period."""
+        self.kill(signal.SIGTERM)
+        try:
+            await asyncio.wait_for(self.proc.wait(), grace)
+        except asyncio.TimeoutError:
+            self.kill(signal.SIGKILL)
+            await self.proc.wait()
+
+    async def wait(self) -> int:
+        """Wait the process to exit and return the return code.
+
+        :raises TimeoutError: When the timeout is reached,
+        the process group is killed.
+        """
+        try:
+            code = await self.proc.wait()
+            if self._watchdog is not None:
+                await self._watchdog
+            if self._exit_task is not None:
+                await asyncio.shield(self._exit_task)
+        except asyncio.CancelledError:
+            self.kill()
+            raise
+        if self.timed_out:
+            raise TimeoutError(
+                f"Command timed out after {self.timeout} seconds.")
+        await asyncio.gather(*self._readers)
+        return code
+
+    async def __aenter__(self) -> "RunHandle":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self.proc.returncode is None:
+            self.kill()
+            await self.proc.wait()
+        if self._exit_task is not None:
+            await asyncio.shield(self._exit_task)
+        for task in self._readers + [self._watchdog]:
+            if task is not None:
+                task.cancel()
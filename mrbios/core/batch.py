@@ -0,0 +1,158 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+import subprocess as subp
+import threading
+import json
+import time
+import csv
+import typing as T
+
+import yaml
+
+from ..utils.log import console
+from .build_log import BuildLog
+
+if T.TYPE_CHECKING:
+    from .runner import ScriptRunner
+
+
+SUMMARY_FIELDS = [
+    "row", "status", "exit_code", "duration", "outputs", "log", "params",
+]
+
+
+def load_batch_params(path: Path) -> list[dict[str, T.Any]]:
+    """Load the argument sets of a batch, one row per run.
+
+    TSV files have a header line with the argument names, YAML files
+    contain a list of mappings.
+    """
+    if path.suffix in (".yaml", ".yml"):
+        with open(path) as f:
+            rows = yaml.safe_load(f) or []
+        if not all(isinstance(r, dict) for r in rows):
+            raise ValueError(f"{path} should contain a list of mappings.")
+        return rows
+    with open(path, newline="") as f:
+        reader = csv.DictReader(f, delimiter="\t")
+        return [dict(r) for r in reader]
+
+
+def _params_key(params: dict) -> str:
+    return json.dumps(params, sort_keys=True, default=str)
+
+
+class BatchRun():
+    """Run a script once per argument set, on a local worker pool.
+
+    The results are written to a TSV summary after each row is finished,
+    rows succeeded in the existing summary are skipped,
+    so an interrupted batch can be resumed.
+    The output of each row is captured to `<summary>.logs/row-<i>.log`.
+
+    :param runner_factory: Create a script runner for a row.
+    :param rows: Argument sets.
+    :param summary_path: Path of the summary table.
+    :param n_jobs: Number of the concurrent runs.
+    """
+    def __init__(
+            self, runner_factory: T.Callable[[], "ScriptRunner"],
+            rows: list[dict[str, T.Any]],
+            summary_path: Path, n_jobs: int = 1):
+        self.runner_factory = runner_factory
+        self.rows = rows
+        self.summary_path = summary_path
+        self.n_jobs = max(1, n_jobs)
+        self.results: dict[int, dict] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def logs_path(self) -> Path:
+        return self.summary_path.with_name(self.summary_path.name + ".logs")
+
+    def load_summary(self) -> dict[int, dict]:
+        if not self.summary_path.exists():
+            return {}
+        with open(self.summary_path, newline="") as f:
+            reader = csv.DictReader(f, delimiter="\t")
+            return {int(r["row"]): r for r in reader}
+
+    def write_summary(self):
+        tmp = self.summary_path.with_name(
+            f".{self.summary_path.name}.tmp")
+        with open(tmp, 'w', newline="") as f:
+            writer = csv.DictWriter(
+                f, fieldnames=SUMMARY_FIELDS, delimiter="\t")
+            writer.writeheader()
+            for i in sorted(self.results):
+                writer.writerow(self.results[i])
+        tmp.replace(self.summary_path)
+
+    def pending_rows(self) -> list[int]:
+        """Rows not succeeded in the existing summary."""
+        self.results = {}
+        for i, r in self.load_summary().items():
+            if (i < len(self.rows)) and \
+                    (r["params"] == _params_key(self.rows[i])):
+                self.results[i] = r
+        return [
+            i for i in range(len(self.rows))
+            if self.results.get(i, {}).get("status") != "done"
+        ]
+
+    def run_row(self, i: int) -> dict:
+        params = self.rows[i]
+        runner = self.runner_factory()
+        self.logs_path.mkdir(parents=True, exist_ok=True)
+        log = BuildLog(self.logs_path / f"row-{i}.log")
+        runner.log = log
+        t0 = time.perf_counter()
+        status, exit_code = "done", 0
+        try:
+            with console.tail_to(lambda line: None):
+                runner.run(**params)
+        except subp.CalledProcessError as e:
+            status, exit_code = "failed", e.returncode
+        except Exception as e:
+            status, exit_code = "failed", -1
+            log.write(f"{type(e).__name__}: {e}\n".encode())
+        finally:
+            log.close()
+        outputs = {
+            name: params.get(name) for name in runner.output_names
+        }
+        return {
+            "row": i,
+            "status": status,
+            "exit_code": exit_code,
+            "duration": f"{time.perf_counter() - t0:.2f}",
+            "outputs": json.dumps(outputs),
+            "log": str(log.path),
+            "params": _params_key(params),
+        }
+
+    def run(self) -> dict[int, dict]:
+        """Run the pending rows and return the results of all rows."""
+        pending = self.pending_rows()
+        n_skip = len(self.rows) - len(pending)
+        if n_skip > 0:
+            console.log(f"Skip {n_skip} rows succeeded before.")
+        n_failed = 0
+        with console.progress() as progress, \
+                ThreadPoolExecutor(max_workers=self.n_jobs) as executor:
+            task = progress.add_task(
+                "batch", total=len(pending), status="0 failed")
+            futures = [executor.submit(self.run_row, i) for i in pending]
+            for fut in as_completed(futures):
+                res = fut.result()
+                if res["status"] != "done":
+                    n_failed += 1
+                with self._lock:
+                    self.results[res["row"]] = res
+                    self.write_summary()
+                progress.update(
+                    task, advance=1, status=f"{n_failed} failed")
+        console.log(
+            f"Batch finished: {len(pending) - n_failed}/{len(pending)} ok, "
+            f"summary: [path]{self.summary_path}[/path]")
+        return self.results
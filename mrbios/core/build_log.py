@@ -0,0 +1,162 @@
+from collections import deque
+from datetime import datetime
+from pathlib import Path
+import subprocess as subp
+import gzip
+import shutil
+import os
+import typing as T
+
+from ..utils.log import console, escape
+from .run_stats import RunUsage, ProcessMonitor
+
+
+DEFAULT_LOG_MAX_BYTES = 10 * 1024**2
+DEFAULT_LOG_BACKUPS = 5
+DEFAULT_LOGS_KEEP = 10
+DEFAULT_TAIL_LINES = 20
+# Lines longer than this are split, keep the memory bounded.
+MAX_LINE_BYTES = 64 * 1024
+
+
+def _gzip_file(path: Path) -> Path:
+    gz_path = path.with_name(path.name + ".gz")
+    with open(path, 'rb') as src, gzip.open(gz_path, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    path.unlink()
+    return gz_path
+
+
+class BuildCommandError(subp.CalledProcessError):
+    """Command failed while building the env, the output is in the log."""
+    def __init__(
+            self, returncode: int, cmd: list[str],
+            log_path: Path, tail: list[str]):
+        super().__init__(returncode, cmd)
+        self.log_path = log_path
+        self.tail = tail
+
+    def __str__(self):
+        return f"{super().__str__()} See the log: {self.log_path}"
+
+
+class BuildLog():
+    """Log file of an env build, the output of the build commands
+    is streamed into it instead of the terminal.
+
+    The log rotates when it's larger than `max_bytes`, the rotated parts
+    are compressed as `<log>.<n>.gz`. The logs of the previous builds are
+    compressed when a new build starts, only the latest `keep` builds
+    are kept.
+
+    :param path: Path of the log file.
+    :param max_bytes: Max size of the log file before rotating.
+    :param backups: Number of the rotated parts to keep.
+    :param tail_lines: Number of the last lines kept in memory.
+    """
+    def __init__(
+            self, path: Path,
+            max_bytes: int = DEFAULT_LOG_MAX_BYTES,
+            backups: int = DEFAULT_LOG_BACKUPS,
+            tail_lines: int = DEFAULT_TAIL_LINES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.tail: deque[str] = deque(maxlen=tail_lines)
+        self._file: T.BinaryIO | None = None
+        self._size = 0
+
+    @staticmethod
+    def start(
+            logs_dir: Path, action: str,
+            keep: int = DEFAULT_LOGS_KEEP, **kwargs) -> "BuildLog":
+        """Create the log of a new build under the logs dir,
+        compress and prune the old ones."""
+        logs_dir.mkdir(parents=True, exist_ok=True)
+        for old in logs_dir.glob("*.log"):
+            _gzip_file(old)
+        builds: dict[str, list[Path]] = {}
+        for p in logs_dir.glob("*.log*.gz"):
+            builds.setdefault(p.name.split(".log")[0], []).append(p)
+        old_builds = sorted(
+            builds.values(),
+            key=lambda parts: max(p.stat().st_mtime for p in parts))
+        for parts in old_builds[:max(0, len(old_builds) - keep)]:
+            for p in parts:
+                p.unlink(missing_ok=True)
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        return BuildLog(logs_dir / f"{action}-{stamp}.log", **kwargs)
+
+    def _open(self) -> T.BinaryIO:
+        if self._file is None:
+            self._file = open(self.path, 'ab')
+            self._size = self.path.stat().st_size
+        return self._file
+
+    def _rotate(self):
+        self.close()
+        self.path.with_name(
+            f"{self.path.name}.{self.backups}.gz").unlink(missing_ok=True)
+        for i in range(self.backups - 1, 0, -1):
+            src = self.path.with_name(f"{self.path.name}.{i}.gz")
+            if src.exists():
+                src.rename(self.path.with_name(
+                    f"{self.path.name}.{i + 1}.gz"))
+        part = self.path.rename(self.path.with_name(self.path.name + ".1"))
+        _gzip_file(part)
+
+    def write(self, data: bytes):
+        f = self._open()
+        f.write(data)
+        self._size += len(data)
+        if self._size > self.max_bytes:
+            self._rotate()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def run(
+            self, cmd: list[str], environ: dict[str, str] | None = None,
+            usage: RunUsage | None = None, cwd: Path | None = None):
+        """Run the command, stream its output into the log
+        and show the last line as a live tail.
+
+        :param usage: Measure the resources used by the command into it.
+        :param cwd: Working dir of the command.
+        :raises BuildCommandError: When the command failed.
+        """
+        self.write(f"\n$ {' '.join(cmd)}\n".encode())
+        environ = dict(os.environ if environ is None else environ)
+        # python buffers the output when it's not a tty
+        environ.setdefault("PYTHONUNBUFFERED", "1")
+        proc = subp.Popen(
+            cmd, env=environ, stdout=subp.PIPE, stderr=subp.STDOUT, cwd=cwd)
+        monitor = None if usage is None else ProcessMonitor(proc.pid, usage)
+        stdout = T.cast(T.BinaryIO, proc.stdout)
+
+        def wait() -> int:
+            return proc.wait() if monitor is None else monitor.wait(proc)
+
+        try:
+            with console.tail(f"Run [path]{escape(cmd[0])}[/path]") as show:
+                while True:
+                    line = stdout.readline(MAX_LINE_BYTES)
+                    if not line:
+                        break
+                    self.write(line)
+                    text = line.decode(errors="replace").rstrip()
+                    if text:
+                        self.tail.append(text)
+                        show(text)
+        except BaseException:
+            # don't leave the command running without a reader
+            proc.kill()
+            wait()
+            raise
+        self._open().flush()
+        code = wait()
+        if code != 0:
+            raise BuildCommandError(
+                proc.returncode, cmd, self.path, list(self.tail))
@@ -0,0 +1,73 @@
+import typing as T
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from ..utils.log import console, escape
+
+
+class EnvBuildPool():
+    """Run env build jobs concurrently in a worker pool.
+
+    Failed jobs do not abort the others, all errors are collected
+    and reported at the end.
+
+    :param n_jobs: Number of the concurrent workers.
+    """
+    def __init__(self, n_jobs: int):
+        self.n_jobs = max(1, n_jobs)
+
+    def run(
+            self, jobs: dict[str, T.Callable[[], T.Any]],
+            action: str = "build",
+            ) -> dict[str, BaseException]:
+        """Run the jobs and return the errors of the failed jobs.
+
+        :param jobs: Mapping from env name to the job function.
+        :param action: Name of the action, used for display.
+        """
+        errors: dict[str, BaseException] = {}
+        if len(jobs) == 0:
+            return errors
+        with console.progress() as progress, \
+                ThreadPoolExecutor(max_workers=self.n_jobs) as executor:
+            task_ids = {
+                name: progress.add_task(
+                    escape(name), total=1, status="waiting")
+                for name in jobs
+            }
+
+            def wrap(name: str, func: T.Callable) -> T.Callable:
+                def show(line: str):
+                    progress.update(
+                        task_ids[name], status=escape(line[:60]))
+
+                def _job():
+                    progress.update(task_ids[name], status="running")
+                    with console.tail_to(show):
+                        return func()
+                return _job
+
+            futures = {
+                executor.submit(wrap(name, func)): name
+                for name, func in jobs.items()
+            }
+            for fut in as_completed(futures):
+                name = futures[fut]
+                try:
+                    fut.result()
+                except Exception as e:
+                    errors[name] = e
+                    status = "[error]failed[/error]"
+                else:
+                    status = "done"
+                progress.update(task_ids[name], completed=1, status=status)
+        self.report(errors, len(jobs), action)
+        return errors
+
+    @staticmethod
+    def report(errors: dict[str, BaseException], n_total: int, action: str):
+        n_ok = n_total - len(errors)
+        console.log(f"{action.capitalize()} finished: {n_ok}/{n_total} ok.")
+        for name, e in errors.items():
+            console.log(
+                f"[error]Failed to {action} [note]{escape(name)}[/note]: "
+                f"{type(e).__name__}: {escape(str(e))}[/error]")
@@ -0,0 +1,182 @@
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+import threading
+import time
+import os
+import typing as T
+
+from .r_install import RInstallResult
+from .run_stats import RunUsage
+
+
+# Number of build records kept in the env's meta info.
+MAX_BUILD_HISTORY = 50
+
+_ARCHIVE_SUFFIXES = (".conda", ".tar.bz2", ".whl")
+
+# Download phases running in the process, the new archives in the shared
+# package cache can't be attributed when they overlap.
+_download_phases: list[dict] = []
+_download_lock = threading.Lock()
+
+
+def _archive_sizes(dirs: list[Path]) -> dict[str, int]:
+    """Sizes of the package archives at the top level of the cache dirs."""
+    sizes = {}
+    for d in dirs:
+        try:
+            entries = list(os.scandir(d))
+        except OSError:
+            continue
+        for e in entries:
+            if e.name.endswith(_ARCHIVE_SUFFIXES) and e.is_file():
+                sizes[e.path] = e.stat().st_size
+    return sizes
+
+
+def default_pkgs_dirs() -> list[Path]:
+    """Package cache dirs of conda/micromamba, new archives in them
+    are counted as downloaded bytes."""
+    if "CONDA_PKGS_DIRS" in os.environ:
+        return [
+            Path(p) for p in
+            os.environ["CONDA_PKGS_DIRS"].split(",") if p
+        ]
+    dirs = [Path.home() / ".conda" / "pkgs"]
+    for var in ("CONDA_ROOT", "MAMBA_ROOT_PREFIX"):
+        if var in os.environ:
+            dirs.append(Path(os.environ[var]) / "pkgs")
+    conda_exe = os.environ.get("CONDA_EXE")
+    if conda_exe is not None:
+        dirs.append(Path(conda_exe).parent.parent / "pkgs")
+    return dirs
+
+
+class BuildProfile():
+    """Timing of the phases of an env build.
+
+    Each phase records the wall time, the CPU time of the commands
+    run in it and the bytes downloaded to the package cache,
+    unless other builds were downloading at the same time.
+
+    :param pkgs_dirs: Package cache dirs used to count the downloads.
+    """
+    def __init__(self, pkgs_dirs: list[Path] | None = None):
+        self.pkgs_dirs = default_pkgs_dirs() if pkgs_dirs is None \
+            else pkgs_dirs
+        self.phases: list[dict] = []
+        self.packages: list[dict] = []
+        self._start: float | None = None
+        # Usage of the commands run in the current phase,
+        # measured by `CondaConfig._run_cmd`.
+        self.usage: RunUsage | None = None
+
+    @contextmanager
+    def phase(self, name: str, count_download: bool = False):
+        """Time the code block as a phase of the build.
+
+        :param count_download: Count the new package archives.
+        """
+        if self._start is None:
+            self._start = time.perf_counter()
+        record: dict[str, T.Any] = {"name": name}
+        before = None
+        if count_download:
+            before = _archive_sizes(self.pkgs_dirs)
+            with _download_lock:
+                for r in _download_phases:
+                    r["_shared"] = True
+                if len(_download_phases) > 0:
+                    record["_shared"] = True
+                _download_phases.append(record)
+        outer, usage = self.usage, RunUsage()
+        self.usage = usage
+        wall0 = time.perf_counter()
+        try:
+            yield record
+        finally:
+            self.usage = outer
+            if outer is not None:
+                outer.user += usage.user
+                outer.sys += usage.sys
+            record["wall"] = round(time.perf_counter() - wall0, 3)
+            record["cpu"] = round(usage.user + usage.sys, 3)
+            if before is not None:
+                with _download_lock:
+                    _download_phases[:] = [
+                        r for r in _download_phases if r is not record]
+                    shared = record.pop("_shared", False)
+                if not shared:
+                    after = _archive_sizes(self.pkgs_dirs)
+                    record["bytes"] = sum(
+                        size for path, size in after.items()
+                        if path not in before)
+            self.phases.append(record)
+
+    def add_r_results(self, results: list[RInstallResult]):
+        for res in results:
+            self.packages.append({
+                "name": res.package,
+                "source": res.source,
+                "status": res.status,
+                "seconds": res.seconds,
+            })
+
+    def to_record(self, action: str) -> dict:
+        """Build record stored in the env's meta info."""
+        total = 0.0
+        if self._start is not None:
+            total = round(time.perf_counter() - self._start, 3)
+        return {
+            "time": str(datetime.now()),
+            "action": action,
+            "total": total,
+            "phases": self.phases,
+            "packages": self.packages,
+        }
+
+
+def add_build_record(meta_info: dict, record: dict) -> dict:
+    """Append the record to the build history of the meta info,
+    only keep the latest `MAX_BUILD_HISTORY` ones."""
+    history = meta_info.get("build-history", []) + [record]
+    meta_info["build-history"] = history[-MAX_BUILD_HISTORY:]
+    return meta_info
+
+
+class BuildStats(T.NamedTuple):
+    phases: list[tuple[str, str, float, float, int | None]]
+    packages: list[tuple[str, str, str, float]]
+    trend: list[tuple[str, str, str, float]]
+
+
+def summarize_history(
+        histories: dict[str, list[dict]], top: int = 10) -> BuildStats:
+    """Summarize the build histories of envs.
+
+    :param histories: Mapping from env name to its build history.
+    :param top: Number of the slowest phases and packages to keep.
+    :return: The slowest phases as (env, phase, wall, cpu, bytes)
+    and packages as (env, package, source, seconds) of the latest builds,
+    and all builds as (env, time, action, total) ordered by time.
+    """
+    phases, packages, trend = [], [], []
+    for env_name, history in histories.items():
+        for record in history:
+            trend.append((
+                env_name, record["time"], record["action"],
+                record["total"]))
+        if len(history) == 0:
+            continue
+        latest = history[-1]
+        for p in latest["phases"]:
+            phases.append((
+                env_name, p["name"], p["wall"], p["cpu"], p.get("bytes")))
+        for p in latest["packages"]:
+            packages.append((
+                env_name, p["name"], p["source"], p["seconds"]))
+    phases.sort(key=lambda r: r[2], reverse=True)
+    packages.sort(key=lambda r: r[3], reverse=True)
+    trend.sort(key=lambda r: r[1])
+    return BuildStats(phases[:top], packages[:top], trend)
@@ -1,11 +1,20 @@
 from pathlib import Path
 import shutil
+import os
 import json
+import hashlib
 from datetime import datetime
+from contextlib import contextmanager
 
 from ..utils.log import console
 from ..utils.template import TemplatesRenderer
 from .env_build import CondaEnvBuild
+from .env_snapshot import EnvSnapshot
+from .env_update import BuildDiff
+from .env_lock import EnvLock
+from .build_profile import add_build_record
+from .build_log import BuildLog
+from .run_stats import RunUsage
 from .runner import ScriptRunner
 from ..utils.misc import file_has_changed_after
 
@@ -82,13 +91,70 @@ class Env(DirObj):
     def build_config(self) -> CondaEnvBuild:
         return CondaEnvBuild.from_config_file(self.path / "build.yaml")
 
-    def build(self):
-        """Build the conda env."""
-        self.build_config.build()
+    @property
+    def snapshot(self) -> EnvSnapshot:
+        """Cached activated environ of the built env."""
+        return EnvSnapshot(
+            self.path / ".env_snapshot.json",
+            self.build_config.conda_config)
+
+    @property
+    def lock(self) -> EnvLock:
+        """Lock artifacts of the built env."""
+        return EnvLock(self.path / "lock", self.build_config)
+
+    def build(self, from_lock: bool = False):
+        """Build the conda env.
+
+        :param from_lock: Recreate the env from the lock artifacts,
+        skip the conda solver.
+        """
+        self.snapshot.invalidate()
+        build_config = self.build_config
+        lock = EnvLock(self.path / "lock", build_config)
+        with self._build_log(build_config, "build"):
+            if from_lock:
+                lock.build_env()
+            else:
+                build_config.build()
+                lock.capture()
+        self._record_build(
+            build_config, "build-from-lock" if from_lock else "build")
+
+    @contextmanager
+    def _build_log(self, build_config: CondaEnvBuild, action: str):
+        """Capture the output of the build commands to a log file
+        under the `logs` dir of the env."""
+        log = BuildLog.start(self.logs_path, action)
+        console.log(f"Write the {action} log to [path]{log.path}[/path]")
+        build_config.set_log(log)
+        try:
+            yield log
+        finally:
+            log.close()
+            build_config.set_log(None)
+
+    @property
+    def logs_path(self) -> Path:
+        return self.path / "logs"
+
+    def _record_build(
+            self, build_config: CondaEnvBuild, action: str | None = None):
+        """Record the build time, the resolved build spec
+        and the phase timings of the build."""
         new_info = self.meta_info.copy()
         new_info['build-time'] = str(datetime.now())
+        new_info['build-spec'] = build_config.config
+        if action is not None:
+            add_build_record(
+                new_info, build_config.profile.to_record(action))
         self.meta_info = new_info
 
+    @property
+    def build_history(self) -> list[dict]:
+        """Phase timings of the recent builds."""
+        return self.meta_info.get('build-history', [])
+
     def update(self):
         """Update the built conda env."""
         if not self.is_built:
@@ -99,14 +165,65 @@ class Env(DirObj):
             build_time = datetime.fromisoformat(
                 self.meta_info['build-time'])
             if file_has_changed_after(self.path / 'build.yaml', build_time):
-                self.delete_built()
-                self.build()
+                self._update_from_diff()
             else:
                 console.log(
                     f"[note]{self.path.joinpath('build.yaml')}[/note] "
                     "has not changed, skip rebuild."
                 )
 
+    def _update_from_diff(self):
+        """Apply the build.yaml changes to the built env in place,
+        rebuild only when channels or the base interpreter changed."""
+        old_spec = self.meta_info.get('build-spec')
+        build_config = self.build_config
+        if old_spec is None:
+            console.log("No recorded build spec, rebuild the env.")
+            self.rebuild()
+            return
+        diff = BuildDiff(old_spec, build_config.config)
+        if build_config.shared_mode == "link" and not diff.is_empty:
+            console.log("The shared env can't be modified, rebuild the env.")
+            self.rebuild()
+        elif diff.need_rebuild:
+            console.log(
+                "Channels or base interpreter changed, rebuild the env.")
+            self.rebuild()
+        elif diff.is_empty:
+            console.log("Dependencies have not changed, skip update.")
+            self._record_build(build_config)
+        else:
+            console.log(f"Apply changes:\n{diff}")
+            self.snapshot.invalidate()
+            with self._build_log(build_config, "update"):
+                build_config.apply_diff(diff)
+                # keep `build --from_lock` and the state hash in sync
+                EnvLock(self.path / "lock", build_config).capture()
+            self._record_build(build_config, "update")
+
+    def rebuild(self):
+        """Delete the built env and build it again."""
+        if self.is_built:
+            self.delete_built()
+        self.build()
+
+    @property
+    def state_hash(self) -> str:
+        """Hash of the lock artifacts of the built env,
+        fallback to the recorded build spec."""
+        h = hashlib.sha256()
+        lock = self.lock
+        if lock.is_exist:
+            for p in sorted(lock.path.iterdir()):
+                h.update(p.name.encode())
+                h.update(p.read_bytes())
+        else:
+            h.update(json.dumps([
+                self.meta_info.get('build-spec'),
+                self.meta_info.get('build-time'),
+            ], sort_keys=True).encode())
+        return h.hexdigest()
+
     @property
     def build_name(self) -> str:
         return self.build_config.env_name
@@ -114,20 +231,65 @@ class Env(DirObj):
     def delete_built(self):
         """Delete the built conda env."""
         self.build_config.delete()
+        self.snapshot.invalidate()
         new_info = self.meta_info.copy()
         new_info['build-time'] = None
+        new_info.pop('build-spec', None)
         self.meta_info = new_info
 
     @property
     def is_built(self) -> bool:
-        return self.build_config.conda_config.is_built
+        return self.build_config.is_built
 
-    def run_command(self, command: list[str]):
+    def run_command(
+            self, command: list[str],
+            direct: bool | None = None,
+            log: BuildLog | None = None,
+            usage: RunUsage | None = None,
+            extra_environ: dict[str, str] | None = None,
+            cwd: Path | None = None):
         """Run command under the built env.
 
         :param command: The command need to run.
+        :param direct: Execute the command directly with the cached
+        activated environ instead of `conda run`.
+        If not set, use the `direct_run` option in build.yaml.
+        :param log: Capture the output to the log instead of the terminal.
+        :param usage: Measure the resources used by the command into it.
+        :param extra_environ: Extra env variables of the command.
+        :param cwd: Working dir of the command, default is the current dir.
+        """
+        conda_config = self.build_config.conda_config
+        conda_config.log = log
+        conda_config.usage = usage
+        conda_config.cwd = cwd
+        conda_config.extra_environ.update(extra_environ or {})
+        if direct is None:
+            direct = conda_config.direct_run
+        if direct:
+            environ = self.snapshot.get_environ()
+            environ.update(extra_environ or {})
+            conda_config.run_with_environ(command, environ)
+        else:
+            conda_config.run_under_env(command)
+
+    def prepare_command(
+            self, command: list[str],
+            direct: bool | None = None,
+            ) -> tuple[list[str], dict[str, str]]:
+        """Get the command line and the environ to run the command
+        under the built env, without running it.
+
+        :param direct: See `run_command`.
         """
-        self.build_config.conda_config.run_under_env(command)
+        conda_config = self.build_config.conda_config
+        if direct is None:
+            direct = conda_config.direct_run
+        if direct:
+            return command, self.snapshot.get_environ()
+        environ = os.environ.copy()
+        environ.update(conda_config.extra_environ)
+        return conda_config._get_conda_run_cmd(command), environ
 
     def __repr__(self):
         e = "created" if self.is_exist else "uncreated"
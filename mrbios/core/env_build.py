@@ -1,11 +1,27 @@
 import subprocess as subp
 from pathlib import Path
+import tempfile
 import os
 
 import yaml
 
 from ..utils.log import console
-from ..utils.misc import command_exist
+from ..utils.misc import command_exist, file_lock
+from ..utils.user_setting import DEFAULT_SETTING_PATH
+from .env_registry import EnvRegistry, get_env_registry
+from .env_update import BuildDiff, spec_name, github_spec_name
+from .env_cache import get_shared_mode, config_hash, shared_env_cache
+from .r_install import get_install_program, parse_install_results
+from .r_cache import RPackageCache
+from .pip_install import installed_distributions, is_satisfied
+from .build_profile import BuildProfile
+from .build_log import BuildLog, BuildCommandError
+from .run_stats import RunUsage, wait_process
+from .solve_cache import solve_cache, solve_key, repodata_stamp
+
+
+# Serialize the conda operations which touch the shared package cache.
+PKGS_LOCK_PATH = DEFAULT_SETTING_PATH.parent / "conda-pkgs.lock"
 
 
 class EnvBuild():
@@ -13,57 +29,332 @@ class EnvBuild():
 
 
 class CondaEnvBuild(EnvBuild):
-    def __init__(self, project_name: str, config: dict):
+    def __init__(
+            self, project_name: str, config: dict,
+            config_path: Path | None = None):
         self.config = config
+        self.config_path = config_path
         self.env_name = f"{project_name}-{config['name']}"
+        self.shared_mode = get_shared_mode(config)
+        # In the shared 'link' mode, the env is an alias of the shared env
+        # it was built with.
+        conda_env_name = self.env_name
+        if self.shared_mode == "link":
+            built_hash = self.built_hash
+            conda_env_name = self.shared_env_name if built_hash is None \
+                else shared_env_cache.env_name(built_hash)
         self.conda_config = CondaConfig(
-            self.env_name,
+            conda_env_name,
             config.get("conda", {}))
         self.pip_config = PipConfig(
-            config.get("pip", {}))
+            config.get("pip", {}),
+            self._default_wheelhouse(config_path))
         self.r_config = RConfig(
             config.get("R", {}))
+        # Phase timings of the build, see `Env.build`
+        self.profile = BuildProfile()
+        self.conda_config.profile = self.profile
 
     @staticmethod
     def from_config_file(path: str | Path) -> "CondaEnvBuild":
         with open(path) as f:
             config = yaml.safe_load(f)
         project_name = Path(path).parent.parent.parent.name
-        build = CondaEnvBuild(project_name, config)
+        build = CondaEnvBuild(project_name, config, Path(path))
         return build
 
     def write_to_config_file(self, path: str | Path):
         with open(path, "w") as f:
             yaml.dump(self.config, f, sort_keys=False)
 
+    @staticmethod
+    def _default_wheelhouse(config_path: Path | None) -> Path:
+        if config_path is None:
+            return DEFAULT_SETTING_PATH.parent / "wheelhouse"
+        project_path = config_path.absolute().parent.parent.parent
+        return project_path / ".wheelhouse"
+
+    def set_log(self, log: BuildLog | None):
+        """Capture the output of the build commands to the log."""
+        self.conda_config.log = log
+
+    @property
+    def config_hash(self) -> str:
+        return config_hash(self.config)
+
+    @property
+    def shared_env_name(self) -> str:
+        return shared_env_cache.env_name(self.config_hash)
+
+    @property
+    def built_hash(self) -> str | None:
+        """Config hash of the shared env this env was built with."""
+        return shared_env_cache.user_hash(self.env_name)
+
+    @property
+    def is_built(self) -> bool:
+        if (self.shared_mode is not None) and (self.built_hash is None):
+            return False
+        return self.conda_config.is_built
+
     def build(self):
-        self.conda_config.check_install_command()
-        self.conda_config.create_env()
+        if self.shared_mode is None:
+            self._build_env(self.conda_config)
+            return
+        hash_ = self.config_hash
+        shared_conda = CondaConfig(
+            self.shared_env_name, self.config.get("conda", {}))
+        shared_conda.log = self.conda_config.log
+        with file_lock(shared_env_cache.lock_path(hash_)):
+            if not shared_conda.is_built:
+                self._build_env(shared_conda)
+            else:
+                console.log(
+                    "Reuse the shared env "
+                    f"[note]{shared_conda.env_name}[/note]")
+        if self.shared_mode == "clone":
+            self.conda_config.check_install_command()
+            with self.profile.phase("conda clone"):
+                self.conda_config.clone_env(shared_conda.env_name)
+        env_path = None
+        if self.config_path is not None:
+            env_path = self.config_path.parent.absolute()
+        shared_env_cache.add_user(hash_, self.env_name, env_path)
+
+    def _build_env(self, conda_config: "CondaConfig"):
+        conda_config.check_install_command()
+        with self.profile.phase("conda create", count_download=True):
+            conda_config.create_env()
         # Install pip packages
         if not self.pip_config.is_empty:
-            self.conda_config.run_under_env(
-                self.pip_config.get_install_command()
-            )
+            self.install_pip_packages(
+                conda_config, self.pip_config.dependents)
         if not self.r_config.is_empty:
-            self.conda_config.set_r_lib_path()
-            # Install CRAN packages
-            if len(self.r_config.cran_dependents) > 0:
-                self.conda_config.run_under_env(
-                    self.r_config.get_cran_command()
-                )
-            # Install Bioconductor packages
-            if len(self.r_config.bioconductor_dependents) > 0:
+            conda_config.set_r_lib_path()
+            self.install_r_packages(
+                conda_config,
+                self.r_config.cran_dependents,
+                self.r_config.bioconductor_dependents,
+                self.r_config.github_dependents,
+            )
+
+    def install_pip_packages(
+            self, conda_config: "CondaConfig", dependents: list[str]):
+        """Install pip packages, skip the ones already satisfied.
+
+        If the wheelhouse is enabled, install from the local wheels first,
+        build the missing wheels into the wheelhouse when it fails.
+        """
+        with self.profile.phase("pip"):
+            self._install_pip_packages(conda_config, dependents)
+
+    def _install_pip_packages(
+            self, conda_config: "CondaConfig", dependents: list[str]):
+        pip_config = self.pip_config
+        dists = installed_distributions(conda_config.env_path)
+        dependents = [d for d in dependents if not is_satisfied(d, dists)]
+        if len(dependents) == 0:
+            console.log("All pip dependents are satisfied, skip install.")
+            return
+        pip_config.check_installer()
+        wheelhouse = pip_config.wheelhouse
+        if wheelhouse is None:
+            conda_config.run_under_env(
+                pip_config.get_install_command(dependents))
+            return
+        wheelhouse.mkdir(parents=True, exist_ok=True)
+        offline_cmd = pip_config.get_install_command(
+            dependents, wheelhouse=wheelhouse)
+        try:
+            conda_config.run_under_env(offline_cmd)
+        except subp.CalledProcessError:
+            console.log(
+                "Build the missing wheels into "
+                f"[path]{wheelhouse}[/path]")
+            conda_config.run_under_env(
+                pip_config.get_wheel_command(dependents, wheelhouse))
+            conda_config.run_under_env(offline_cmd)
+
+    def install_r_packages(
+            self, conda_config: "CondaConfig",
+            cran: list[str], bioconductor: list[str], github: list[str]):
+        """Install CRAN, Bioconductor and GitHub packages in one R session.
+
+        Packages already installed at a satisfying version are skipped.
+        """
+        if len(cran) + len(bioconductor) + len(github) == 0:
+            return
+        program = self.r_config.get_install_program(
+            cran, bioconductor, github)
+        with self.profile.phase("R"), \
+                tempfile.TemporaryDirectory() as tmp_dir:
+            program_path = Path(tmp_dir) / "install.R"
+            results_path = Path(tmp_dir) / "results.tsv"
+            program_path.write_text(program)
+            cmd = ["Rscript", str(program_path), str(results_path)]
+            cache = self.r_config.binary_cache
+            if cache is not None:
+                cache.path.mkdir(parents=True, exist_ok=True)
+                cmd.append(str(cache.path))
+            conda_config.run_under_env(cmd)
+            results = parse_install_results(results_path)
+        self.profile.add_r_results(results)
+        if cache is not None:
+            cache.evict()
+        failed = []
+        for res in results:
+            console.log(
+                f"R package [note]{res.package}[/note] ({res.source}): "
+                f"{res.status} in {res.seconds:.1f}s")
+            if res.status == "failed":
+                failed.append(res)
+        if len(failed) > 0:
+            msg = "; ".join(f"{r.package}: {r.message}" for r in failed)
+            console.log(f"[error]Failed to install R packages: {msg}[/error]")
+            raise RuntimeError(f"Failed to install R packages: {msg}")
+
+    def apply_diff(self, diff: BuildDiff):
+        """Apply the changes of build config to the built env in place."""
+        self.conda_config.check_install_command()
+        if len(diff.conda.removed) > 0:
+            with self.profile.phase("conda remove"):
+                self.conda_config.remove_packages(diff.conda.removed)
+        if len(diff.conda.added) > 0:
+            with self.profile.phase("conda install", count_download=True):
+                self.conda_config.install_packages(diff.conda.added)
+        if len(diff.pip.removed) > 0:
+            with self.profile.phase("pip uninstall"):
                 self.conda_config.run_under_env(
-                    self.r_config.get_bioconductor_command()
-                )
-            # Install github packages
-            if len(self.r_config.github_dependents) > 0:
+                    self.pip_config.get_uninstall_command(diff.pip.removed))
+        if len(diff.pip.added) > 0:
+            self.install_pip_packages(self.conda_config, diff.pip.added)
+        r_diffs = diff.r
+        if all(d.is_empty for d in r_diffs.values()):
+            return
+        self.conda_config.set_r_lib_path()
+        r_removed = [
+            spec_name(s) for s in
+            r_diffs["cran"].removed + r_diffs["bioconductor"].removed
+        ] + [github_spec_name(s) for s in r_diffs["github"].removed]
+        if len(r_removed) > 0:
+            with self.profile.phase("R remove"):
                 self.conda_config.run_under_env(
-                    self.r_config.get_devtools_command()
-                )
+                    self.r_config.get_remove_command(r_removed))
+        self.install_r_packages(
+            self.conda_config,
+            r_diffs["cran"].added,
+            r_diffs["bioconductor"].added,
+            r_diffs["github"].added,
+        )
 
     def delete(self):
-        self.conda_config.remove_env()
+        if self.shared_mode != "link":
+            self.conda_config.remove_env()
+        if self.shared_mode is not None:
+            shared_env_cache.remove_user(self.env_name)
+
+
+class CondaBackend():
+    """Command line of the tool used to manage conda envs.
+
+    `command` is used to create envs and install packages,
+    `manager` is used to run commands, list and remove envs.
+    """
+    command = "conda"
+    manager = "conda"
+
+    def create_cmd(
+            self, main_cmd: str, env_name: str,
+            channels: list[str], dependents: list[str]) -> list[str]:
+        cmd = [self.command, main_cmd, "-n", env_name]
+        for c in channels:
+            cmd.append("-c")
+            cmd.append(c)
+        cmd += dependents + ["--yes"]
+        return cmd
+
+    def create_from_file_cmd(
+            self, env_name: str, explicit_file: Path) -> list[str]:
+        return [
+            self.command, "create", "-n", env_name,
+            "--file", str(explicit_file), "--yes"
+        ]
+
+    def clone_cmd(self, env_name: str, source_env: str) -> list[str] | None:
+        """Command for clone env, None if it's not supported."""
+        return [
+            self.command, "create", "-n", env_name,
+            "--clone", source_env, "--yes"
+        ]
+
+    def remove_packages_cmd(
+            self, env_name: str, packages: list[str]) -> list[str]:
+        return [self.command, "remove", "-n", env_name] + \
+            packages + ["--yes"]
+
+    def remove_env_cmd(self, env_name: str) -> list[str]:
+        return [self.manager, "env", "remove", "-n", env_name]
+
+    def run_cmd(self, env_name: str, command: list[str]) -> list[str]:
+        cmd = [
+            self.manager, "run", "--no-capture-output",
+            "-n", env_name
+        ]
+        return cmd + command
+
+    def list_explicit_cmd(self, env_name: str) -> list[str]:
+        return [
+            self.manager, "list", "-n", env_name,
+            "--explicit", "--md5"
+        ]
+
+    @property
+    def registry(self) -> EnvRegistry:
+        return get_env_registry(self.manager)
+
+
+class MambaBackend(CondaBackend):
+    command = "mamba"
+
+
+class MicromambaBackend(CondaBackend):
+    """Standalone micromamba, no base conda install needed."""
+    command = "micromamba"
+    manager = "micromamba"
+
+    def clone_cmd(self, env_name: str, source_env: str) -> list[str] | None:
+        return None
+
+    def remove_env_cmd(self, env_name: str) -> list[str]:
+        return [self.manager, "env", "remove", "-n", env_name, "--yes"]
+
+    def run_cmd(self, env_name: str, command: list[str]) -> list[str]:
+        return [self.manager, "run", "-n", env_name] + command
+
+    def list_explicit_cmd(self, env_name: str) -> list[str]:
+        return [
+            self.manager, "env", "export", "-n", env_name,
+            "--explicit", "--md5"
+        ]
+
+
+BACKENDS: dict[str, type[CondaBackend]] = {
+    "micromamba": MicromambaBackend,
+    "mamba": MambaBackend,
+    "conda": CondaBackend,
+}
+
+
+def get_backend(install_command: str) -> CondaBackend:
+    """Get the backend by the `install_command`, if it's 'auto' or
+    not installed, use the first available one of
+    micromamba, mamba and conda."""
+    if (install_command in BACKENDS) and command_exist(install_command):
+        return BACKENDS[install_command]()
+    for name, cls in BACKENDS.items():
+        if command_exist(name):
+            return cls()
+    return CondaBackend()
 
 
 class CondaConfig():
@@ -73,101 +364,223 @@ class CondaConfig():
         self.channels = config.get("channels", [])
         self.dependents = config.get("deps", [])
         self.install_command = self.config.get("install_command", "conda")
+        self.direct_run = self.config.get("direct_run", False)
+        self.use_solve_cache = self.config.get("solve_cache", True)
+        # Extra environment variables for the commands run by this env,
+        # avoid to modify os.environ when building envs concurrently.
+        self.extra_environ: dict[str, str] = {}
+        # Capture the output of the commands to the log if it's set.
+        self.log: BuildLog | None = None
+        # Measure the resources used by the commands into it.
+        self.usage: RunUsage | None = None
+        # Profile of the build, the commands are measured
+        # into its current phase.
+        self.profile: BuildProfile | None = None
+        # Working dir of the commands, the current dir if it's not set.
+        self.cwd: Path | None = None
+
+    @property
+    def backend(self) -> CondaBackend:
+        return get_backend(self.install_command)
 
     def check_install_command(self):  # pragma: no cover
+        if self.install_command == "auto":
+            self.install_command = self.backend.command
         if not command_exist(self.install_command):
-            if self.install_command != "conda":
+            backend = self.backend
+            if command_exist(backend.command):
                 console.log(
                     f"[error]{self.install_command} not installed, "
-                    "turn to using conda[/error]")
-                self.install_command = "conda"
-                self.check_install_command()
+                    f"turn to using {backend.command}[/error]")
+                self.install_command = backend.command
             else:
-                raise SystemError("Conda is not installed.")
-
-    def _get_install_cmd(self, main_cmd: str) -> list[str]:
-        cmd = [self.install_command, main_cmd, "-n", self.env_name]
-        for c in self.channels:
-            cmd.append("-c")
-            cmd.append(c)
-        cmd += self.dependents + ["--yes"]
-        return cmd
-
-    def _run_cmd(self, cmd: list[str], cmd_name: str):
+                raise SystemError(
+                    "None of conda, mamba or micromamba is installed.")
+
+    def _get_install_cmd(
+            self, main_cmd: str,
+            dependents: list[str] | None = None) -> list[str]:
+        if dependents is None:
+            dependents = self.dependents
+        return self.backend.create_cmd(
+            main_cmd, self.env_name, self.channels, dependents)
+
+    def _run_cmd(
+            self, cmd: list[str], cmd_name: str,
+            environ: dict[str, str] | None = None):
         cmd_str = " ".join(cmd)
         console.log(f"Run command [path]{cmd_str}[/path]")
+        if environ is None:
+            environ = os.environ.copy()
+            environ.update(self.extra_environ)
+        usage = self.usage
+        if (usage is None) and (self.profile is not None):
+            usage = self.profile.usage
         try:
-            subp.check_call(cmd, env=os.environ.copy())
+            if self.log is None:
+                code = wait_process(
+                    subp.Popen(cmd, env=environ, cwd=self.cwd), usage)
+                if code != 0:
+                    raise subp.CalledProcessError(code, cmd)
+            else:
+                self.log.run(cmd, environ, usage=usage, cwd=self.cwd)
+        except BuildCommandError as e:
+            console.log(
+                f"[error]Failed to {cmd_name} env "
+                f"[note]{self.env_name}[/note], "
+                f"see the log [path]{e.log_path}[/path][/error]")
+            tail = "\n".join(e.tail)
+            console.log(f"Last lines of the output:\n{tail}", markup=False)
+            raise e
         except Exception as e:
             console.log(
                 f"[error]Failed to {cmd_name} env "
                 f"[note]{self.env_name}[/note][error]")
             raise e
 
+    def solve_key(self) -> str:
+        stamp = repodata_stamp(self.channels)
+        return solve_key(self.channels, self.dependents, stamp)
+
     def create_env(self):
+        """Create env and install the conda dependents.
+
+        The solve result is cached, the env with the same channels and
+        dependents is created from the cached explicit spec directly.
+        """
+        if self.use_solve_cache:
+            explicit_file = solve_cache.get(self.solve_key())
+            if explicit_file is not None:
+                console.log(
+                    "Create env from the cached solve result "
+                    f"[path]{explicit_file}[/path]")
+                try:
+                    self.create_env_from_file(explicit_file)
+                    return
+                except subp.CalledProcessError:
+                    console.log(
+                        "[error]Failed to create env from the cached "
+                        "solve result, solve again.[/error]")
         cmd = self._get_install_cmd("create")
-        self._run_cmd(cmd, "create")
+        try:
+            with file_lock(PKGS_LOCK_PATH):
+                self._run_cmd(cmd, "create")
+        finally:
+            self.registry.invalidate()
+        if self.use_solve_cache:
+            # the repodata may be refreshed by the solver, get key after it
+            explicit = subp.check_output(self.get_list_explicit_cmd())
+            solve_cache.put(self.solve_key(), explicit.decode())
+
+    def clone_env(self, source_env: str):
+        """Create env by cloning another env, files are hardlinked
+        when it's possible."""
+        cmd = self.backend.clone_cmd(self.env_name, source_env)
+        if cmd is None:
+            # clone is not supported, create from the explicit spec
+            source = CondaConfig(source_env, self.config)
+            explicit = subp.check_output(
+                source.get_list_explicit_cmd()).decode()
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                explicit_file = Path(tmp_dir) / "explicit.txt"
+                explicit_file.write_text(explicit)
+                self.create_env_from_file(explicit_file)
+            return
+        try:
+            self._run_cmd(cmd, "clone")
+        finally:
+            self.registry.invalidate()
+
+    def create_env_from_file(self, explicit_file: Path):
+        """Create env from an explicit spec file, without solving."""
+        cmd = self.backend.create_from_file_cmd(self.env_name, explicit_file)
+        try:
+            with file_lock(PKGS_LOCK_PATH):
+                self._run_cmd(cmd, "create")
+        finally:
+            self.registry.invalidate()
+
+    def get_list_explicit_cmd(self) -> list[str]:
+        """Get the command to list the explicit spec of the env."""
+        return self.backend.list_explicit_cmd(self.env_name)
+
+    def install_packages(self, dependents: list[str]):
+        """Install packages to the built env."""
+        cmd = self._get_install_cmd("install", dependents)
+        try:
+            with file_lock(PKGS_LOCK_PATH):
+                self._run_cmd(cmd, "install packages in")
+        finally:
+            self.registry.invalidate()
+
+    def remove_packages(self, dependents: list[str]):
+        """Remove packages from the built env."""
+        cmd = self.backend.remove_packages_cmd(
+            self.env_name, [spec_name(d) for d in dependents])
+        try:
+            self._run_cmd(cmd, "remove packages in")
+        finally:
+            self.registry.invalidate()
 
     def remove_env(self):
-        cmd = [
-            "conda", "env", "remove", "-n",
-            self.env_name
-        ]
-        self._run_cmd(cmd, "remove")
+        cmd = self.backend.remove_env_cmd(self.env_name)
+        try:
+            self._run_cmd(cmd, "remove")
+        finally:
+            self.registry.invalidate()
 
     def _get_conda_run_cmd(self, command: list[str]) -> list[str]:
         """Get the command to run under conda env."""
-        cmd = [
-            "conda", "run", "--no-capture-output",
-            "-n", self.env_name
-        ]
-        cmd += command
-        return cmd
+        return self.backend.run_cmd(self.env_name, command)
 
     def run_under_env(self, command: list[str]):
         """Run command under conda env."""
         cmd = self._get_conda_run_cmd(command)
         self._run_cmd(cmd, "run command in")
 
+    def run_with_environ(
+            self, command: list[str], environ: dict[str, str]):
+        """Run command directly with an activated environ,
+        bypass the `conda run`."""
+        self._run_cmd(command, "run command in", environ=environ)
+
+    @property
+    def registry(self) -> EnvRegistry:
+        return self.backend.registry
+
     @property
     def env_path(self) -> Path:
         """Get the path of conda env."""
-        # get the output of conda env list
-        cmd = ["conda", "env", "list"]
-        cmd = self._get_conda_run_cmd(cmd)
-        out = subp.check_output(cmd).decode()
-        # find the path of env
-        for line in out.splitlines():
-            if "*" in line:
-                env_path = line.split()[-1]
-                return Path(env_path)
-        else:  # pragma: no cover
+        env_path = self.registry.get_prefix(self.env_name)
+        if env_path is None:  # pragma: no cover
             raise ValueError("Cannot find conda env path.")
+        return env_path
 
     @property
     def is_built(self) -> bool:
         """Check if the env is built."""
-        cmd = ["conda", "run", "-n", self.env_name, "conda", "--version"]
-        try:
-            subp.check_call(
-                cmd, env=os.environ.copy(),
-                stdout=subp.DEVNULL, stderr=subp.DEVNULL)
-        except subp.CalledProcessError:
-            return False
-        return True
+        return self.registry.is_built(self.env_name)
 
     def set_r_lib_path(self):
         """Set the R_LIBS_USER env variable."""
         env_path = self.env_path
         r_lib_path = env_path / "Lib/R/library"
         console.log(f"Set R_LIBS_USER to [path]{r_lib_path}[/path]")
-        os.environ["R_LIBS_USER"] = str(r_lib_path)
+        self.extra_environ["R_LIBS_USER"] = str(r_lib_path)
 
 
 class PipConfig():
-    """Pip config for conda env build."""
-    def __init__(self, config: dict):
+    """Pip config for conda env build.
+
+    :param default_wheelhouse: Wheelhouse path used when
+    the `wheelhouse` option is `true`.
+    """
+    def __init__(
+            self, config: dict,
+            default_wheelhouse: Path | None = None):
         self.config = config
+        self.installer = config.get("installer", "pip")
+        self.default_wheelhouse = default_wheelhouse
 
     @property
     def is_empty(self) -> bool:
@@ -177,10 +590,65 @@ class PipConfig():
     def dependents(self) -> list[str]:
         return self.config.get("deps", [])
 
-    def get_install_command(self) -> list[str]:
-        """Get pip install command. """
-        cmd = ["pip", "install"]
-        cmd += self.dependents
+    @property
+    def wheelhouse(self) -> Path | None:
+        """Directory caches the built wheels,
+        set by the `wheelhouse` option: `true` or a path."""
+        option = self.config.get("wheelhouse")
+        if not option:
+            return None
+        if option is True:
+            return self.default_wheelhouse
+        return Path(option).expanduser()
+
+    def check_installer(self):
+        if self.installer not in ("pip", "uv"):
+            raise ValueError(
+                f"Unknown pip installer: {self.installer}, "
+                "should be 'pip' or 'uv'.")
+        if (self.installer == "uv") and not command_exist("uv"):
+            console.log(
+                "[error]uv not installed, turn to using pip[/error]")
+            self.installer = "pip"
+
+    def get_install_command(
+            self, dependents: list[str] | None = None,
+            wheelhouse: Path | None = None) -> list[str]:
+        """Get pip install command.
+
+        :param wheelhouse: Install from the local wheels only.
+        """
+        if dependents is None:
+            dependents = self.dependents
+        if self.installer == "uv":
+            cmd = ["uv", "pip", "install", "--python", "python"]
+        else:
+            cmd = ["pip", "install"]
+        if wheelhouse is not None:
+            cmd += ["--no-index", "--find-links", str(wheelhouse)]
+        cmd += dependents
+        return cmd
+
+    def get_wheel_command(
+            self, dependents: list[str], wheelhouse: Path) -> list[str]:
+        """Get command for build the wheels of packages and
+        their dependencies into the wheelhouse."""
+        cmd = [
+            "pip", "wheel", "--wheel-dir", str(wheelhouse),
+            "--find-links", str(wheelhouse),
+        ]
+        cmd += dependents
+        return cmd
+
+    def get_install_locked_command(self, requirements: Path) -> list[str]:
+        """Get pip install command for a pinned requirements file."""
+        cmd = ["pip", "install", "--no-deps", "-r", str(requirements)]
+        return cmd
+
+    def get_uninstall_command(self, dependents: list[str]) -> list[str]:
+        """Get pip uninstall command. """
+        cmd = ["pip", "uninstall", "--yes"]
+        cmd += [spec_name(d) for d in dependents]
         return cmd
 
 
@@ -199,6 +667,12 @@ class RConfig(EnvBuild):
             len(self.bioconductor_dependents) == 0 and \
             len(self.github_dependents) == 0
 
+    @property
+    def binary_cache(self) -> RPackageCache | None:
+        """The binary package cache shared by envs,
+        enabled by the `binary_cache` option."""
+        return RPackageCache.from_config(self.config.get("binary_cache"))
+
     @property
     def cran_mirror(self) -> str:
         default_mirror = "https://cloud.r-project.org/"
@@ -220,9 +694,11 @@ class RConfig(EnvBuild):
     def github_dependents(self) -> list[str]:
         return self.devtools_config.get("deps", [])
 
-    def get_cran_command(self) -> list[str]:
+    def get_cran_command(
+            self, dependents: list[str] | None = None) -> list[str]:
         """Get cran install command. """
-        dependents = self.cran_dependents
+        if dependents is None:
+            dependents = self.cran_dependents
         if len(dependents) > 1:
             dependents = [f"'{d}'" for d in dependents]
             pkgs_str = f"c({', '.join(dependents)})"
@@ -235,9 +711,15 @@ class RConfig(EnvBuild):
         cmd = ["Rscript", "-e", f'{install_inst}']
         return cmd
 
-    def get_bioconductor_command(self) -> list[str]:
-        """Get bioconductor install command. """
-        dependents = self.bioconductor_dependents
+    def get_bioconductor_command(
+            self, dependents: list[str] | None = None,
+            bioc_version: str | None = None) -> list[str]:
+        """Get bioconductor install command.
+
+        :param bioc_version: Pin the Bioconductor release.
+        """
+        if dependents is None:
+            dependents = self.bioconductor_dependents
         if len(dependents) > 1:
             dependents = [f"'{d}'" for d in dependents]
             pkgs_str = f"c({', '.join(dependents)})"
@@ -246,8 +728,11 @@ class RConfig(EnvBuild):
         install_inst = (
             "if (!requireNamespace('BiocManager', quietly = TRUE)) "
             f"install.packages('BiocManager', repos='{self.cran_mirror}'); "
-            f"BiocManager::install({pkgs_str})"
+            f"BiocManager::install({pkgs_str}"
         )
+        if bioc_version is not None:
+            install_inst += f", version='{bioc_version}', update=FALSE"
+        install_inst += ")"
         if self.bioconductor_mirror is not None:  # pragma: no cover
             install_inst = (
                 f"options(BioC_mirror='{self.bioconductor_mirror}'); " +
@@ -256,9 +741,11 @@ class RConfig(EnvBuild):
         cmd = ["Rscript", "-e", f'{install_inst}']
         return cmd
 
-    def get_devtools_command(self) -> list[str]:
+    def get_devtools_command(
+            self, dependents: list[str] | None = None) -> list[str]:
         """Get devtools install command. """
-        dependents = self.github_dependents
+        if dependents is None:
+            dependents = self.github_dependents
         if len(dependents) > 1:
             dependents = [f"'{d}'" for d in dependents]
             pkgs_str = f"c({', '.join(dependents)})"
@@ -271,3 +758,57 @@ class RConfig(EnvBuild):
         )
         cmd = ["Rscript", "-e", f'{install_inst}']
         return cmd
+
+    def get_remove_command(self, packages: list[str]) -> list[str]:
+        """Get R packages remove command. """
+        pkgs = ", ".join([f"'{p}'" for p in packages])
+        remove_inst = f"remove.packages(c({pkgs}))"
+        cmd = ["Rscript", "-e", remove_inst]
+        return cmd
+
+    def get_cran_locked_command(
+            self, versions: dict[str, str]) -> list[str]:
+        """Get command for install CRAN packages with pinned versions."""
+        install_inst = (
+            "if (!requireNamespace('remotes', quietly = TRUE)) "
+            f"install.packages('remotes', repos='{self.cran_mirror}'); "
+        )
+        for name, version in versions.items():
+            install_inst += (
+                f"remotes::install_version('{name}', version='{version}', "
+                f"repos='{self.cran_mirror}', upgrade='never'); "
+            )
+        cmd = ["Rscript", "-e", install_inst]
+        return cmd
+
+    def get_versions_command(self, packages: list[str]) -> list[str]:
+        """Get command for print the version and remote SHA of
+        installed packages, and the Bioconductor release.
+        Output tab separated lines: name, version, sha."""
+        pkgs = ", ".join([f"'{p}'" for p in packages])
+        inst = (
+            f"for (p in c({pkgs})) {{ "
+            "d <- packageDescription(p); "
+            "if (!is.list(d)) next; "
+            "sha <- if (is.null(d$RemoteSha)) '' else d$RemoteSha; "
+            "cat(p, d$Version, sha, sep='\\t'); cat('\\n') }; "
+            "if (requireNamespace('BiocManager', quietly = TRUE)) { "
+            "cat('BiocVersion', as.character(BiocManager::version()), '', "
+            "sep='\\t'); cat('\\n') }"
+        )
+        cmd = ["Rscript", "-e", inst]
+        return cmd
+
+    def get_install_program(
+            self, cran: list[str] | None = None,
+            bioconductor: list[str] | None = None,
+            github: list[str] | None = None) -> str:
+        """Get the R program which installs all the packages
+        in a single session, with `Ncpus` set to the available cores."""
+        return get_install_program(
+            self.cran_dependents if cran is None else cran,
+            self.bioconductor_dependents if bioconductor is None
+            else bioconductor,
+            self.github_dependents if github is None else github,
+            self.cran_mirror, self.bioconductor_mirror,
+        )
@@ -0,0 +1,169 @@
+from pathlib import Path
+import hashlib
+import json
+import platform
+import sys
+import typing as T
+
+from ..utils.log import console
+from ..utils.misc import dump_json_atomic, file_lock
+from ..utils.user_setting import DEFAULT_SETTING_PATH
+
+
+SHARED_ENVS_PATH = DEFAULT_SETTING_PATH.parent / "shared_envs"
+SHARED_ENV_NAME_PREFIX = "mrbios-shared-"
+SHARED_MODES = ("link", "clone")
+
+
+def get_shared_mode(config: dict) -> str | None:
+    """Get the shared env mode from the build config.
+
+    `shared: true` is the same as `shared: link`.
+    """
+    mode = config.get("shared")
+    if (mode is None) or (mode is False):
+        return None
+    if mode is True:
+        return "link"
+    if mode not in SHARED_MODES:
+        raise ValueError(
+            f"Unknown shared mode: {mode}, "
+            f"should be one of {SHARED_MODES}")
+    return mode
+
+
+def config_hash(config: dict) -> str:
+    """Hash of the normalized build config.
+
+    The env name and the shared option are ignored, deps are sorted,
+    channels keep their order because it's the priority.
+    """
+    def sort_deps(section: dict) -> dict:
+        section = dict(section)
+        if "deps" in section:
+            section["deps"] = sorted(section["deps"])
+        return section
+
+    conda = sort_deps(config.get("conda", {}))
+    conda.pop("install_command", None)
+    conda.pop("direct_run", None)
+    conda.pop("solve_cache", None)
+    pip = sort_deps(config.get("pip", {}))
+    pip.pop("installer", None)
+    pip.pop("wheelhouse", None)
+    normalized = {
+        "conda": conda,
+        "pip": pip,
+        "R": {
+            k: sort_deps(v) for k, v in config.get("R", {}).items()
+            if isinstance(v, dict) and (k != "binary_cache")
+        },
+        "platform": f"{sys.platform}-{platform.machine()}",
+    }
+    content = json.dumps(normalized, sort_keys=True)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+class SharedEnvCache():
+    """Built envs shared across projects, one env per config hash.
+
+    Keep the reference of the project envs which use the shared env,
+    the unused shared envs will be removed by `gc`.
+    """
+    def __init__(self, path: Path = SHARED_ENVS_PATH):
+        self.path = path
+
+    @property
+    def info_path(self) -> Path:
+        return self.path / "refs.json"
+
+    def lock_path(self, key: str = "refs") -> Path:
+        return self.path / f"{key}.lock"
+
+    @staticmethod
+    def env_name(hash_: str) -> str:
+        return SHARED_ENV_NAME_PREFIX + hash_[:16]
+
+    def load(self) -> dict[str, dict[str, str]]:
+        """Load the mapping: config hash -> {user env name: env path}."""
+        if not self.info_path.exists():
+            return {}
+        with open(self.info_path) as f:
+            return json.load(f)
+
+    def _modify(self, func: T.Callable[[dict], None]):
+        with file_lock(self.lock_path()):
+            refs = self.load()
+            func(refs)
+            dump_json_atomic(refs, self.info_path)
+
+    def add_user(self, hash_: str, user: str, path: Path | None):
+        """Add a reference to the shared env."""
+        def _add(refs: dict):
+            # One user can only refer to one shared env.
+            for users in refs.values():
+                users.pop(user, None)
+            refs.setdefault(hash_, {})[user] = str(path)
+        self._modify(_add)
+
+    def remove_user(self, user: str):
+        """Remove the reference of an user."""
+        def _remove(refs: dict):
+            for users in refs.values():
+                users.pop(user, None)
+        self._modify(_remove)
+
+    def has_user(self, hash_: str, user: str) -> bool:
+        return user in self.load().get(hash_, {})
+
+    def user_hash(self, user: str) -> str | None:
+        """Hash of the shared env the user refers to,
+        it's the config at the build time, not the current one."""
+        for hash_, users in self.load().items():
+            if user in users:
+                return hash_
+        return None
+
+    @staticmethod
+    def _is_alive(hash_: str, path: str) -> bool:
+        """Check if the user env still exists and is shared,
+        it uses the shared env until it's updated, even if its
+        build.yaml has been edited."""
+        from .env_build import CondaEnvBuild
+        config_file = Path(path) / "build.yaml"
+        if not config_file.exists():
+            return False
+        build = CondaEnvBuild.from_config_file(config_file)
+        return build.shared_mode is not None
+
+    def gc(self, dry_run: bool = False) -> list[str]:
+        """Remove the shared envs which are no longer used.
+
+        :return: Names of the removed envs.
+        """
+        from .env_build import CondaConfig
+        removed = []
+        with file_lock(self.lock_path()):
+            refs = self.load()
+            for hash_, users in list(refs.items()):
+                for user, path in list(users.items()):
+                    if not self._is_alive(hash_, path):
+                        users.pop(user)
+                if len(users) > 0:
+                    continue
+                name = self.env_name(hash_)
+                conda_config = CondaConfig(name, {})
+                if conda_config.is_built:
+                    console.log(
+                        f"Remove unused shared env [note]{name}[/note]")
+                    if not dry_run:
+                        conda_config.remove_env()
+                    removed.append(name)
+                if not dry_run:
+                    refs.pop(hash_)
+            if not dry_run:
+                dump_json_atomic(refs, self.info_path)
+        return removed
+
+
+shared_env_cache = SharedEnvCache()
@@ -0,0 +1,158 @@
+import subprocess as subp
+from pathlib import Path
+import json
+import typing as T
+
+from ..utils.log import console
+from ..utils.misc import dump_json_atomic
+from .env_update import spec_name, github_spec_name
+
+if T.TYPE_CHECKING:
+    from .env_build import CondaEnvBuild
+
+
+# List the packages installed by pip/uv, skip the ones installed by conda.
+PIP_FREEZE_SCRIPT = """
+import importlib.metadata as m
+for d in m.distributions():
+    if (d.read_text('INSTALLER') or '').strip() in ('pip', 'uv'):
+        print(f"{d.metadata['Name']}=={d.version}")
+"""
+
+
+class EnvLock():
+    """Lock artifacts of a built env, used to rebuild the env
+    without running the conda solver.
+
+    The lock directory contains:
+
+    + `conda-explicit.txt`: conda explicit spec, with URLs and md5 hashes.
+    + `pip-requirements.txt`: pinned packages installed by pip.
+    + `R-packages.json`: versions of the R packages and the
+      Bioconductor release.
+    """
+    def __init__(self, path: Path, build: "CondaEnvBuild"):
+        self.path = path
+        self.build = build
+
+    @property
+    def explicit_path(self) -> Path:
+        return self.path / "conda-explicit.txt"
+
+    @property
+    def pip_path(self) -> Path:
+        return self.path / "pip-requirements.txt"
+
+    @property
+    def r_path(self) -> Path:
+        return self.path / "R-packages.json"
+
+    @property
+    def is_exist(self) -> bool:
+        return self.explicit_path.exists()
+
+    def capture(self):
+        """Capture the lock artifacts from the built env."""
+        with self.build.profile.phase("lock"):
+            self._capture()
+
+    def _capture(self):
+        console.log(
+            f"Write lock of [note]{self.build.env_name}[/note] "
+            f"to [path]{self.path}[/path]")
+        self.path.mkdir(parents=True, exist_ok=True)
+        conda_config = self.build.conda_config
+        explicit = subp.check_output(
+            conda_config.get_list_explicit_cmd()).decode()
+        with open(self.explicit_path, 'w') as f:
+            f.write(explicit)
+        if not self.build.pip_config.is_empty:
+            cmd = conda_config._get_conda_run_cmd(
+                ["python", "-c", PIP_FREEZE_SCRIPT])
+            freeze = subp.check_output(cmd).decode()
+            with open(self.pip_path, 'w') as f:
+                f.write(freeze)
+        if not self.build.r_config.is_empty:
+            self.capture_r_packages()
+
+    def capture_r_packages(self):
+        r_config = self.build.r_config
+        names = [
+            spec_name(s) for s in
+            r_config.cran_dependents + r_config.bioconductor_dependents
+        ] + [github_spec_name(s) for s in r_config.github_dependents]
+        cmd = self.build.conda_config._get_conda_run_cmd(
+            r_config.get_versions_command(names))
+        out = subp.check_output(cmd).decode()
+        packages = {}
+        bioc_version = None
+        for line in out.splitlines():
+            items = line.split("\t")
+            if len(items) != 3:
+                continue
+            name, version, sha = items
+            if name == "BiocVersion":
+                bioc_version = version
+            else:
+                packages[name] = {"version": version, "sha": sha or None}
+        dump_json_atomic({
+            "bioc-version": bioc_version,
+            "packages": packages,
+        }, self.r_path)
+
+    def load_r_packages(self) -> dict:
+        with open(self.r_path) as f:
+            return json.load(f)
+
+    def build_env(self):
+        """Recreate the env from the lock artifacts,
+        skip the conda solver."""
+        if not self.is_exist:
+            raise IOError(
+                f"Lock of {self.build.env_name} not found "
+                f"at {self.path}, please build it without lock first.")
+        conda_config = self.build.conda_config
+        conda_config.check_install_command()
+        profile = self.build.profile
+        with profile.phase("conda create", count_download=True):
+            conda_config.create_env_from_file(self.explicit_path)
+        if self.pip_path.exists():
+            with profile.phase("pip"):
+                conda_config.run_under_env(
+                    self.build.pip_config.get_install_locked_command(
+                        self.pip_path))
+        if self.r_path.exists():
+            self._install_locked_r_packages()
+
+    def _install_locked_r_packages(self):
+        conda_config = self.build.conda_config
+        profile = self.build.profile
+        conda_config.set_r_lib_path()
+        r_config = self.build.r_config
+        info = self.load_r_packages()
+        locked = info["packages"]
+        cran = [spec_name(s) for s in r_config.cran_dependents]
+        bioc = [spec_name(s) for s in r_config.bioconductor_dependents]
+        github = r_config.github_dependents
+        if len(cran) > 0:
+            with profile.phase("R cran"):
+                conda_config.run_under_env(
+                    r_config.get_cran_locked_command({
+                        n: locked[n]["version"]
+                        for n in cran if n in locked
+                    }))
+        if len(bioc) > 0:
+            with profile.phase("R bioconductor"):
+                conda_config.run_under_env(
+                    r_config.get_bioconductor_command(
+                        bioc, bioc_version=info["bioc-version"]))
+        if len(github) > 0:
+            refs = []
+            for spec in github:
+                name = github_spec_name(spec)
+                sha = locked.get(name, {}).get("sha")
+                repo = spec.split("@")[0]
+                refs.append(f"{repo}@{sha}" if sha else spec)
+            with profile.phase("R github"):
+                conda_config.run_under_env(
+                    r_config.get_devtools_command(refs))
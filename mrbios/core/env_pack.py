@@ -0,0 +1,263 @@
+import subprocess as subp
+from pathlib import Path
+import tarfile
+import json
+import io
+import os
+import re
+import shutil
+import typing as T
+
+from ..utils.log import console
+from ..utils.misc import command_exist
+from .env_registry import (
+    invalidate_registries, is_named_prefix, ENVIRONMENTS_TXT_PATH,
+)
+
+
+PACK_META_NAME = ".mrbios-pack.json"
+
+
+def _compressor_cmd(archive: Path) -> list[str] | None:
+    """Multi-threaded compressor which reads the tar stream from stdin,
+    return None if no such compressor available."""
+    if archive.name.endswith(".tar.zst"):
+        if not command_exist("zstd"):
+            raise SystemError("zstd is required to pack .tar.zst archive.")
+        return ["zstd", "-T0", "-q", "-c"]
+    if command_exist("pigz"):
+        return ["pigz", "-c"]
+    return None
+
+
+def _decompressor_cmd(archive: Path) -> list[str] | None:
+    if archive.name.endswith(".tar.zst"):
+        if not command_exist("zstd"):
+            raise SystemError("zstd is required to unpack .tar.zst archive.")
+        return ["zstd", "-d", "-q", "-c", str(archive)]
+    if command_exist("pigz"):
+        return ["pigz", "-d", "-c", str(archive)]
+    return None
+
+
+def _prefix_files(prefix: Path) -> dict[str, str]:
+    """Files which contain the env prefix, from conda's package records.
+
+    :return: Mapping from relative path to the file mode (text/binary).
+    """
+    files = {}
+    for record in (prefix / "conda-meta").glob("*.json"):
+        files[str(record.relative_to(prefix))] = "text"
+        with open(record) as f:
+            info = json.load(f)
+        for p in info.get("paths_data", {}).get("paths", []):
+            if p.get("prefix_placeholder"):
+                files[p["_path"]] = p.get("file_mode", "text")
+    return files
+
+
+def _has_prefix_shebang(path: Path, prefix: bytes) -> bool:
+    """Check if the script has a shebang line point to the prefix,
+    e.g. the scripts installed by pip."""
+    if path.is_symlink() or not path.is_file():
+        return False
+    with open(path, 'rb') as f:
+        head = f.read(len(prefix) + 128)
+    return head.startswith(b"#!") and (prefix in head.split(b"\n")[0])
+
+
+def pack_env(prefix: Path, env_name: str, archive: Path):
+    """Write a built env to a compressed relocatable tarball.
+
+    The tar stream is written to the compressor directly, so the env
+    is never hold in memory. Files containing the prefix are recorded
+    in the archive, they will be rewritten when unpacking.
+    """
+    prefix = Path(prefix).absolute()
+    prefix_files = _prefix_files(prefix)
+    bin_prefix = str(prefix).encode()
+    console.log(
+        f"Pack env [note]{env_name}[/note] at [path]{prefix}[/path] "
+        f"to [path]{archive}[/path]")
+    compress_cmd = _compressor_cmd(archive)
+    with open(archive, 'wb') as out:
+        proc = None
+        if compress_cmd is not None:
+            proc = subp.Popen(compress_cmd, stdin=subp.PIPE, stdout=out)
+            tar = tarfile.open(fileobj=proc.stdin, mode="w|")
+        else:
+            tar = tarfile.open(fileobj=out, mode="w|gz")
+        try:
+            for root, dirs, files in os.walk(prefix):
+                root_path = Path(root)
+                for name in dirs + files:
+                    path = root_path / name
+                    rel = str(path.relative_to(prefix))
+                    tar.add(path, arcname=rel, recursive=False)
+                    if root_path.name == "bin" and rel not in prefix_files \
+                            and _has_prefix_shebang(path, bin_prefix):
+                        prefix_files[rel] = "text"
+            meta = json.dumps({
+                "env-name": env_name,
+                "prefix": str(prefix),
+                "prefix-files": prefix_files,
+            }).encode()
+            info = tarfile.TarInfo(PACK_META_NAME)
+            info.size = len(meta)
+            tar.addfile(info, io.BytesIO(meta))
+        finally:
+            tar.close()
+            if proc is not None:
+                T.cast(T.IO, proc.stdin).close()
+                if proc.wait() != 0:  # pragma: no cover
+                    raise subp.CalledProcessError(
+                        proc.returncode, proc.args)
+
+
+def _replace_binary_prefix(
+        data: bytes, old: bytes, new: bytes) -> bytes:
+    """Replace the prefix in null-terminated C strings,
+    pad with nulls to keep the length."""
+    if len(new) > len(old):
+        raise ValueError(
+            f"New prefix {new!r} is longer than the old one {old!r}, "
+            "can't relocate binary files.")
+    pattern = re.compile(re.escape(old) + b"([^\0]*?)\0")
+    padding = b"\0" * (len(old) - len(new))
+
+    def replace(m: re.Match) -> bytes:
+        return new + m.group(1) + padding + b"\0"
+    return pattern.sub(replace, data)
+
+
+def check_relocatable(
+        old_prefix: str, new_prefix: str, prefix_files: dict[str, str]):
+    """Check the binary files can be relocated to the new prefix.
+
+    :raises ValueError: When the new prefix is longer than the old one
+    and there are binary files with the prefix.
+    """
+    if (len(new_prefix.encode()) > len(old_prefix.encode())) and \
+            ("binary" in prefix_files.values()):
+        raise ValueError(
+            f"New prefix {new_prefix} is longer than the old one "
+            f"{old_prefix}, can't relocate binary files.")
+
+
+def relocate_prefix(
+        root: Path, old_prefix: str, prefix_files: dict[str, str],
+        new_prefix: str | None = None):
+    """Rewrite the old prefix in the files under the root
+    to the new one, default is the root."""
+    old = old_prefix.encode()
+    new = str(root if new_prefix is None else new_prefix).encode()
+    if old == new:
+        return
+    for rel, mode in prefix_files.items():
+        path = root / rel
+        if path.is_symlink() or not path.is_file():
+            continue
+        with open(path, 'rb') as f:
+            data = f.read()
+        if old not in data:
+            continue
+        if mode == "binary":
+            data = _replace_binary_prefix(data, old, new)
+        else:
+            data = data.replace(old, new)
+        st_mode = path.stat().st_mode
+        with open(path, 'wb') as f:
+            f.write(data)
+        os.chmod(path, st_mode)
+
+
+def register_env(prefix: Path):
+    """Register the prefix to conda, so it can be found by name."""
+    txt = ENVIRONMENTS_TXT_PATH
+    txt.parent.mkdir(parents=True, exist_ok=True)
+    registered = txt.read_text().splitlines() if txt.exists() else []
+    if str(prefix) not in registered:
+        with open(txt, 'a') as f:
+            f.write(f"{prefix}\n")
+    invalidate_registries()
+
+
+def default_envs_dir() -> Path:
+    if command_exist("conda"):
+        out = subp.check_output(["conda", "info", "--base"]).decode()
+        return Path(out.strip()) / "envs"
+    # micromamba only
+    root = os.environ.get("MAMBA_ROOT_PREFIX", "~/micromamba")
+    return Path(root).expanduser() / "envs"
+
+
+def envs_dirs() -> list[Path]:
+    """Dirs where conda finds the envs by name."""
+    if command_exist("conda"):
+        out = subp.check_output(["conda", "info", "--json"])
+        return [Path(p) for p in json.loads(out).get("envs_dirs", [])]
+    return [default_envs_dir()]
+
+
+def unpack_env(archive: Path, dest: Path | None = None) -> Path:
+    """Restore an env from an archive created by `pack_env`.
+
+    :param dest: Target prefix, default is `<conda base>/envs/<env name>`.
+    It should be under an envs dir, the envs are found by name.
+    The env name is read from the archive.
+    :return: The prefix of the restored env.
+    :raises ValueError: When the env can't be found by name at `dest`.
+    """
+    archive = Path(archive)
+    if dest is not None:
+        dest = dest.absolute()
+        if not is_named_prefix(dest, envs_dirs()):
+            raise ValueError(
+                f"Target prefix {dest} is not under an envs dir, "
+                "conda can't find the env by name there.")
+    decompress_cmd = _decompressor_cmd(archive)
+    envs_dir = default_envs_dir() if dest is None else dest.parent
+    tmp_dest = envs_dir / f".mrbios-unpacking-{os.getpid()}"
+    tmp_dest.mkdir(parents=True)
+    console.log(
+        f"Unpack [path]{archive}[/path] to [path]{envs_dir}[/path]")
+    try:
+        proc = None
+        if decompress_cmd is not None:
+            proc = subp.Popen(decompress_cmd, stdout=subp.PIPE)
+            tar = tarfile.open(fileobj=proc.stdout, mode="r|")
+        else:
+            tar = tarfile.open(archive, mode="r|gz")
+        with tar:
+            if hasattr(tarfile, "tar_filter"):
+                tar.extractall(tmp_dest, filter="tar")
+            else:  # pragma: no cover
+                tar.extractall(tmp_dest)
+        if proc is not None and proc.wait() != 0:  # pragma: no cover
+            raise subp.CalledProcessError(proc.returncode, proc.args)
+        meta_path = tmp_dest / PACK_META_NAME
+        with open(meta_path) as f:
+            meta = json.load(f)
+        meta_path.unlink()
+        if dest is None:
+            dest = envs_dir / meta["env-name"]
+        elif dest.name != meta["env-name"]:
+            console.log(
+                f"The env [note]{meta['env-name']}[/note] is restored "
+                f"with the name [note]{dest.name}[/note].")
+        dest = dest.absolute()
+        if dest.exists():
+            raise IOError(f"Target prefix {dest} already exists.")
+        # relocate before the rename, never leave a broken env at dest
+        check_relocatable(meta["prefix"], str(dest), meta["prefix-files"])
+        relocate_prefix(
+            tmp_dest, meta["prefix"], meta["prefix-files"], str(dest))
+        tmp_dest.rename(dest)
+    finally:
+        if tmp_dest.exists():
+            shutil.rmtree(tmp_dest)
+    register_env(dest)
+    console.log(
+        f"Env [note]{meta['env-name']}[/note] restored "
+        f"at [path]{dest}[/path]")
+    return dest
@@ -0,0 +1,138 @@
+import subprocess as subp
+from pathlib import Path
+import json
+
+from ..utils.user_setting import DEFAULT_SETTING_PATH
+from ..utils.misc import dump_json_atomic
+
+
+ENVIRONMENTS_TXT_PATH = Path.home() / ".conda" / "environments.txt"
+DEFAULT_REGISTRY_CACHE_PATH = DEFAULT_SETTING_PATH.parent / "env_registry.json"
+
+
+def is_named_prefix(prefix: Path, envs_dirs: list[Path]) -> bool:
+    """Check if conda finds the env at the prefix by its dir name,
+    it should be under an envs dir."""
+    return (prefix.parent in envs_dirs) or (prefix.parent.name == "envs")
+
+
+def _mtime(path: Path) -> float | None:
+    try:
+        return path.stat().st_mtime
+    except OSError:
+        return None
+
+
+class EnvRegistry():
+    """Registry of the built conda envs.
+
+    Read `conda env list --json` once and answer the queries about
+    env existence and prefix from memory. The result is cached on disk,
+    keyed on the mtimes of conda's `environments.txt` and
+    every prefix's `conda-meta/history`, so it's only refreshed when
+    an env is created, removed or modified.
+    """
+    def __init__(
+            self,
+            cache_path: Path = DEFAULT_REGISTRY_CACHE_PATH,
+            environments_txt: Path = ENVIRONMENTS_TXT_PATH,
+            list_cmd: list[str] | None = None):
+        self.cache_path = cache_path
+        self.environments_txt = environments_txt
+        self.list_cmd = list_cmd or ["conda", "env", "list", "--json"]
+        self._info: dict | None = None
+
+    def _fingerprint(self, envs: dict[str, str]) -> dict[str, float | None]:
+        fp = {
+            str(self.environments_txt): _mtime(self.environments_txt),
+        }
+        for prefix in envs.values():
+            history = Path(prefix) / "conda-meta" / "history"
+            fp[str(history)] = _mtime(history)
+        return fp
+
+    def _is_fresh(self, info: dict) -> bool:
+        return info["fingerprint"] == self._fingerprint(info["envs"])
+
+    def _load_cache(self) -> dict | None:
+        if not self.cache_path.exists():
+            return None
+        try:
+            with open(self.cache_path) as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):  # pragma: no cover
+            return None
+
+    def list_conda_envs(self) -> dict[str, str]:
+        """Get the name to prefix mapping of all conda envs."""
+        out = subp.check_output(self.list_cmd)
+        info = json.loads(out)
+        root_prefix = info.get("root_prefix")
+        envs_dirs = [Path(p) for p in info.get("envs_dirs", [])]
+        envs = {}
+        for prefix in info["envs"]:
+            p = Path(prefix)
+            if prefix == root_prefix:
+                envs["base"] = prefix
+            elif is_named_prefix(p, envs_dirs):
+                envs.setdefault(p.name, prefix)
+        return envs
+
+    def refresh(self) -> dict[str, str]:
+        """Reload the env list from conda."""
+        envs = self.list_conda_envs()
+        self._info = {
+            "envs": envs,
+            "fingerprint": self._fingerprint(envs),
+        }
+        dump_json_atomic(self._info, self.cache_path)
+        return envs
+
+    @property
+    def envs(self) -> dict[str, str]:
+        """Name to prefix mapping of all built envs."""
+        for info in (self._info, self._load_cache()):
+            if (info is not None) and self._is_fresh(info):
+                self._info = info
+                return info["envs"]
+        return self.refresh()
+
+    def invalidate(self):
+        """Drop the cached env list."""
+        self._info = None
+        self.cache_path.unlink(missing_ok=True)
+
+    def get_prefix(self, env_name: str) -> Path | None:
+        prefix = self.envs.get(env_name)
+        if prefix is None:
+            return None
+        return Path(prefix)
+
+    def is_built(self, env_name: str) -> bool:
+        prefix = self.get_prefix(env_name)
+        if prefix is None:
+            return False
+        return (prefix / "conda-meta").exists()
+
+
+_registries: dict[str, EnvRegistry] = {}
+
+
+def get_env_registry(manager: str = "conda") -> EnvRegistry:
+    """Get the registry of the envs managed by conda or micromamba."""
+    if manager not in _registries:
+        cache_path = DEFAULT_REGISTRY_CACHE_PATH
+        if manager != "conda":
+            cache_path = cache_path.with_name(f"env_registry-{manager}.json")
+        _registries[manager] = EnvRegistry(
+            cache_path, list_cmd=[manager, "env", "list", "--json"])
+    return _registries[manager]
+
+
+def invalidate_registries():
+    """Drop the cached env lists of all managers."""
+    for registry in _registries.values():
+        registry.invalidate()
+
+
+env_registry = get_env_registry("conda")
@@ -0,0 +1,100 @@
+import subprocess as subp
+from pathlib import Path
+import json
+import os
+import typing as T
+
+from ..utils.log import console
+from ..utils.misc import dump_json_atomic
+
+if T.TYPE_CHECKING:
+    from .env_build import CondaConfig
+
+
+class EnvSnapshot():
+    """Cached environment variables produced by activating a conda env.
+
+    The snapshot stores the difference between the caller's environ and
+    the environ inside the activated env (PATH, CONDA_PREFIX, R_HOME,
+    variables set by activate.d hooks ...). Commands can then be executed
+    directly with the activated environ, without launching `conda run`.
+
+    The snapshot is invalidated when the env prefix's `conda-meta`
+    directory changes or when the env is rebuilt.
+    """
+    def __init__(self, path: Path, conda_config: "CondaConfig"):
+        self.path = path
+        self.conda_config = conda_config
+
+    @property
+    def is_exist(self) -> bool:
+        return self.path.exists()
+
+    def load(self) -> dict:
+        with open(self.path) as f:
+            return json.load(f)
+
+    @staticmethod
+    def _meta_mtime(prefix: str | Path) -> float | None:
+        meta_path = Path(prefix) / "conda-meta"
+        if not meta_path.exists():
+            return None
+        return meta_path.stat().st_mtime
+
+    @property
+    def is_valid(self) -> bool:
+        """Check if the snapshot is up to date with the env prefix."""
+        if not self.is_exist:
+            return False
+        try:
+            info = self.load()
+        except (OSError, json.JSONDecodeError):
+            return False
+        if info.get("env-name") != self.conda_config.env_name:
+            return False
+        mtime = self._meta_mtime(info["prefix"])
+        return (mtime is not None) and (mtime == info["conda-meta-mtime"])
+
+    def capture(self) -> dict:
+        """Capture the activated environ by running `env` under the env."""
+        console.log(
+            "Capture activated environ of "
+            f"[note]{self.conda_config.env_name}[/note]")
+        base = os.environ.copy()
+        cmd = self.conda_config._get_conda_run_cmd(["env", "-0"])
+        out = subp.check_output(cmd, env=base).decode()
+        activated = {}
+        for item in out.split("\0"):
+            if "=" not in item:
+                continue
+            key, value = item.split("=", 1)
+            activated[key.strip("\n")] = value
+        prefix = activated.get("CONDA_PREFIX")
+        if prefix is None:  # pragma: no cover
+            raise ValueError(
+                "Cannot find CONDA_PREFIX in the activated environ.")
+        info = {
+            "env-name": self.conda_config.env_name,
+            "prefix": prefix,
+            "conda-meta-mtime": self._meta_mtime(prefix),
+            "set": {
+                k: v for k, v in activated.items()
+                if base.get(k) != v
+            },
+            "unset": [k for k in base if k not in activated],
+        }
+        dump_json_atomic(info, self.path)
+        return info
+
+    def invalidate(self):
+        """Remove the cached snapshot."""
+        self.path.unlink(missing_ok=True)
+
+    def get_environ(self) -> dict[str, str]:
+        """Get the activated environ, capture it if the cache is stale."""
+        info = self.load() if self.is_valid else self.capture()
+        environ = os.environ.copy()
+        for key in info["unset"]:
+            environ.pop(key, None)
+        environ.update(info["set"])
+        return environ
@@ -0,0 +1,129 @@
+import re
+import typing as T
+
+
+# Changing these packages means the whole env need to be rebuilt.
+BASE_INTERPRETERS = ("python", "r-base")
+
+_NAME_PATTERN = re.compile(r"^\s*(?:[\w\-.]+::)?([A-Za-z0-9_.\-]+)")
+# user/repo[/subdir][@ref|#pull|@*release] of remotes::install_github
+_GITHUB_PATTERN = re.compile(
+    r"^\s*[\w\-.]+/([\w\-.]+)((?:/[\w\-.]+)*)(?:[@#].*)?$")
+
+
+def spec_name(spec: str) -> str:
+    """Get the package name from a conda/pip/R dependency spec.
+
+    >>> spec_name("python==3.10")
+    'python'
+    >>> spec_name("conda-forge::numpy>=1.20")
+    'numpy'
+    """
+    m = _NAME_PATTERN.match(spec)
+    if m is None:  # pragma: no cover
+        return spec
+    return m.group(1)
+
+
+def github_spec_name(spec: str) -> str:
+    """Get the package name from a GitHub dependency spec.
+
+    >>> github_spec_name("hadley/devtools@v2.4.5")
+    'devtools'
+    >>> github_spec_name("user/repo/pkg/subdir#12")
+    'subdir'
+
+    :raises ValueError: When the spec is not like 'user/repo'.
+    """
+    m = _GITHUB_PATTERN.match(spec)
+    if m is None:
+        raise ValueError(
+            f"Invalid GitHub dependency spec: {spec!r}, "
+            "should be like 'user/repo[/subdir][@ref]'.")
+    # the package in a subdir is named after the subdir
+    subdir = m.group(2)
+    return subdir.rsplit("/", 1)[-1] if subdir else m.group(1)
+
+
+class DepsDiff(T.NamedTuple):
+    """Difference between two lists of dependency specs."""
+    added: list[str]
+    removed: list[str]
+
+    @property
+    def is_empty(self) -> bool:
+        return len(self.added) == 0 and len(self.removed) == 0
+
+    @staticmethod
+    def from_specs(
+            old: list[str], new: list[str],
+            name_func: T.Callable[[str], str] = spec_name,
+            ) -> "DepsDiff":
+        """Changed specs are treated as added, so they will be
+        reinstalled with the new spec."""
+        old_map = {name_func(s): s for s in old}
+        new_map = {name_func(s): s for s in new}
+        added = [
+            spec for name, spec in new_map.items()
+            if old_map.get(name) != spec
+        ]
+        removed = [
+            old_map[name] for name in old_map
+            if name not in new_map
+        ]
+        return DepsDiff(added, removed)
+
+
+class BuildDiff():
+    """Difference between the recorded build spec and the new build config.
+
+    :param old: The config recorded at the last build.
+    :param new: The current config in build.yaml.
+    """
+    def __init__(self, old: dict, new: dict):
+        self.old = old
+        self.new = new
+        old_conda, new_conda = old.get("conda", {}), new.get("conda", {})
+        self.channels_changed = (
+            old_conda.get("channels", []) != new_conda.get("channels", []))
+        self.conda = DepsDiff.from_specs(
+            old_conda.get("deps", []), new_conda.get("deps", []))
+        self.pip = DepsDiff.from_specs(
+            old.get("pip", {}).get("deps", []),
+            new.get("pip", {}).get("deps", []))
+        old_r, new_r = old.get("R", {}), new.get("R", {})
+        self.r: dict[str, DepsDiff] = {
+            source: DepsDiff.from_specs(
+                old_r.get(source, {}).get("deps", []),
+                new_r.get(source, {}).get("deps", []),
+                github_spec_name if source == "github" else spec_name)
+            for source in ("cran", "bioconductor", "github")
+        }
+
+    @property
+    def base_changed(self) -> bool:
+        """Check if the base interpreter (python, R) has changed."""
+        changed = self.conda.added + self.conda.removed
+        return any(spec_name(s) in BASE_INTERPRETERS for s in changed)
+
+    @property
+    def need_rebuild(self) -> bool:
+        return self.channels_changed or self.base_changed
+
+    @property
+    def is_empty(self) -> bool:
+        return self.conda.is_empty and self.pip.is_empty and \
+            all(d.is_empty for d in self.r.values())
+
+    def __repr__(self):
+        lines = []
+        parts = [("conda", self.conda), ("pip", self.pip)] + \
+            [(f"R/{k}", v) for k, v in self.r.items()]
+        for name, d in parts:
+            if len(d.added) > 0:
+                lines.append(f"{name} add: {' '.join(d.added)}")
+            if len(d.removed) > 0:
+                lines.append(f"{name} remove: {' '.join(d.removed)}")
+        if self.channels_changed:
+            lines.append("channels changed")
+        return "\n".join(lines)
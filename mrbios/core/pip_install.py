@@ -0,0 +1,84 @@
+import re
+from pathlib import Path
+
+try:
+    from packaging.requirements import Requirement, InvalidRequirement
+except ImportError:  # pragma: no cover
+    Requirement = None  # type: ignore
+
+
+_NAME_PATTERN = re.compile(r"^\s*([A-Za-z0-9][A-Za-z0-9._\-]*)\s*(.*)$")
+
+
+def normalize_name(name: str) -> str:
+    """Normalize the distribution name, see PEP 503."""
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def _read_metadata(dist_info: Path) -> tuple[str, str] | None:
+    metadata = dist_info / "METADATA"
+    if not metadata.exists():
+        metadata = dist_info / "PKG-INFO"
+    if not metadata.exists():
+        return None
+    name = version = None
+    with open(metadata, errors="replace") as f:
+        for line in f:
+            if line.startswith("Name:"):
+                name = line[5:].strip()
+            elif line.startswith("Version:"):
+                version = line[8:].strip()
+            elif line.strip() == "":
+                break
+    if (name is None) or (version is None):
+        return None
+    return name, version
+
+
+def installed_distributions(prefix: Path) -> dict[str, str]:
+    """Read the installed python distributions of an env directly
+    from the metadata in its site-packages, without starting python.
+
+    :return: Mapping from normalized name to version.
+    """
+    dists = {}
+    patterns = [
+        "lib/python*/site-packages/*.dist-info",
+        "lib/python*/site-packages/*.egg-info",
+        "Lib/site-packages/*.dist-info",
+        "Lib/site-packages/*.egg-info",
+    ]
+    for pattern in patterns:
+        for dist_info in prefix.glob(pattern):
+            info = _read_metadata(dist_info)
+            if info is not None:
+                dists[normalize_name(info[0])] = info[1]
+    return dists
+
+
+def is_satisfied(spec: str, dists: dict[str, str]) -> bool:
+    """Check if a requirement spec is satisfied by the installed
+    distributions. Specs can't be checked (URLs, VCS ...) are treated
+    as unsatisfied."""
+    if Requirement is not None:
+        try:
+            req = Requirement(spec)
+        except InvalidRequirement:
+            return False
+        if req.url is not None:
+            return False
+        version = dists.get(normalize_name(req.name))
+        if version is None:
+            return False
+        return req.specifier.contains(version, prereleases=True)
+    else:  # pragma: no cover
+        m = _NAME_PATTERN.match(spec)
+        if m is None:
+            return False
+        version = dists.get(normalize_name(m.group(1)))
+        rest = m.group(2).strip()
+        if (version is None) or ("@" in rest):
+            return False
+        if rest == "":
+            return True
+        return rest.startswith("==") and rest[2:].strip() == version
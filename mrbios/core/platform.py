@@ -19,9 +19,11 @@ class Platform():
         for task in self.project.get_tasks().values():
             for script in task.scripts:
                 script_runner = script.runner
+                # warm workers live in the server process
+                persistent = script_runner.config.get("worker") == "persistent"
                 launcher = AsyncLauncher(
                     script_runner.get_run_func(),
-                    job_type='process',
+                    job_type='thread' if persistent else 'process',
                     name=script.name,
                     tags=[task.name]
                 )
@@ -0,0 +1,83 @@
+from pathlib import Path
+import shutil
+import os
+
+from ..utils.log import console
+from ..utils.user_setting import DEFAULT_SETTING_PATH
+
+
+DEFAULT_R_CACHE_PATH = DEFAULT_SETTING_PATH.parent / "R-packages"
+DEFAULT_R_CACHE_MAX_SIZE_GB = 20.0
+
+
+def dir_size(path: Path) -> int:
+    """Total size of the files under the directory, in bytes."""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            p = os.path.join(root, name)
+            if not os.path.islink(p):
+                total += os.path.getsize(p)
+    return total
+
+
+class RPackageCache():
+    """Cache of the built R packages, shared by all envs.
+
+    Layout: `<path>/R-<R version>-<platform>/<package>_<version>/<package>`,
+    the R install program restores packages from it and saves the newly
+    built ones to it. The mtime of an entry is updated when it's reused,
+    so `evict` removes the least recently used entries first.
+
+    :param path: Root of the cache.
+    :param max_size_gb: Size cap of the cache.
+    """
+    def __init__(
+            self, path: Path = DEFAULT_R_CACHE_PATH,
+            max_size_gb: float = DEFAULT_R_CACHE_MAX_SIZE_GB):
+        self.path = Path(path)
+        self.max_size_gb = max_size_gb
+
+    @staticmethod
+    def from_config(config: dict | bool | None) -> "RPackageCache | None":
+        """Create from the `binary_cache` option of the R config:
+        `true` or `{path: ..., max_size_gb: ...}`."""
+        if not config:
+            return None
+        if config is True:
+            return RPackageCache()
+        return RPackageCache(
+            Path(config.get("path", DEFAULT_R_CACHE_PATH)).expanduser(),
+            config.get("max_size_gb", DEFAULT_R_CACHE_MAX_SIZE_GB),
+        )
+
+    def entries(self) -> list[Path]:
+        if not self.path.exists():
+            return []
+        return [
+            e for key_dir in self.path.iterdir() if key_dir.is_dir()
+            for e in key_dir.iterdir()
+            if e.is_dir() and ".tmp" not in e.name
+        ]
+
+    def evict(self) -> list[Path]:
+        """Remove the least recently used entries until
+        the cache size is under the cap.
+
+        :return: The removed entries.
+        """
+        max_size = self.max_size_gb * 1024**3
+        sizes = {e: dir_size(e) for e in self.entries()}
+        total = sum(sizes.values())
+        removed = []
+        for entry in sorted(sizes, key=lambda e: e.stat().st_mtime):
+            if total <= max_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= sizes[entry]
+            removed.append(entry)
+        if len(removed) > 0:
+            console.log(
+                f"Evict {len(removed)} packages from the R binary cache "
+                f"[path]{self.path}[/path]")
+        return removed
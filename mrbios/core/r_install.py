@@ -0,0 +1,233 @@
+import re
+import typing as T
+from pathlib import Path
+
+from .env_update import github_spec_name
+
+
+# Helpers of the generated R install program.
+# Command line arguments: path of the result file,
+# path of the binary package cache (optional).
+R_INSTALL_PRELUDE = r"""
+.mrbios_results <- commandArgs(TRUE)[1]
+.mrbios_cache <- commandArgs(TRUE)[2]
+.mrbios_use_cache <- !is.na(.mrbios_cache)
+.mrbios_lib <- .libPaths()[1]
+.mrbios_ncpus <- max(1L, parallel::detectCores(), na.rm = TRUE)
+options(Ncpus = .mrbios_ncpus)
+Sys.setenv(MAKEFLAGS = paste0("-j", .mrbios_ncpus))
+.mrbios_installed <- installed.packages()[, "Version"]
+
+.mrbios_record <- function(pkg, source, status, seconds, msg) {
+  msg <- gsub("[\t\r\n]+", " ", msg)
+  line <- paste(pkg, source, status, sprintf("%.2f", seconds), msg, sep = "\t")
+  cat(line, "\n", sep = "", file = .mrbios_results, append = TRUE)
+}
+
+.mrbios_satisfied <- function(pkg, op, ver) {
+  if (!(pkg %in% names(.mrbios_installed))) return(FALSE)
+  if (is.na(op)) return(TRUE)
+  cur <- package_version(.mrbios_installed[[pkg]])
+  do.call(op, list(cur, package_version(ver)))
+}
+
+.mrbios_require <- function(pkg, repos) {
+  if (!requireNamespace(pkg, quietly = TRUE)) {
+    install.packages(pkg, repos = repos)
+  }
+}
+
+.mrbios_cache_dir <- if (.mrbios_use_cache) {
+  file.path(
+    .mrbios_cache,
+    paste0("R-", getRversion(), "-", R.version[["platform"]]))
+} else NA
+.mrbios_dbs <- list()
+
+.mrbios_available <- function(source, repos) {
+  if (is.null(.mrbios_dbs[[source]])) {
+    if (source == "bioconductor") {
+      .mrbios_require("BiocManager", repos)
+      repos <- BiocManager::repositories()
+    }
+    .mrbios_dbs[[source]] <<- available.packages(repos = repos)
+  }
+  .mrbios_dbs[[source]]
+}
+
+# Restore the package and its missing dependencies from the cache,
+# only when all of them are cached and the package can be loaded.
+.mrbios_restore <- function(pkg, source, op, ver, repos) {
+  db <- tryCatch(.mrbios_available(source, repos), error = function(e) NULL)
+  if (is.null(db) || !(pkg %in% rownames(db))) return(FALSE)
+  deps <- tools::package_dependencies(
+    pkg, db = db, recursive = TRUE,
+    which = c("Depends", "Imports", "LinkingTo"))[[pkg]]
+  base <- rownames(installed.packages(priority = "base"))
+  missing <- setdiff(c(pkg, deps), c(names(.mrbios_installed), base))
+  # dependencies from other repositories can't be resolved here
+  if (!all(missing %in% rownames(db))) return(FALSE)
+  entries <- file.path(
+    .mrbios_cache_dir, paste0(missing, "_", db[missing, "Version"]))
+  if (!all(dir.exists(file.path(entries, missing)))) return(FALSE)
+  copied <- file.copy(
+    file.path(entries, missing), .mrbios_lib, recursive = TRUE)
+  Sys.setFileTime(entries, Sys.time())
+  .mrbios_installed <<- installed.packages()[, "Version"]
+  if (all(copied) && .mrbios_satisfied(pkg, op, ver) &&
+      requireNamespace(pkg, quietly = TRUE)) {
+    return(TRUE)
+  }
+  # fall back to the normal install
+  unlink(file.path(.mrbios_lib, missing), recursive = TRUE)
+  .mrbios_installed <<- installed.packages()[, "Version"]
+  FALSE
+}
+
+# Save the newly built packages to the cache.
+.mrbios_save <- function(before) {
+  now <- paste(names(.mrbios_installed), .mrbios_installed)
+  for (p in names(.mrbios_installed)[!(now %in% before)]) {
+    path <- find.package(p, quiet = TRUE)
+    entry <- file.path(
+      .mrbios_cache_dir, paste0(p, "_", .mrbios_installed[[p]]))
+    if ((length(path) == 0) || dir.exists(entry)) next
+    tmp <- paste0(entry, ".tmp", Sys.getpid())
+    dir.create(tmp, recursive = TRUE, showWarnings = FALSE)
+    if (all(file.copy(path[1], tmp, recursive = TRUE))) {
+      file.rename(tmp, entry)
+    } else {
+      unlink(tmp, recursive = TRUE)
+    }
+  }
+}
+
+# Install the unsatisfied packages of a source in one call, so they are
+# built in parallel with Ncpus, and record the result per package.
+.mrbios_install <- function(source, pkgs, targets, ops, vers, repos) {
+  use_cache <- .mrbios_use_cache && (source != "github")
+  todo <- logical(length(pkgs))
+  for (i in seq_along(pkgs)) {
+    t0 <- proc.time()[["elapsed"]]
+    if (.mrbios_satisfied(pkgs[i], ops[i], vers[i])) {
+      .mrbios_record(pkgs[i], source, "skipped", 0, "")
+    } else if (use_cache &&
+               .mrbios_restore(pkgs[i], source, ops[i], vers[i], repos)) {
+      .mrbios_record(
+        pkgs[i], source, "cached", proc.time()[["elapsed"]] - t0, "")
+    } else {
+      todo[i] <- TRUE
+    }
+  }
+  if (!any(todo)) return(invisible(NULL))
+  t0 <- proc.time()[["elapsed"]]
+  before <- paste(names(.mrbios_installed), .mrbios_installed)
+  warns <- character(0)
+  msg <- tryCatch({
+    withCallingHandlers({
+      if (source == "cran") {
+        install.packages(targets[todo], repos = repos)
+      } else if (source == "bioconductor") {
+        .mrbios_require("BiocManager", repos)
+        BiocManager::install(targets[todo], update = FALSE, ask = FALSE)
+      } else {
+        .mrbios_require("remotes", repos)
+        remotes::install_github(targets[todo], upgrade = "never")
+      }
+      ""
+    }, warning = function(w) {
+      # install.packages only warns when an installation failed,
+      # the other packages of the call go on
+      if (grepl("non-zero exit status|not available", conditionMessage(w))) {
+        warns <<- c(warns, conditionMessage(w))
+      }
+      invokeRestart("muffleWarning")
+    })
+  }, error = function(e) conditionMessage(e))
+  # the packages are built together, share the time between them
+  seconds <- (proc.time()[["elapsed"]] - t0) / sum(todo)
+  .mrbios_installed <<- installed.packages()[, "Version"]
+  if (use_cache) .mrbios_save(before)
+  for (i in which(todo)) {
+    if (.mrbios_satisfied(pkgs[i], ops[i], vers[i])) {
+      .mrbios_record(pkgs[i], source, "installed", seconds, "")
+      next
+    }
+    m <- c(warns[grepl(pkgs[i], warns, fixed = TRUE)], msg[msg != ""])
+    if (length(m) == 0) m <- "package not installed"
+    .mrbios_record(
+      pkgs[i], source, "failed", seconds, paste(m, collapse = "; "))
+  }
+}
+"""
+
+_R_SPEC_PATTERN = re.compile(
+    r"^\s*([A-Za-z0-9.]+)\s*(?:\(?\s*(>=|<=|==|>|<)\s*([0-9.\-]+)\s*\)?)?\s*$")
+
+
+def parse_r_spec(spec: str) -> tuple[str, str | None, str | None]:
+    """Parse R dependency spec like 'DESeq2', 'Seurat>=4.0' or
+    'Seurat (>= 4.0)' to (name, operator, version)."""
+    m = _R_SPEC_PATTERN.match(spec)
+    if m is None:
+        return spec, None, None
+    return m.group(1), m.group(2), m.group(3)
+
+
+def _r_str(value: str | None) -> str:
+    if value is None:
+        return "NA"
+    return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+
+def _r_vec(values: T.Sequence[str | None]) -> str:
+    return "c(" + ", ".join(_r_str(v) for v in values) + ")"
+
+
+def get_install_program(
+        cran: list[str], bioconductor: list[str], github: list[str],
+        cran_mirror: str, bioconductor_mirror: str | None = None) -> str:
+    """Generate an R program which installs all packages in one session,
+    with one install call per source."""
+    lines = [R_INSTALL_PRELUDE]
+    if bioconductor_mirror is not None:  # pragma: no cover
+        lines.append(f"options(BioC_mirror = {_r_str(bioconductor_mirror)})")
+    repos = _r_str(cran_mirror)
+    for source, specs in (("cran", cran), ("bioconductor", bioconductor)):
+        if len(specs) == 0:
+            continue
+        names, ops, vers = zip(*[parse_r_spec(s) for s in specs])
+        lines.append(
+            f".mrbios_install('{source}', {_r_vec(names)}, "
+            f"{_r_vec(names)}, {_r_vec(ops)}, {_r_vec(vers)}, {repos})")
+    if len(github) > 0:
+        na = _r_vec([None] * len(github))
+        lines.append(
+            f".mrbios_install('github', "
+            f"{_r_vec([github_spec_name(s) for s in github])}, "
+            f"{_r_vec(github)}, {na}, {na}, {repos})")
+    return "\n".join(lines) + "\n"
+
+
+class RInstallResult(T.NamedTuple):
+    package: str
+    source: str
+    status: str
+    seconds: float
+    message: str
+
+
+def parse_install_results(path: Path) -> list[RInstallResult]:
+    """Parse the result file written by the R install program."""
+    results: list[RInstallResult] = []
+    if not path.exists():
+        return results
+    with open(path) as f:
+        for line in f:
+            items = line.rstrip("\n").split("\t")
+            if len(items) != 5:  # pragma: no cover
+                continue
+            pkg, source, status, seconds, msg = items
+            results.append(
+                RInstallResult(pkg, source, status, float(seconds), msg))
+    return results
@@ -0,0 +1,263 @@
+from contextlib import contextmanager
+from pathlib import Path
+import threading
+import itertools
+import tempfile
+import socket
+import json
+import time
+import os
+import re
+import typing as T
+
+from ..utils.log import console
+from ..utils.misc import file_lock
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None  # type: ignore
+
+
+# The pool is shared by all mrbios processes on the node,
+# it should be on a local file system.
+DEFAULT_POOL_PATH = Path(os.environ.get(
+    "MRBIOS_RESOURCE_POOL",
+    Path(tempfile.gettempdir()) / "mrbios-resource-pool"))
+# Fraction of the total memory can be reserved by the runs.
+MEMORY_FRACTION = 0.9
+POLL_INTERVAL = 0.5
+# Env variables of the thread numbers of the common libraries.
+THREAD_VARS = [
+    "OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS",
+    # R: parallel::mclapply and data.table
+    "MC_CORES", "R_DATATABLE_NUM_THREADS",
+    "MRBIOS_THREADS",
+]
+
+_SIZE_UNITS = {
+    "": 1024**3, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4,
+}
+_counter = itertools.count()
+
+
+def parse_memory(value: str | float) -> int:
+    """Parse the memory size to bytes, like "512M", "8G",
+    numbers are in GB."""
+    if isinstance(value, (int, float)):
+        return int(value * 1024**3)
+    m = re.fullmatch(r"([\d.]+)\s*([KMGT]?)i?B?", value.strip().upper())
+    if m is None:
+        raise ValueError(f"Invalid memory size: {value}")
+    return int(float(m.group(1)) * _SIZE_UNITS[m.group(2)])
+
+
+def available_cpus() -> list[int]:
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))  # pragma: no cover
+
+
+def total_memory() -> int:
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:  # pragma: no cover
+        pass
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def thread_environ(threads: int) -> dict[str, str]:
+    """Env variables limiting the threads of the common libraries."""
+    return {var: str(threads) for var in THREAD_VARS}
+
+
+class Reservation():
+    """CPUs and memory held by a run until it's released."""
+    def __init__(self, cpus: list[int], memory: int, path: Path, fd: int):
+        self.cpus = cpus
+        self.memory = memory
+        self.path = path
+        self._fd = fd
+
+    @property
+    def environ(self) -> dict[str, str]:
+        """Thread variables of the reserved CPUs,
+        none for a memory only reservation."""
+        if len(self.cpus) == 0:
+            return {}
+        return thread_environ(len(self.cpus))
+
+    def release(self):
+        if self._fd < 0:
+            return
+        self.path.unlink(missing_ok=True)
+        os.close(self._fd)  # release the lock
+        self._fd = -1
+
+
+class ResourcePool():
+    """Node-wide pool of the CPUs and the memory,
+    shared by the mrbios processes through the file locks.
+
+    Each reservation is a file in the pool dir, locked by its holder,
+    the reservations of the crashed processes are unlocked by the OS
+    and ignored. The allocation is serialized by the lock of the pool.
+
+    :param path: Dir of the pool, on a local file system.
+    :param cpus: CPUs can be allocated, default is the CPUs
+    available to the current process.
+    :param memory: Bytes of the memory can be reserved.
+    """
+    def __init__(
+            self, path: Path = DEFAULT_POOL_PATH,
+            cpus: list[int] | None = None,
+            memory: int | None = None):
+        self.path = path
+        self.cpus = available_cpus() if cpus is None else cpus
+        self.memory = int(total_memory() * MEMORY_FRACTION) \
+            if memory is None else memory
+
+    @property
+    def lock_path(self) -> Path:
+        return self.path / "pool.lock"
+
+    def _ensure_dir(self):
+        if not self.path.exists():
+            self.path.mkdir(parents=True, exist_ok=True)
+            # shared by the users of the node
+            try:
+                os.chmod(self.path, 0o1777)
+            except OSError:  # pragma: no cover
+                pass
+        if not self.lock_path.exists():
+            fd = os.open(self.lock_path, os.O_CREAT | os.O_WRONLY, 0o666)
+            try:
+                os.fchmod(fd, 0o666)
+            except OSError:  # pragma: no cover
+                pass
+            os.close(fd)
+
+    def reservations(self) -> list[dict]:
+        """Reservations of the live runs, the stale ones are removed."""
+        live = []
+        for p in self.path.glob("res-*.json"):
+            try:
+                fd = os.open(p, os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                try:
+                    if fcntl is not None:
+                        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    with os.fdopen(os.dup(fd)) as f:
+                        live.append(json.load(f))
+                    continue
+                # not locked, the holder is gone
+                try:
+                    p.unlink()
+                except OSError:  # pragma: no cover
+                    pass
+            except (OSError, ValueError):  # pragma: no cover
+                continue
+            finally:
+                os.close(fd)
+        return live
+
+    def try_acquire(self, threads: int, memory: int = 0) -> Reservation | None:
+        """Reserve the CPUs and memory if they are free."""
+        self._ensure_dir()
+        with file_lock(self.lock_path):
+            live = self.reservations()
+            used_cpus = {c for r in live for c in r["cpus"]}
+            used_memory = sum(r["memory"] for r in live)
+            free = [c for c in self.cpus if c not in used_cpus]
+            if (len(free) < threads) or \
+                    (used_memory + memory > self.memory):
+                return None
+            cpus = free[:threads]
+            path = self.path / (
+                f"res-{os.getpid()}-{threading.get_ident()}-"
+                f"{next(_counter)}.json")
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_RDWR, 0o644)
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            os.write(fd, json.dumps({
+                "cpus": cpus, "memory": memory,
+                "pid": os.getpid(), "host": socket.gethostname(),
+            }).encode())
+        return Reservation(cpus, memory, path, fd)
+
+    @contextmanager
+    def acquire(
+            self, threads: int, memory: int = 0,
+            timeout: float | None = None) -> T.Iterator[Reservation]:
+        """Wait until the CPUs and memory are free and hold them
+        in the block.
+
+        :raises TimeoutError: When they are not free before the timeout.
+        """
+        if threads > len(self.cpus):
+            console.log(
+                f"[error]Requested {threads} threads but only "
+                f"{len(self.cpus)} CPUs available, "
+                f"use {len(self.cpus)}.[/error]")
+            threads = len(self.cpus)
+        if memory > self.memory:
+            raise ValueError(
+                f"Requested {memory / 1024**3:.1f}GB memory but only "
+                f"{self.memory / 1024**3:.1f}GB can be reserved.")
+        start = time.monotonic()
+        logged = False
+        while (res := self.try_acquire(threads, memory)) is None:
+            if (timeout is not None) and \
+                    (time.monotonic() - start > timeout):
+                raise TimeoutError(
+                    f"Timed out waiting for {threads} CPUs.")
+            if not logged:
+                console.log(
+                    f"Waiting for {threads} CPUs and "
+                    f"{memory / 1024**3:.1f}GB memory to be free.")
+                logged = True
+            time.sleep(POLL_INTERVAL)
+        try:
+            yield res
+        finally:
+            res.release()
+
+
+@contextmanager
+def bind_cpus(cpus: list[int] | None):
+    """Bind the current thread to the CPUs in the block,
+    the processes started in it inherit the CPU set."""
+    if (cpus is None) or (not hasattr(os, "sched_setaffinity")):
+        yield
+        return
+    old = os.sched_getaffinity(0)
+    os.sched_setaffinity(0, cpus)
+    try:
+        yield
+    finally:
+        os.sched_setaffinity(0, old)
+
+
+def set_process_affinity(pid: int, cpus: list[int]):
+    """Bind all threads of a running process to the CPUs."""
+    if not hasattr(os, "sched_setaffinity"):  # pragma: no cover
+        return
+    try:
+        tids = [int(t) for t in os.listdir(f"/proc/{pid}/task")]
+    except OSError:  # pragma: no cover
+        tids = [pid]
+    for tid in tids:
+        try:
+            os.sched_setaffinity(tid, cpus)
+        except OSError:  # pragma: no cover
+            pass
+
+
+resource_pool = ResourcePool()
@@ -0,0 +1,325 @@
+from pathlib import Path
+from collections import Counter
+import hashlib
+import json
+import os
+import shutil
+import typing as T
+
+from ..utils.log import console
+from ..utils.misc import dump_json_atomic, file_lock
+from ..utils.user_setting import DEFAULT_SETTING_PATH
+
+
+DEFAULT_RUN_CACHE_PATH = DEFAULT_SETTING_PATH.parent / "run-cache"
+DEFAULT_RUN_CACHE_MAX_SIZE_GB = 50.0
+# Number of the file hashes memoized by (path, size, mtime).
+MAX_HASH_MEMO = 10000
+# ioctl request of the Linux copy-on-write clone
+FICLONE = 0x40049409
+
+
+def _reflink(src: Path, dst: Path) -> bool:
+    try:
+        import fcntl
+    except ImportError:  # pragma: no cover
+        return False
+    with open(src, 'rb') as fs, open(dst, 'wb') as fd:
+        try:
+            fcntl.ioctl(fd.fileno(), FICLONE, fs.fileno())
+        except OSError:
+            return False
+    return True
+
+
+def clone_file(src: Path, dst: Path, allow_hardlink: bool = True):
+    """Clone the file with reflink, fallback to hardlink and copy."""
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    if dst.exists() or dst.is_symlink():
+        dst.unlink()
+    if _reflink(src, dst):
+        return
+    dst.unlink(missing_ok=True)
+    if allow_hardlink:
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+    shutil.copyfile(src, dst)
+
+
+def sha256_file(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class RunCache():
+    """Content-addressed cache of the script outputs.
+
+    Layout:
+
+    + `objects/<hash[:2]>/<hash>`: output files, read only.
+    + `entries/<key>.json`: outputs of a run, mapping from the
+      output argument to the object hashes.
+
+    Outputs are restored as new writable files, with reflink when it's
+    possible, never hardlinked to the read only objects.
+    The mtime of an entry is updated when it's reused, `evict` removes
+    the least recently used entries and the objects no longer referenced.
+
+    :param path: Root of the cache.
+    :param max_size_gb: Size cap of the objects.
+    """
+    def __init__(
+            self, path: Path = DEFAULT_RUN_CACHE_PATH,
+            max_size_gb: float = DEFAULT_RUN_CACHE_MAX_SIZE_GB):
+        self.path = Path(path)
+        self.max_size_gb = max_size_gb
+        self._memo: dict[str, list] | None = None
+
+    @property
+    def objects_path(self) -> Path:
+        return self.path / "objects"
+
+    @property
+    def entries_path(self) -> Path:
+        return self.path / "entries"
+
+    @property
+    def memo_path(self) -> Path:
+        return self.path / "hashes.json"
+
+    @property
+    def lock_path(self) -> Path:
+        return self.path / "cache.lock"
+
+    def object_path(self, hash_: str) -> Path:
+        return self.objects_path / hash_[:2] / hash_
+
+    def _load_memo(self) -> dict[str, list]:
+        if self._memo is None:
+            try:
+                with open(self.memo_path) as f:
+                    self._memo = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                self._memo = {}
+        return self._memo
+
+    def _save_memo(self):
+        if self._memo is None:
+            return
+        items = list(self._memo.items())[-MAX_HASH_MEMO:]
+        self.path.mkdir(parents=True, exist_ok=True)
+        dump_json_atomic(dict(items), self.memo_path)
+
+    def hash_file(self, path: Path) -> str:
+        """Hash of the file content, memoized by the size and mtime."""
+        path = path.absolute()
+        st = path.stat()
+        memo = self._load_memo()
+        stamp = [st.st_size, st.st_mtime_ns]
+        key = str(path)
+        if (key in memo) and (memo[key][:2] == stamp):
+            return memo[key][2]
+        hash_ = sha256_file(path)
+        memo.pop(key, None)
+        memo[key] = stamp + [hash_]
+        return hash_
+
+    def hash_path(self, path: Path) -> str:
+        """Hash of a file or all files under a directory."""
+        if path.is_file():
+            return self.hash_file(path)
+        h = hashlib.sha256()
+        for p in sorted(path.rglob("*")):
+            if p.is_file():
+                h.update(str(p.relative_to(path)).encode())
+                h.update(self.hash_file(p).encode())
+        return h.hexdigest()
+
+    def make_key(
+            self, script_dir: Path, args: dict[str, T.Any],
+            outputs: list[str], env_state: str) -> str:
+        """Key of a script run.
+
+        :param script_dir: Dir of the script, all files are hashed.
+        :param args: Resolved arguments of the run,
+        the existing paths in them are treated as input files.
+        :param outputs: Names of the output arguments,
+        their values are ignored.
+        :param env_state: State of the env, like the hash of the lock.
+        """
+        inputs = {}
+        for name, value in sorted(args.items()):
+            if name in outputs:
+                continue
+            inputs[name] = [value, None]
+            if isinstance(value, (str, Path)) and str(value) \
+                    and Path(value).exists():
+                inputs[name][1] = self.hash_path(Path(value))
+        content = json.dumps({
+            "script": self.hash_path(script_dir),
+            "inputs": inputs,
+            "env": env_state,
+        }, sort_keys=True, default=str)
+        self._save_memo()
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def entry_path(self, key: str) -> Path:
+        return self.entries_path / f"{key}.json"
+
+    def get(self, key: str) -> dict | None:
+        """Get the entry of the key, None if missing or
+        its objects have been removed."""
+        path = self.entry_path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        if not all(
+                self.object_path(h).exists()
+                for h in self._entry_hashes(entry)):
+            return None
+        os.utime(path)
+        return entry
+
+    @staticmethod
+    def _entry_hashes(entry: dict) -> list[str]:
+        hashes = []
+        for info in entry["outputs"].values():
+            if info["type"] == "file":
+                hashes.append(info["hash"])
+            else:
+                hashes.extend(info["files"].values())
+        return hashes
+
+    def restore(self, entry: dict, args: dict[str, T.Any]):
+        """Restore the outputs of the entry to the paths in args."""
+        for name, info in entry["outputs"].items():
+            dst = Path(args[name])
+            if info["type"] == "file":
+                clone_file(
+                    self.object_path(info["hash"]), dst,
+                    allow_hardlink=False)
+            else:
+                for rel, hash_ in info["files"].items():
+                    clone_file(
+                        self.object_path(hash_), dst / rel,
+                        allow_hardlink=False)
+
+    @staticmethod
+    def prepare_outputs(args: dict[str, T.Any], outputs: list[str]):
+        """Unlink the output files hardlinked to the cache objects,
+        restored by the older versions, before running,
+        avoid to write through the links into the cache."""
+        for name in outputs:
+            path = Path(args[name])
+            files = [path] if path.is_file() else (
+                list(path.rglob("*")) if path.is_dir() else [])
+            for p in files:
+                if p.is_file() and p.stat().st_nlink > 1:
+                    p.unlink()
+
+    def _add_object(self, src: Path) -> str:
+        hash_ = self.hash_file(src)
+        obj = self.object_path(hash_)
+        if not obj.exists():
+            tmp = obj.with_name(f".{hash_}.{os.getpid()}.tmp")
+            clone_file(src, tmp, allow_hardlink=False)
+            os.chmod(tmp, 0o444)
+            os.replace(tmp, obj)
+        return hash_
+
+    def put(self, key: str, args: dict[str, T.Any], outputs: list[str]):
+        """Store the outputs of a run."""
+        self.objects_path.mkdir(parents=True, exist_ok=True)
+        with file_lock(self.lock_path):
+            stored = self._put(key, args, outputs)
+        if stored:
+            self.evict()
+
+    def _put(
+            self, key: str, args: dict[str, T.Any],
+            outputs: list[str]) -> bool:
+        entry: dict[str, dict] = {"outputs": {}}
+        for name in outputs:
+            path = Path(args[name])
+            if path.is_file():
+                entry["outputs"][name] = {
+                    "type": "file", "hash": self._add_object(path)}
+            elif path.is_dir():
+                entry["outputs"][name] = {"type": "dir", "files": {
+                    str(p.relative_to(path)): self._add_object(p)
+                    for p in sorted(path.rglob("*")) if p.is_file()
+                }}
+            else:
+                console.log(
+                    f"[error]Output [note]{name}[/note] not found "
+                    f"at [path]{path}[/path], skip caching.[/error]")
+                return False
+        self._save_memo()
+        self.entries_path.mkdir(parents=True, exist_ok=True)
+        dump_json_atomic(entry, self.entry_path(key))
+        return True
+
+    def evict(
+            self, max_size_gb: float | None = None,
+            dry_run: bool = False) -> list[Path]:
+        """Remove the least recently used entries until
+        the size of the objects is under the cap,
+        then remove the objects not referenced by any entry.
+
+        :return: The removed entries.
+        """
+        if max_size_gb is None:
+            max_size_gb = self.max_size_gb
+        max_size = max_size_gb * 1024**3
+        if not self.path.exists():
+            return []
+        with file_lock(self.lock_path):
+            entries = {}
+            for p in self.entries_path.glob("*.json"):
+                try:
+                    with open(p) as f:
+                        entries[p] = set(self._entry_hashes(json.load(f)))
+                except (OSError, json.JSONDecodeError):
+                    entries[p] = set()
+            sizes = {
+                o.name: o.stat().st_size
+                for o in self.objects_path.glob("*/*")
+                if not o.name.startswith(".")
+            }
+            refs = Counter(h for hashes in entries.values() for h in hashes)
+            total = sum(sizes.get(h, 0) for h in refs)
+            removed = []
+            for p in sorted(entries, key=lambda p: p.stat().st_mtime):
+                if total <= max_size:
+                    break
+                removed.append(p)
+                for h in entries[p]:
+                    refs[h] -= 1
+                    if refs[h] == 0:
+                        del refs[h]
+                        total -= sizes.get(h, 0)
+            if dry_run:
+                return removed
+            for p in removed:
+                p.unlink(missing_ok=True)
+            for h in sizes:
+                if h not in refs:
+                    obj = self.object_path(h)
+                    os.chmod(obj, 0o644)
+                    obj.unlink(missing_ok=True)
+        if len(removed) > 0:
+            console.log(
+                f"Evict {len(removed)} entries from the run cache "
+                f"[path]{self.path}[/path]")
+        return removed
+
+
+run_cache = RunCache()
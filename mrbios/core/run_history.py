@@ -0,0 +1,297 @@
+from datetime import datetime
+from pathlib import Path
+import threading
+import csv
+import sqlite3
+import socket
+import json
+import math
+import time
+import os
+import re
+import typing as T
+
+from ..utils.misc import is_network_fs
+from .run_stats import RunUsage, percentile
+
+
+# The old runs are pruned every N new runs.
+PRUNE_EVERY = 500
+DEFAULT_MAX_AGE_DAYS = 180.0
+DEFAULT_MAX_ROWS = 100000
+# Seconds to wait for the lock of the database.
+BUSY_TIMEOUT = 30.0
+
+RUN_FIELDS = [
+    "id", "script", "env", "host", "pid", "status", "exit_code", "mode",
+    "start", "end", "wall", "user", "sys", "cpu", "max_rss",
+    "read_bytes", "write_bytes", "overhead", "args", "outputs",
+]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    script TEXT NOT NULL,
+    env TEXT,
+    host TEXT,
+    pid INTEGER,
+    status TEXT NOT NULL,
+    exit_code INTEGER,
+    mode TEXT,
+    start REAL NOT NULL,
+    end REAL,
+    wall REAL,
+    user REAL,
+    sys REAL,
+    cpu REAL,
+    max_rss INTEGER,
+    read_bytes INTEGER,
+    write_bytes INTEGER,
+    overhead REAL,
+    args TEXT,
+    outputs TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_script ON runs (script, start);
+CREATE INDEX IF NOT EXISTS runs_status ON runs (status, start);
+CREATE INDEX IF NOT EXISTS runs_start ON runs (start);
+"""
+
+_TIME_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def parse_time(value: str | float) -> float:
+    """Parse a time point to the unix time.
+
+    Accept ISO dates like "2024-01-31" or "2024-01-31T20:00",
+    the time ago like "30m", "12h", "7d", or a number of days ago.
+    """
+    now = time.time()
+    if isinstance(value, (int, float)):
+        return now - value * 86400
+    m = re.fullmatch(r"(\d+(?:\.\d+)?)([smhd])", value.strip())
+    if m is not None:
+        return now - float(m.group(1)) * _TIME_UNITS[m.group(2)]
+    return datetime.fromisoformat(value).timestamp()
+
+
+class RunHistory():
+    """History of the script runs of a project, in a SQLite database.
+
+    The database is in WAL mode, so the readers never block the writers,
+    and the concurrent runs only hold the write lock for a short insert or
+    update. WAL needs the shared memory of a local disk, on a network
+    file system, like NFS, the database falls back to the rollback
+    journal. A run is inserted as 'running' when it starts and updated
+    when it finishes, the runs killed in between stay 'running',
+    so each run takes two short writes.
+
+    :param path: Path of the database file.
+    :param journal_mode: SQLite journal mode, by default 'WAL' on a
+    local disk and 'DELETE' on a network file system.
+    """
+    def __init__(self, path: Path, journal_mode: str | None = None):
+        self.path = path
+        self._journal_mode = journal_mode
+        self._local = threading.local()
+
+    @property
+    def journal_mode(self) -> str:
+        if self._journal_mode is None:
+            self._journal_mode = "DELETE" \
+                if is_network_fs(self.path.parent) else "WAL"
+        return self._journal_mode
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """Connection of the current thread."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(
+                self.path, timeout=BUSY_TIMEOUT, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute(f"PRAGMA journal_mode={self.journal_mode}")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def start(
+            self, script: str, args: dict[str, T.Any],
+            env: str | None = None,
+            outputs: dict[str, T.Any] | None = None,
+            status: str = "running") -> int:
+        """Record the start of a run and return its id."""
+        cur = self.conn.execute(
+            "INSERT INTO runs (script, env, host, pid, status, start, "
+            "args, outputs) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                script, env, socket.gethostname(), os.getpid(), status,
+                time.time(),
+                json.dumps(args, default=str),
+                json.dumps(outputs or {}, default=str),
+            ))
+        run_id = T.cast(int, cur.lastrowid)
+        if run_id % PRUNE_EVERY == 0:
+            self.prune(DEFAULT_MAX_AGE_DAYS, DEFAULT_MAX_ROWS)
+        return run_id
+
+    def finish(
+            self, run_id: int, exit_code: int,
+            usage: RunUsage | None = None):
+        """Record the end of a run."""
+        values: dict[str, T.Any] = {
+            "status": "done" if exit_code == 0 else "failed",
+            "exit_code": exit_code,
+            "end": time.time(),
+        }
+        if usage is not None:
+            record = usage.to_record(exit_code)
+            for key in (
+                    "mode", "wall", "user", "sys", "cpu", "max_rss",
+                    "read_bytes", "write_bytes", "overhead"):
+                values[key] = record[key]
+        columns = ", ".join(f'"{k}" = ?' for k in values)
+        self.conn.execute(
+            f"UPDATE runs SET {columns} WHERE id = ?",
+            list(values.values()) + [run_id])
+
+    @staticmethod
+    def _where(
+            script: str | None = None,
+            status: str | None = None,
+            since: str | float | None = None,
+            until: str | float | None = None,
+            host: str | None = None,
+            ) -> tuple[str, list]:
+        conds: list[str] = []
+        params: list[T.Any] = []
+        if script is not None:
+            # `task/*` matches all scripts of the task
+            conds.append("script GLOB ?")
+            params.append(script)
+        if status is not None:
+            statuses = status.split(",")
+            conds.append(f"status IN ({', '.join('?' * len(statuses))})")
+            params.extend(statuses)
+        if since is not None:
+            conds.append("start >= ?")
+            params.append(parse_time(since))
+        if until is not None:
+            conds.append("start < ?")
+            params.append(parse_time(until))
+        if host is not None:
+            conds.append("host = ?")
+            params.append(host)
+        where = ("WHERE " + " AND ".join(conds)) if conds else ""
+        return where, params
+
+    def query(self, limit: int | None = None, **filters) -> list[dict]:
+        """Runs matching the filters, the latest first.
+
+        :param filters: `script` (glob pattern), `status`
+        (comma separated), `since`, `until` (see `parse_time`), `host`.
+        """
+        where, params = self._where(**filters)
+        sql = f"SELECT * FROM runs {where} ORDER BY start DESC, id DESC"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return [dict(r) for r in self.conn.execute(sql, params)]
+
+    def prune(
+            self, max_age_days: float | None = None,
+            max_rows: int | None = None) -> int:
+        """Remove the runs older than the age and the oldest runs
+        beyond the max number of rows.
+
+        :return: Number of the removed runs.
+        """
+        n = 0
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if max_age_days is not None:
+                cur = conn.execute(
+                    "DELETE FROM runs WHERE start < ?",
+                    (time.time() - max_age_days * 86400,))
+                n += cur.rowcount
+            if max_rows is not None:
+                # the ids grow with the runs, remove a range of them
+                cur = conn.execute(
+                    "DELETE FROM runs WHERE id <= "
+                    "(SELECT id FROM runs ORDER BY id DESC "
+                    "LIMIT 1 OFFSET ?)",
+                    (max_rows,))
+                n += cur.rowcount
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return n
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+def run_history_path(project_path: Path) -> Path:
+    return project_path.absolute() / ".run-history.sqlite"
+
+
+_histories: dict[Path, RunHistory] = {}
+_histories_lock = threading.Lock()
+
+
+def get_run_history(project_path: Path) -> RunHistory:
+    """Run history of the project, shared in the process."""
+    path = run_history_path(project_path)
+    with _histories_lock:
+        if path not in _histories:
+            _histories[path] = RunHistory(path)
+        return _histories[path]
+
+
+def export_runs(runs: list[dict], path: Path):
+    """Export the runs to a TSV, JSON or JSON lines file,
+    by the suffix of the path."""
+    if path.suffix == ".json":
+        with open(path, 'w') as f:
+            json.dump(runs, f, indent=4)
+    elif path.suffix == ".jsonl":
+        with open(path, 'w') as f:
+            for r in runs:
+                f.write(json.dumps(r) + "\n")
+    else:
+        with open(path, 'w', newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=RUN_FIELDS, delimiter="\t")
+            writer.writeheader()
+            writer.writerows(runs)
+
+
+def summarize_runs_by(
+        runs: list[dict], by: str = "script",
+        ) -> list[tuple[str, int, int, float, float, float, int]]:
+    """Aggregate the runs by a field.
+
+    :return: (group, runs, failed, p50 wall, p90 wall, max wall,
+    max peak rss) of each group, ordered by the p90 wall time.
+    """
+    groups: dict[str, list[dict]] = {}
+    for r in runs:
+        groups.setdefault(str(r.get(by)), []).append(r)
+    rows = []
+    for group, rs in groups.items():
+        walls = [r["wall"] for r in rs if r["wall"] is not None]
+        rows.append((
+            group, len(rs),
+            sum(r["status"] == "failed" for r in rs),
+            percentile(walls, 50), percentile(walls, 90),
+            max(walls, default=float("nan")),
+            max((r["max_rss"] or 0 for r in rs), default=0),
+        ))
+    rows.sort(
+        key=lambda r: 0.0 if math.isnan(r[4]) else r[4], reverse=True)
+    return rows
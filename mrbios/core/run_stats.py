@@ -0,0 +1,313 @@
+from datetime import datetime
+import subprocess as subp
+import threading
+import time
+import os
+import typing as T
+
+
+# Seconds between two samples of the process tree.
+SAMPLE_INTERVAL = 0.2
+# Metrics shown by `script stats`: (name, record field, scale, unit)
+STATS_METRICS = [
+    ("wall", "wall", 1.0, "s"),
+    ("cpu", "cpu", 1.0, "s"),
+    ("peak rss", "max_rss", 1024**-2, "MB"),
+    ("read", "read_bytes", 1024**-2, "MB"),
+    ("write", "write_bytes", 1024**-2, "MB"),
+    ("overhead", "overhead", 1.0, "s"),
+]
+
+try:
+    _CLK_TCK = os.sysconf("SC_CLK_TCK")
+    _PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+except (AttributeError, ValueError):  # pragma: no cover
+    _CLK_TCK, _PAGE_SIZE = 100, 4096
+# `/proc/<pid>/task/<tid>/children` needs CONFIG_PROC_CHILDREN
+_PROC_CHILDREN = os.path.exists(
+    f"/proc/{os.getpid()}/task/{os.getpid()}/children")
+
+
+def _read_stat(pid: int) -> list[str] | None:
+    """Fields of `/proc/<pid>/stat` after the command name."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            content = f.read()
+    except OSError:
+        return None
+    return content[content.rfind(")") + 2:].split()
+
+
+def _children(pid: int) -> list[int]:
+    children: list[int] = []
+    try:
+        tids = os.listdir(f"/proc/{pid}/task")
+    except OSError:
+        return children
+    for tid in tids:
+        try:
+            with open(f"/proc/{pid}/task/{tid}/children") as f:
+                children.extend(int(c) for c in f.read().split())
+        except OSError:
+            continue
+    return children
+
+
+def _process_tree(pid: int) -> list[int]:
+    """The process and all its descendants, walked from the root."""
+    if not _PROC_CHILDREN:  # pragma: no cover
+        return _scan_process_tree(pid)
+    tree, stack = [], [pid]
+    while stack:
+        p = stack.pop()
+        tree.append(p)
+        stack.extend(_children(p))
+    return tree
+
+
+def _scan_process_tree(pid: int) -> list[int]:
+    """The process and all its descendants, by the parents of
+    all processes."""
+    children: dict[int, list[int]] = {}
+    try:
+        entries = os.listdir("/proc")
+    except OSError:
+        return [pid]
+    for name in entries:
+        if not name.isdigit():
+            continue
+        fields = _read_stat(int(name))
+        if fields is not None:
+            children.setdefault(int(fields[1]), []).append(int(name))
+    tree, stack = [], [pid]
+    while stack:
+        p = stack.pop()
+        tree.append(p)
+        stack.extend(children.get(p, []))
+    return tree
+
+
+def _rss(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+def _io(pid: int) -> tuple[int, int]:
+    """Bytes read and written by the process, including
+    the children reaped by it."""
+    read = write = 0
+    try:
+        with open(f"/proc/{pid}/io") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key == "read_bytes":
+                    read = int(value)
+                elif key == "write_bytes":
+                    write = int(value)
+    except (OSError, ValueError):
+        pass
+    return read, write
+
+
+def _cpu_times(pid: int) -> tuple[float, float]:
+    """User and system CPU time of the process and its reaped children."""
+    fields = _read_stat(pid)
+    if fields is None:
+        return 0.0, 0.0
+    utime, stime, cutime, cstime = (int(v) for v in fields[11:15])
+    return (utime + cutime) / _CLK_TCK, (stime + cstime) / _CLK_TCK
+
+
+class RunUsage():
+    """Resources used by a script run, summed over the commands of it.
+
+    :param start: Time the run started, by `time.perf_counter`.
+    """
+    def __init__(self, start: float | None = None):
+        self.start = time.perf_counter() if start is None else start
+        self.reset()
+
+    def reset(self) -> None:
+        """Drop the measurements, keep the start time."""
+        # mrbios overhead before the first command started
+        self.overhead: float | None = None
+        self.wall = 0.0
+        self.user = 0.0
+        self.sys = 0.0
+        self.max_rss = 0
+        self.read_bytes = 0
+        self.write_bytes = 0
+        self.mode = "subprocess"
+
+    def add(self, other: "RunUsage"):
+        """Add the usage of a sub run, like a chunk of a sharded run,
+        the max RSS is the largest of the sub runs."""
+        self.mark_started()
+        self.user += other.user
+        self.sys += other.sys
+        self.max_rss = max(self.max_rss, other.max_rss)
+        self.read_bytes += other.read_bytes
+        self.write_bytes += other.write_bytes
+
+    def mark_started(self):
+        if self.overhead is None:
+            self.overhead = time.perf_counter() - self.start
+
+    def to_record(self, exit_code: int) -> dict:
+        return {
+            "time": str(datetime.now()),
+            "status": "done" if exit_code == 0 else "failed",
+            "exit_code": exit_code,
+            "mode": self.mode,
+            "wall": round(self.wall, 3),
+            "user": round(self.user, 3),
+            "sys": round(self.sys, 3),
+            "cpu": round(self.user + self.sys, 3),
+            "max_rss": self.max_rss,
+            "read_bytes": self.read_bytes,
+            "write_bytes": self.write_bytes,
+            "overhead": round(self.overhead or 0.0, 3),
+        }
+
+
+class ProcessMonitor():
+    """Measure the resources used by a process tree.
+
+    The RSS and the I/O of the whole tree are sampled from `/proc`
+    in a background thread. Use `wait` for a child process,
+    its CPU time comes from `wait4`, use it as a context manager
+    around a call served by a running process, like a worker,
+    or call `finish_exited` for a process reaped by someone else.
+
+    :param pid: The root process.
+    :param usage: The usage to add the measurement to.
+    :param interval: Seconds between two samples.
+    """
+    def __init__(
+            self, pid: int, usage: RunUsage,
+            interval: float = SAMPLE_INTERVAL):
+        usage.mark_started()
+        self.pid = pid
+        self.usage = usage
+        self.interval = interval
+        self.peak_rss = 0
+        self.io = (0, 0)
+        # CPU time of the tree, the reaped children are in their parents
+        self.cpu = (0.0, 0.0)
+        self._t0 = time.perf_counter()
+        self._io0 = self._tree_io(_process_tree(pid))
+        self._cpu0 = _cpu_times(pid)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _tree_io(tree: list[int]) -> tuple[int, int]:
+        ios = [_io(p) for p in tree]
+        return sum(r for r, _ in ios), sum(w for _, w in ios)
+
+    def _sample(self):
+        tree = _process_tree(self.pid)
+        self.peak_rss = max(self.peak_rss, sum(_rss(p) for p in tree))
+        read, write = self._tree_io(tree)
+        # the I/O of the reaped children moves to their parent,
+        # so the sum over the tree only grows
+        self.io = (max(self.io[0], read), max(self.io[1], write))
+        times = [_cpu_times(p) for p in tree]
+        self.cpu = (
+            max(self.cpu[0], sum(u for u, _ in times)),
+            max(self.cpu[1], sum(s for _, s in times)))
+
+    def _loop(self):
+        while True:
+            self._sample()
+            if self._stop.wait(self.interval):
+                break
+
+    def _finish(self, user: float, sys: float, max_rss: int,
+                read: int, write: int):
+        self._stop.set()
+        self._thread.join()
+        u = self.usage
+        u.wall += time.perf_counter() - self._t0
+        u.user += user
+        u.sys += sys
+        u.max_rss = max(u.max_rss, self.peak_rss, max_rss)
+        u.read_bytes += max(self.io[0] - self._io0[0], read)
+        u.write_bytes += max(self.io[1] - self._io0[1], write)
+
+    def wait(self, proc: subp.Popen) -> int:
+        """Wait the child process and return the return code."""
+        if not hasattr(os, "wait4"):  # pragma: no cover
+            code = proc.wait()
+            self._finish(0.0, 0.0, 0, 0, 0)
+            return code
+        try:
+            _, status, ru = os.wait4(proc.pid, 0)
+        except ChildProcessError:  # pragma: no cover
+            # reaped by someone else
+            code = proc.wait()
+            self._finish(0.0, 0.0, 0, 0, 0)
+            return code
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        # ru_maxrss is in KB on Linux, it's the peak of the largest
+        # single process, a lower bound of the tree
+        self._finish(
+            ru.ru_utime, ru.ru_stime, ru.ru_maxrss * 1024,
+            ru.ru_inblock * 512, ru.ru_oublock * 512)
+        return proc.returncode
+
+    def finish_exited(self):
+        """Finish the measurement of a process reaped by someone else,
+        the CPU time is the last sample of the tree."""
+        self._finish(self.cpu[0], self.cpu[1], 0, 0, 0)
+
+    def __enter__(self) -> "ProcessMonitor":
+        return self
+
+    def __exit__(self, *exc_info):
+        self._sample()
+        user, sys = _cpu_times(self.pid)
+        self._finish(user - self._cpu0[0], sys - self._cpu0[1], 0, 0, 0)
+
+
+def wait_process(proc: subp.Popen, usage: RunUsage | None = None) -> int:
+    """Wait the process, measure its resources into the usage if given.
+
+    Should be called right after the process started.
+    """
+    if usage is None:
+        return proc.wait()
+    return ProcessMonitor(proc.pid, usage).wait(proc)
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Percentile with the linear interpolation, q in [0, 100]."""
+    values = sorted(values)
+    if len(values) == 0:
+        return float("nan")
+    pos = (len(values) - 1) * q / 100
+    lo = int(pos)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+
+def summarize_runs(
+        records: list[dict],
+        qs: T.Sequence[float] = (50, 90, 99),
+        ) -> list[tuple[str, str, list[float], float]]:
+    """Percentiles of the metrics over the records.
+
+    :return: (metric, unit, percentiles, max) of each metric.
+    """
+    rows = []
+    for name, field, scale, unit in STATS_METRICS:
+        values = [r[field] * scale for r in records if field in r]
+        if len(values) == 0:
+            continue
+        rows.append((
+            name, unit, [percentile(values, q) for q in qs], max(values)))
+    return rows
@@ -1,5 +1,15 @@
 import typing as T
 from pathlib import Path
+from contextlib import nullcontext, ExitStack
+import subprocess as subp
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import tempfile
+import shutil
+import sqlite3
+import time
+import threading
+import sys
 import shlex
 
 import yaml
@@ -9,44 +19,509 @@ from funcdesc import mark_input
 from funcdesc.desc import NotDef
 
 from ..utils.log import console
+from .run_cache import run_cache
+from .run_stats import RunUsage, ProcessMonitor
+from .shard import ShardSpec, split_file, merge_outputs
+from .resource_pool import (
+    Reservation, resource_pool, parse_memory, bind_cpus, available_cpus,
+)
+from .scratch import ScratchSpec, ScratchRun, scratch_run
+from .run_history import RunHistory, get_run_history
+from .async_run import RunHandle
+from .worker import (
+    call_py_worker, call_r_worker, RecyclePolicy, WorkerCrashed,
+)
 
 
 if T.TYPE_CHECKING:
     from .project import Project
+    from .build_log import BuildLog
+    from .dir_obj import Env
+
+
+class CompiledInterface(T.NamedTuple):
+    """Parsed interface of a script, shared by its runners."""
+    config: dict
+    local_files: list[str]
+    command_template: str
+    env: "Env"
+    cmd_obj: T.Any
+
+
+def _stamp(path: Path) -> tuple[int, int] | None:
+    try:
+        st = path.stat()
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+class InterfaceCache():
+    """Compiled interfaces of the scripts in the current process.
+
+    An entry is reused while the mtimes of the script dir,
+    its `interface.yaml` and the dir of the bound env are unchanged,
+    adding, removing or renaming a file changes the mtime of the dir.
+    """
+    def __init__(self) -> None:
+        self._entries: dict[Path, tuple[tuple, CompiledInterface]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _fingerprint(base_path: Path, env_path: Path) -> tuple:
+        return (
+            _stamp(base_path),
+            _stamp(base_path / "interface.yaml"),
+            _stamp(env_path),
+        )
+
+    def get(self, base_path: Path) -> CompiledInterface:
+        key = base_path.absolute()
+        with self._lock:
+            cached = self._entries.get(key)
+        if cached is not None:
+            stamp, compiled = cached
+            if stamp == self._fingerprint(key, compiled.env.path):
+                return compiled
+        with open(key / "interface.yaml", 'r') as f:
+            config = yaml.safe_load(f)
+        compiled = compile_interface(config, key)
+        stamp = self._fingerprint(key, compiled.env.path)
+        with self._lock:
+            self._entries[key] = (stamp, compiled)
+        return compiled
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+interface_cache = InterfaceCache()
+
+
+def get_local_files(base_path: Path) -> list[str]:
+    """Get the local files in the script folder."""
+    it = base_path.glob("*")
+    files = [p.name for p in it if p.is_file()]
+    # exclude interface.yaml and README.md
+    exclude_list = ["interface.yaml", "README.md"]
+    files = [f for f in files if f not in exclude_list]
+    return files
+
+
+def compile_interface(config: dict, base_path: Path) -> CompiledInterface:
+    """Resolve the command template and the env of a script."""
+    from .project import Project
+    local_files = get_local_files(base_path)
+    # replace local files to absolute path
+    temp_list = shlex.split(config["command"])
+    for i, v in enumerate(temp_list):
+        if v in local_files:
+            p = base_path.absolute() / v
+            temp_list[i] = p.as_posix()
+    temp = " ".join(temp_list)
+    env = Project(base_path.parent.parent.parent).get_envs()[config["env"]]
+    return CompiledInterface(
+        config, local_files, temp, env, cmd2func(temp, config))
 
 
 class ScriptRunner:
-    def __init__(self, config: dict, base_path: str | Path):
+    def __init__(
+            self, config: dict, base_path: str | Path,
+            compiled: CompiledInterface | None = None):
         base_path = Path(base_path)
         self.path = base_path
-        self.config = config
-        env_name = config["env"]
-        self.env = self.project.get_envs()[env_name]
+        if compiled is None:
+            compiled = compile_interface(config, base_path)
+        self.compiled = compiled
+        self.config = compiled.config
+        self.env = compiled.env
+        # Options passed to `Env.run_command`
+        self.direct: bool | None = None
+        self.log: "BuildLog | None" = None
+        # Scratch option of the runs, overrides `scratch` of the interface.
+        self.scratch: bool | str | dict | None = None
+
+    def _run_command(
+            self, cmd_str: str, vals: dict,
+            usage: RunUsage | None = None) -> int:
+        """Run the command, record it and the resources used by it
+        in the run history."""
+        if usage is None:
+            usage = RunUsage()
+        run_id = self._record_start(vals)
+        code = -1
+        try:
+            with self._reserve() as res, self._scratch(vals) as scratch:
+                cwd = None
+                if scratch is not None:
+                    vals, cwd = scratch.vals, scratch.path
+                    cmd_str = self.compiled.cmd_obj.get_cmd_str(**vals)
+                code = self._execute(cmd_str, vals, usage, res, cwd)
+        except subp.CalledProcessError as e:
+            code = e.returncode
+            raise
+        finally:
+            self._record_finish(run_id, code, usage)
+        return code
+
+    def _reserve(self) -> T.ContextManager[Reservation | None]:
+        """Reserve the `threads` and `memory` declared in the interface
+        from the node-wide resource pool, no CPUs are reserved
+        if `threads` is not declared."""
+        threads = self.config.get("threads")
+        memory = self.config.get("memory")
+        if (threads is None) and (memory is None):
+            return nullcontext()
+        return resource_pool.acquire(
+            0 if threads is None else int(threads),
+            parse_memory(memory) if memory else 0)
+
+    @property
+    def scratch_spec(self) -> ScratchSpec | None:
+        option = self.config.get("scratch") if self.scratch is None \
+            else self.scratch
+        return ScratchSpec.from_config(option)
+
+    def _scratch(self, vals: dict) -> T.ContextManager[ScratchRun | None]:
+        """Stage the run in a scratch dir on a fast local disk,
+        if the `scratch` option is set."""
+        spec = self.scratch_spec
+        if spec is None:
+            return nullcontext()
+        return scratch_run(spec, vals, self.output_names)
+
+    def _execute(
+            self, cmd_str: str, vals: dict, usage: RunUsage,
+            res: Reservation | None = None, cwd: Path | None = None) -> int:
+        if self.config.get("worker") == "persistent":
+            try:
+                return self._run_in_worker(cmd_str, vals, usage, res, cwd)
+            except WorkerCrashed as e:
+                if e.started:
+                    # the script may have side effects, don't rerun it
+                    console.log(
+                        f"[error]Worker crashed during the run: {e}[/error]")
+                    raise subp.CalledProcessError(1, shlex.split(cmd_str))
+                console.log(
+                    f"[error]Worker crashed: {e}, "
+                    "fallback to the subprocess mode.[/error]")
+                usage.reset()
+        with bind_cpus(res.cpus if (res is not None) and res.cpus else None):
+            self.env.run_command(
+                shlex.split(cmd_str), direct=self.direct, log=self.log,
+                usage=usage,
+                extra_environ=None if res is None else res.environ,
+                cwd=cwd)
+        return 0
+
+    @property
+    def script_name(self) -> str:
+        """Name of the script as `<task>/<script>`."""
+        return f"{self.path.parent.name}/{self.path.name}"
+
+    @property
+    def history(self) -> RunHistory:
+        return get_run_history(self.path.parent.parent.parent)
+
+    def _record_start(
+            self, vals: dict, status: str = "running") -> int | None:
+        outputs = {name: vals.get(name) for name in self.output_names}
+        try:
+            return self.history.start(
+                self.script_name, vals, self.env.name, outputs, status)
+        except sqlite3.Error as e:
+            console.log(f"[error]Failed to record the run: {e}[/error]")
+            return None
+
+    def _record_finish(self, run_id: int | None, code: int, usage: RunUsage):
+        if run_id is None:
+            return
+        try:
+            self.history.finish(run_id, code, usage)
+        except sqlite3.Error as e:
+            console.log(f"[error]Failed to record the run: {e}[/error]")
+
+    @property
+    def worker_script(self) -> Path | None:
+        """The local Python or R file in the command."""
+        for v in shlex.split(self.config["command"]):
+            if v.endswith((".py", ".R", ".r")) and (self.path / v).is_file():
+                return self.path / v
+        return None
+
+    def _convert_vals(self, vals: dict) -> dict:
+        """Convert the string values to the types of the inputs."""
+        vals = dict(vals)
+        for name, arg in self.config['inputs'].items():
+            type_ = eval(arg.get('type', 'str'))
+            if isinstance(vals.get(name), str) and (type_ is not str):
+                vals[name] = type_(vals[name])
+        return vals
+
+    def _run_in_worker(
+            self, cmd_str: str, vals: dict, usage: RunUsage,
+            res: Reservation | None = None, cwd: Path | None = None) -> int:
+        """Run the script in a warm worker of the env."""
+        script = self.worker_script
+        if script is None:
+            raise WorkerCrashed("No Python or R file found in the command.")
+        key = f"{self.env.build_name}:{script.suffix}"
+        cpus = None
+        if (res is not None) and res.cpus:
+            # the thread numbers are fixed when the worker starts
+            key += f":{len(res.cpus)}"
+            cpus = res.cpus
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output = Path(tmp_dir) / "output.log"
+            if script.suffix == ".py":
+                cmd, environ = self.env.prepare_command(
+                    ["python"], direct=True)
+                environ.update({} if res is None else res.environ)
+                code = call_py_worker(
+                    key, cmd, environ, script,
+                    self.config.get("entry", "main"),
+                    self._convert_vals(vals),
+                    None if self.log is None else output, usage, cpus, cwd)
+            else:
+                cmd, environ = self.env.prepare_command(
+                    ["Rscript"], direct=True)
+                environ.update({} if res is None else res.environ)
+                tokens = shlex.split(cmd_str)
+                args = tokens[tokens.index(script.absolute().as_posix()) + 1:]
+                policy = RecyclePolicy(
+                    self.config.get("worker_max_calls", 200),
+                    self.config.get("worker_max_memory_growth_mb", 2048.0))
+                code = call_r_worker(
+                    key, cmd, environ, script, args, output, policy,
+                    usage, cpus, cwd)
+            if output.exists():
+                self._forward_output(output)
+        if code != 0:
+            raise subp.CalledProcessError(code, [str(script)])
+        return code
+
+    def _forward_output(self, output: Path):
+        """Copy the captured output of a worker call
+        to the log or the terminal."""
+        with open(output, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                if self.log is not None:
+                    self.log.write(chunk)
+                else:
+                    sys.stdout.buffer.write(chunk)
+        sys.stdout.flush()
 
     @property
     def command_template(self) -> str:
-        temp = self.config["command"]
-        # replace local files to absolute path
-        local_files = self.get_local_files()
-        temp_list = shlex.split(temp)
-        for i, v in enumerate(temp_list):
-            if v in local_files:
-                p = self.path.absolute() / v
-                temp_list[i] = p.as_posix()
-        temp = " ".join(temp_list)
-        return temp
+        return self.compiled.command_template
 
     def run(self, *args, **kwargs) -> int:
-        cmd_obj = cmd2func(self.command_template, self.config)
+        usage = RunUsage()
+        cmd_obj = self.compiled.cmd_obj
+        cmd_str = cmd_obj.get_cmd_str(*args, **kwargs)
+        vals = cmd_obj.formater.desc.parse_pass_in(args, kwargs)
+        if not self.config.get("cache", False):
+            return self._run_vals(cmd_str, vals, usage)
+        return self._run_cached(cmd_str, vals, usage)
+
+    def _run_vals(self, cmd_str: str, vals: dict, usage: RunUsage) -> int:
+        if self.shard_input is None:
+            return self._run_command(cmd_str, vals, usage)
+        return self._run_sharded(vals, usage)
+
+    @property
+    def shard_input(self) -> tuple[str, ShardSpec] | None:
+        """The input argument split into chunks, marked with `shard`."""
+        shards = [
+            (name, ShardSpec.from_config(arg["shard"]))
+            for name, arg in self.config['inputs'].items()
+            if arg.get("shard")
+        ]
+        if len(shards) > 1:
+            raise ValueError("Only one input argument can be sharded.")
+        return shards[0] if shards else None
+
+    def _run_sharded(self, vals: dict, usage: RunUsage) -> int:
+        """Split the input into chunks, run the script on the chunks
+        in parallel, then merge the outputs of the chunks.
+
+        The chunks are recorded as their own runs, the whole run is
+        recorded in the 'sharded' mode with the usage summed over them.
+        """
+        name, spec = T.cast(tuple[str, ShardSpec], self.shard_input)
+        outputs = self.output_names
+        if len(outputs) == 0:
+            raise ValueError(
+                "Mark the outputs with `output: true`, "
+                "they are merged from the outputs of the chunks.")
+        src = Path(vals[name])
+        scratch_spec = self.scratch_spec
+        # keep the chunks on the scratch disk if it's set
+        shard_dir = None if scratch_spec is None \
+            else scratch_spec.space.create("shard")
+        if shard_dir is not None:
+            work_dir = shard_dir.path
+        else:
+            work_dir = Path(tempfile.mkdtemp(
+                prefix=".shard-",
+                dir=Path(vals[outputs[0]]).absolute().parent))
+        usage.mode = "sharded"
+        run_id = self._record_start(vals)
+        code = -1
+        chunk_usages: list[RunUsage] = []
+        try:
+            chunks = split_file(src, spec, work_dir)
+            console.log(
+                f"Split [path]{src}[/path] into {len(chunks)} chunks.")
+            chunk_vals = []
+            for chunk in chunks:
+                (chunk.parent / "out").mkdir()
+                v = dict(vals, **{name: str(chunk)})
+                for o in outputs:
+                    v[o] = str(chunk.parent / "out" / Path(vals[o]).name)
+                chunk_vals.append(v)
+            cmd_obj = self.compiled.cmd_obj
+            n_jobs = min(len(chunks), len(available_cpus()))
+            chunk_usages = [RunUsage() for _ in chunk_vals]
+            with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+                futures = [
+                    executor.submit(
+                        self._run_command, cmd_obj.get_cmd_str(**v), v, u)
+                    for v, u in zip(chunk_vals, chunk_usages)
+                ]
+                for fut in futures:
+                    fut.result()
+            for o in outputs:
+                merge = self.config['inputs'][o].get("merge", "concat")
+                merge_outputs(
+                    [Path(v[o]) for v in chunk_vals], Path(vals[o]),
+                    merge, self._run_merge_command)
+            code = 0
+        except subp.CalledProcessError as e:
+            code = e.returncode
+            raise
+        finally:
+            if shard_dir is not None:
+                shard_dir.remove()
+            else:
+                shutil.rmtree(work_dir, ignore_errors=True)
+            for u in chunk_usages:
+                usage.add(u)
+            usage.wall = time.perf_counter() - usage.start
+            self._record_finish(run_id, code, usage)
+        return code
+
+    def _run_merge_command(self, cmd_str: str):
+        local_files = self.compiled.local_files
+        cmd = [
+            (self.path.absolute() / v).as_posix() if v in local_files else v
+            for v in shlex.split(cmd_str)
+        ]
+        self.env.run_command(cmd, direct=self.direct, log=self.log)
+
+    async def arun(
+            self, *args, timeout: float | None = None,
+            **kwargs) -> "RunHandle":
+        """Start the script without blocking the event loop.
+
+        Like `run`, the run reserves the resources, is staged in the
+        scratch dir and is recorded in the run history, they are released,
+        committed and recorded when the process exited.
+
+        :param timeout: Seconds before killing the run.
+        :return: Handle of the run, iterate the output lines with
+        `handle.stdout()`/`handle.stderr()`, get the return code
+        with `await handle.wait()`.
+        :raises ValueError: When the script has a sharded input,
+        it runs as many processes, use `run` instead.
+        """
+        if self.shard_input is not None:
+            raise ValueError(
+                f"{self.script_name} has a sharded input, "
+                "it can't be started as a single process, use `run`.")
+        cmd_obj = self.compiled.cmd_obj
         cmd_str = cmd_obj.get_cmd_str(*args, **kwargs)
-        return self.env.run_command(shlex.split(cmd_str))
+        vals = cmd_obj.formater.desc.parse_pass_in(args, kwargs)
+        usage = RunUsage()
+        run_id = self._record_start(vals)
+        stack = ExitStack()
+        try:
+            # waiting for the resources should not block the event loop
+            res = await asyncio.to_thread(
+                stack.enter_context, self._reserve())
+            scratch = await asyncio.to_thread(
+                stack.enter_context, self._scratch(vals))
+            cwd = None
+            if scratch is not None:
+                cmd_str = cmd_obj.get_cmd_str(**scratch.vals)
+                cwd = str(scratch.path)
+            # may activate the env in a subprocess
+            cmd, environ = await asyncio.to_thread(
+                self.env.prepare_command, shlex.split(cmd_str),
+                direct=self.direct)
+            cpus = None
+            if (res is not None) and res.cpus:
+                environ.update(res.environ)
+                cpus = res.cpus
+            handle = await RunHandle.start(
+                cmd, environ, timeout=timeout, cwd=cwd, cpus=cpus)
+        except BaseException:
+            stack.close()
+            self._record_finish(run_id, -1, usage)
+            raise
+        monitor = ProcessMonitor(handle.pid, usage)
+
+        def finish(code: int):
+            monitor.finish_exited()
+            try:
+                if (code == 0) and not handle.timed_out:
+                    stack.close()
+                else:
+                    # drop the outputs in the scratch dir
+                    e = subp.CalledProcessError(code, cmd)
+                    stack.__exit__(type(e), e, None)
+            finally:
+                self._record_finish(run_id, code, usage)
+        handle.add_exit_callback(finish)
+        return handle
+
+    @property
+    def output_names(self) -> list[str]:
+        """Arguments marked as outputs with `output: true`."""
+        return [
+            name for name, arg in self.config['inputs'].items()
+            if arg.get('output', False)
+        ]
+
+    def _run_cached(
+            self, cmd_str: str, vals: dict, usage: RunUsage) -> int:
+        """Run the script, restore the outputs from the run cache
+        if the script, the arguments, the input files and the env
+        have not changed."""
+        outputs = self.output_names
+        key = run_cache.make_key(
+            self.path, vals, outputs, self.env.state_hash)
+        entry = run_cache.get(key)
+        if entry is not None:
+            console.log(
+                f"Restore the outputs from the run cache, key: {key[:16]}")
+            self._record_start(vals, status="cached")
+            run_cache.restore(entry, vals)
+            return 0
+        run_cache.prepare_outputs(vals, outputs)
+        ret_code = self._run_vals(cmd_str, vals, usage)
+        run_cache.put(key, vals, outputs)
+        return ret_code
 
     def get_run_func(self) -> T.Callable:
-        cmd_obj = cmd2func(self.command_template, self.config)
+        cmd_obj = self.compiled.cmd_obj
 
         def run(*args, **kwargs) -> int:  # pragma: no cover
+            usage = RunUsage()
             cmd_str = cmd_obj.get_cmd_str(*args, **kwargs)
-            return self.env.run_command(shlex.split(cmd_str))
+            vals = cmd_obj.formater.desc.parse_pass_in(args, kwargs)
+            return self._run_vals(cmd_str, vals, usage)
         run.__signature__ = cmd_obj.__signature__  # type: ignore
         for name, arg in self.config['inputs'].items():
             mark_ = mark_input(
@@ -77,12 +552,7 @@ class ScriptRunner:
 
     def get_local_files(self) -> list[str]:
         """Get the local files in the script folder."""
-        it = self.path.glob("*")
-        files = [p.name for p in it if p.is_file()]
-        # exclude interface.yaml and README.md
-        exclude_list = ["interface.yaml", "README.md"]
-        files = [f for f in files if f not in exclude_list]
-        return files
+        return list(self.compiled.local_files)
 
     @property
     def project(self) -> "Project":
@@ -91,7 +561,12 @@ class ScriptRunner:
 
     @staticmethod
     def from_config_file(path: str | Path) -> "ScriptRunner":
+        """Create the runner from the interface file,
+        the parsed interface is cached in the process."""
         path = Path(path)
-        with open(path, 'r') as f:
-            config = yaml.safe_load(f)
-        return ScriptRunner(config, path.parent)
+        if path.name != "interface.yaml":
+            with open(path, 'r') as f:
+                config = yaml.safe_load(f)
+            return ScriptRunner(config, path.parent)
+        compiled = interface_cache.get(path.parent)
+        return ScriptRunner(compiled.config, path.parent, compiled)
@@ -0,0 +1,355 @@
+from contextlib import contextmanager
+from pathlib import Path
+import itertools
+import threading
+import tempfile
+import getpass
+import shutil
+import errno
+import glob
+import json
+import time
+import os
+import typing as T
+
+from ..utils.log import console
+from ..utils.misc import file_lock, dump_json_atomic
+from .resource_pool import parse_memory
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None  # type: ignore
+
+
+# Root of the scratch dirs, should be on a fast local disk.
+DEFAULT_SCRATCH_ROOT = Path(os.environ.get(
+    "MRBIOS_SCRATCH_DIR", tempfile.gettempdir()))
+# Runs fall back to the working dir when the scratch disk
+# has less free space than this.
+MIN_FREE_BYTES = 1024**3
+LINK_MODES = ("hardlink", "symlink")
+LOCK_NAME = ".mrbios-scratch.lock"
+# Seconds the measured usage of the scratch dirs is reused
+# by the quota check, instead of walking all dirs for each run.
+USAGE_MAX_AGE = 30.0
+
+_counter = itertools.count()
+
+
+def _is_dir(path: Path) -> bool:
+    return path.is_dir() and not path.is_symlink()
+
+
+def dir_size(path: Path) -> int:
+    """Bytes of the disk used by the files in the dir,
+    the files linked from elsewhere are not counted."""
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                st = os.lstat(os.path.join(root, name))
+            except OSError:
+                continue
+            if st.st_nlink == 1:
+                size += st.st_blocks * 512
+    return size
+
+
+def _link(src: Path, dst: Path, link: str):
+    if (link == "hardlink") and src.is_file():
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            # on another file system, or not permitted
+            pass
+    os.symlink(src, dst)
+
+
+def stage_input(src: Path, dst_dir: Path, link: str = "hardlink") -> Path:
+    """Link the input and the index files named after it,
+    like `x.bam.bai`, into the dir without copying.
+
+    :return: Path of the staged input.
+    """
+    src = src.absolute()
+    dst_dir.mkdir(parents=True, exist_ok=True)
+    siblings = [
+        Path(p) for p in glob.glob(glob.escape(str(src)) + ".*")
+        if os.path.isfile(p)
+    ]
+    for p in [src] + siblings:
+        _link(p, dst_dir / p.name, link)
+    return dst_dir / src.name
+
+
+def _temp_path(dst: Path, tag: str) -> Path:
+    return dst.with_name(
+        f".{dst.name}.{os.getpid()}-{threading.get_ident()}.{tag}")
+
+
+def move_atomic(src: Path, dst: Path):
+    """Move the file or dir to the destination. It's renamed into place,
+    across file systems it's copied beside the destination first,
+    so the readers never see a partial output."""
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    old = None
+    if _is_dir(dst):
+        # a dir can't be replaced by a rename, move it aside
+        old = _temp_path(dst, "old")
+        os.replace(dst, old)
+    try:
+        try:
+            os.replace(src, dst)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            tmp = _temp_path(dst, "tmp")
+            try:
+                if _is_dir(src):
+                    shutil.copytree(src, tmp, symlinks=True)
+                else:
+                    shutil.copy2(src, tmp, follow_symlinks=False)
+                os.replace(tmp, dst)
+            except BaseException:
+                if _is_dir(tmp):
+                    shutil.rmtree(tmp, ignore_errors=True)
+                else:
+                    tmp.unlink(missing_ok=True)
+                raise
+    except BaseException:
+        if old is not None:
+            os.replace(old, dst)
+        raise
+    if old is not None:
+        shutil.rmtree(old, ignore_errors=True)
+
+
+class ScratchDir():
+    """A dir on the scratch disk, locked by its process until removed."""
+    def __init__(self, path: Path, fd: int):
+        self.path = path
+        self._fd = fd
+
+    def remove(self):
+        if self._fd < 0:
+            return
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.close(self._fd)  # release the lock
+        self._fd = -1
+
+
+class ScratchSpace():
+    """Per-run dirs on a fast local disk.
+
+    Each dir holds a lock file locked by its process, the dirs of
+    the crashed processes are unlocked by the OS and removed when the
+    next dir is created. The creation is serialized by the lock of the
+    space.
+
+    The quota is a soft admission limit: no new dir is created when
+    the usage is over it, the running runs are not stopped when their
+    dirs grow beyond it. The usage measured by a previous check is
+    reused for `USAGE_MAX_AGE` seconds, it's measured again before
+    refusing a run.
+
+    :param root: Root of the scratch dirs.
+    :param quota: Max bytes used by the scratch dirs of the user
+    under the root, no new dir is created beyond it.
+    """
+    def __init__(self, root: Path, quota: int | None = None):
+        self.root = root
+        self.quota = quota
+
+    @property
+    def base(self) -> Path:
+        return self.root / f"mrbios-scratch-{getpass.getuser()}"
+
+    @property
+    def lock_path(self) -> Path:
+        return self.base / "scratch.lock"
+
+    @property
+    def usage_path(self) -> Path:
+        return self.base / "usage.json"
+
+    def sweep(self) -> int:
+        """Remove the dirs of the dead processes.
+
+        :return: Number of the removed dirs.
+        """
+        n = 0
+        for d in self.base.iterdir():
+            if not _is_dir(d):
+                continue
+            try:
+                fd = os.open(d / LOCK_NAME, os.O_RDONLY)
+            except FileNotFoundError:
+                # the holder died during the creation or the removal
+                fd = -1
+            except OSError:  # pragma: no cover
+                continue
+            try:
+                if (fd >= 0) and (fcntl is not None):
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                elif fd >= 0:  # pragma: no cover
+                    continue
+            except BlockingIOError:
+                continue
+            finally:
+                if fd >= 0:
+                    os.close(fd)
+            shutil.rmtree(d, ignore_errors=True)
+            n += 1
+        if n > 0:
+            self.usage_path.unlink(missing_ok=True)
+        return n
+
+    def usage(self, max_age: float = 0.0) -> int:
+        """Bytes used by the scratch dirs.
+
+        :param max_age: Reuse the usage measured in the last seconds.
+        """
+        if max_age > 0:
+            try:
+                with open(self.usage_path) as f:
+                    cached = json.load(f)
+                if time.time() - cached["time"] <= max_age:
+                    return int(cached["bytes"])
+            except (OSError, ValueError, KeyError, TypeError):
+                pass
+        used = sum(dir_size(d) for d in self.base.iterdir() if _is_dir(d))
+        dump_json_atomic(
+            {"time": time.time(), "bytes": used}, self.usage_path)
+        return used
+
+    def create(self, prefix: str = "run") -> ScratchDir | None:
+        """Create a new scratch dir, None if the disk is nearly full
+        or the quota is exceeded."""
+        self.base.mkdir(parents=True, exist_ok=True)
+        with file_lock(self.lock_path):
+            self.sweep()
+            free = shutil.disk_usage(self.base).free
+            if free < MIN_FREE_BYTES:
+                console.log(
+                    f"[error]Only {free / 1024**3:.1f}GB free in "
+                    f"[path]{self.root}[/path], run without the scratch "
+                    "dir.[/error]")
+                return None
+            if self.quota is not None:
+                used = self.usage(USAGE_MAX_AGE)
+                if used >= self.quota:
+                    used = self.usage()
+                if used >= self.quota:
+                    console.log(
+                        f"[error]Scratch dirs in [path]{self.root}[/path] "
+                        f"used {used / 1024**3:.1f}GB, over the quota "
+                        f"{self.quota / 1024**3:.1f}GB, run without the "
+                        "scratch dir.[/error]")
+                    return None
+            path = self.base / (
+                f"{prefix}-{os.getpid()}-{threading.get_ident()}-"
+                f"{next(_counter)}")
+            path.mkdir()
+            fd = os.open(path / LOCK_NAME, os.O_CREAT | os.O_RDWR, 0o600)
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+        return ScratchDir(path, fd)
+
+
+class ScratchSpec(T.NamedTuple):
+    """The `scratch` option of a script.
+
+    :param dir: Root of the scratch dirs, on a fast local disk.
+    :param quota: Max size of the scratch dirs under the root,
+    like "200G", the new runs beyond it run in the working dir.
+    :param link: How the inputs are staged: 'hardlink' (symlink when
+    the input is on another file system) or 'symlink'.
+    """
+    dir: str = str(DEFAULT_SCRATCH_ROOT)
+    quota: str | float | None = None
+    link: str = "hardlink"
+
+    @staticmethod
+    def from_config(config: T.Any) -> "ScratchSpec | None":
+        """Parse the option: true, the root dir or a mapping."""
+        if (config is None) or (config is False):
+            return None
+        if config is True:
+            return ScratchSpec()
+        if isinstance(config, str):
+            return ScratchSpec(dir=config)
+        spec = ScratchSpec(**config)
+        if spec.link not in LINK_MODES:
+            raise ValueError(f"Unknown link mode: {spec.link}")
+        return spec
+
+    @property
+    def space(self) -> ScratchSpace:
+        quota = None if self.quota is None else parse_memory(self.quota)
+        return ScratchSpace(Path(self.dir), quota)
+
+
+class ScratchRun():
+    """Arguments of a run staged in a scratch dir.
+
+    The existing paths of the input arguments are linked into
+    `inputs/<name>/`, the outputs are redirected to `outputs/<name>/`.
+
+    :param scratch_dir: Working dir of the run.
+    :param vals: Arguments of the run.
+    :param outputs: Names of the output arguments.
+    :param link: See `ScratchSpec`.
+    """
+    def __init__(
+            self, scratch_dir: ScratchDir, vals: dict,
+            outputs: list[str], link: str = "hardlink"):
+        self.dir = scratch_dir
+        self.outputs: dict[str, Path] = {}
+        self.vals = dict(vals)
+        for name, v in vals.items():
+            if not isinstance(v, (str, Path)) or (str(v) == ""):
+                continue
+            if name in outputs:
+                dst = Path(v).absolute()
+                out = self.path / "outputs" / name / dst.name
+                out.parent.mkdir(parents=True)
+                self.outputs[name] = dst
+                self.vals[name] = str(out)
+            elif Path(v).exists():
+                self.vals[name] = str(stage_input(
+                    Path(v), self.path / "inputs" / name, link))
+
+    @property
+    def path(self) -> Path:
+        return self.dir.path
+
+    def commit(self):
+        """Move the outputs and the files written beside them,
+        like `out.bam.bai`, back to the output paths."""
+        for name, dst in self.outputs.items():
+            for p in (self.path / "outputs" / name).iterdir():
+                move_atomic(p, dst.parent / p.name)
+
+
+@contextmanager
+def scratch_run(
+        spec: ScratchSpec, vals: dict,
+        outputs: list[str]) -> T.Iterator[ScratchRun | None]:
+    """Stage the run in a new scratch dir, move the outputs back
+    when the block succeeded, and remove the dir in any case.
+
+    Yield None when the scratch disk is not available,
+    the run should be done in place.
+    """
+    scratch_dir = spec.space.create()
+    if scratch_dir is None:
+        yield None
+        return
+    try:
+        run = ScratchRun(scratch_dir, vals, outputs, spec.link)
+        yield run
+        run.commit()
+    finally:
+        scratch_dir.remove()
@@ -0,0 +1,297 @@
+from pathlib import Path
+import heapq
+import gzip
+import mmap
+import os
+import shlex
+import shutil
+import typing as T
+
+from .resource_pool import available_cpus
+
+# Chunks smaller than this are not worth a process.
+MIN_CHUNK_BYTES = 8 * 1024**2
+COPY_BLOCK_BYTES = 16 * 1024**2
+# Prefixes of the header lines, copied to every chunk.
+HEADER_PREFIXES: dict[str, tuple[bytes, ...]] = {
+    "vcf": (b"#",),
+    "sam": (b"@",),
+    "bed": (b"#", b"track", b"browser"),
+    "gff": (b"#",),
+    "gtf": (b"#",),
+}
+# Merge strategies besides the custom merge commands.
+MERGE_STRATEGIES = ("concat", "sorted")
+
+
+class ShardSpec(T.NamedTuple):
+    """How to split an input, the `shard` option of an input argument.
+
+    :param by: 'lines' or 'records'.
+    :param format: Format of the records: fastq, fasta, vcf, sam, bed,
+    gff, gtf, tsv, the header lines of the format are copied to
+    every chunk.
+    :param chunks: Number of the chunks, 'auto' for the number of the CPUs.
+    :param header: Number of the header lines for the formats without
+    header prefixes, like TSV with column names.
+    """
+    by: str = "lines"
+    format: str = "lines"
+    chunks: int | str = "auto"
+    header: int = 0
+
+    @staticmethod
+    def from_config(config: dict) -> "ShardSpec":
+        spec = ShardSpec(**config)
+        if spec.by not in ("lines", "records"):
+            raise ValueError(f"Unknown shard mode: {spec.by}")
+        return spec
+
+    @property
+    def record_format(self) -> str:
+        return self.format if self.by == "records" else "lines"
+
+
+def n_chunks(spec: ShardSpec, size: int) -> int:
+    if spec.chunks != "auto":
+        return max(1, int(spec.chunks))
+    return max(1, min(len(available_cpus()), size // MIN_CHUNK_BYTES))
+
+
+def _is_gzip(path: Path) -> bool:
+    with open(path, 'rb') as f:
+        return f.read(2) == b"\x1f\x8b"
+
+
+def _open(path: Path, mode: str) -> T.BinaryIO:
+    """Open the file, through gzip if it's named '.gz'."""
+    if path.suffix == ".gz":
+        return T.cast(T.BinaryIO, gzip.open(path, mode, compresslevel=1))
+    return T.cast(T.BinaryIO, open(path, mode))
+
+
+def _is_header(line: bytes, spec: ShardSpec, index: int) -> bool:
+    if index < spec.header:
+        return True
+    prefixes = HEADER_PREFIXES.get(spec.format)
+    return (prefixes is not None) and line.startswith(prefixes)
+
+
+def _next_line(mm: mmap.mmap, pos: int) -> int:
+    """Start of the first line at or after the position."""
+    if (pos == 0) or (mm[pos - 1:pos] == b"\n"):
+        return pos
+    i = mm.find(b"\n", pos)
+    return len(mm) if i < 0 else i + 1
+
+
+def _next_record(mm: mmap.mmap, pos: int, fmt: str) -> int:
+    """Start of the first record at or after the position."""
+    pos = _next_line(mm, pos)
+    if fmt == "fasta":
+        if mm[pos:pos + 1] == b">":
+            return pos
+        i = mm.find(b"\n>", pos)
+        return len(mm) if i < 0 else i + 1
+    if fmt == "fastq":
+        # a quality line can start with '@' too, check the '+' line
+        while pos < len(mm):
+            line2 = _next_line(mm, _next_line(mm, pos + 1) + 1)
+            if (mm[pos:pos + 1] == b"@") and (mm[line2:line2 + 1] == b"+"):
+                return pos
+            pos = _next_line(mm, pos + 1)
+        return len(mm)
+    return pos
+
+
+def _copy_range(mm: mmap.mmap, start: int, end: int, dst: T.BinaryIO):
+    view = memoryview(mm)
+    try:
+        for i in range(start, end, COPY_BLOCK_BYTES):
+            dst.write(view[i:min(end, i + COPY_BLOCK_BYTES)])
+    finally:
+        view.release()
+
+
+def _split_plain(
+        path: Path, spec: ShardSpec, out_paths: T.Callable[[int], Path],
+        ) -> list[Path]:
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            shutil.copyfile(path, out_paths(0))
+            return [out_paths(0)]
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    with mm:
+        body = 0
+        index = 0
+        while body < len(mm):
+            end = _next_line(mm, body + 1)
+            if not _is_header(mm[body:end], spec, index):
+                break
+            body, index = end, index + 1
+        header = mm[:body]
+        n = n_chunks(spec, len(mm) - body)
+        bounds = [body]
+        for i in range(1, n):
+            target = body + (len(mm) - body) * i // n
+            bounds.append(max(
+                bounds[-1], _next_record(mm, target, spec.record_format)))
+        bounds.append(len(mm))
+        chunks: list[Path] = []
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            if (start == end) and (len(chunks) > 0):
+                continue
+            dst = out_paths(len(chunks))
+            with open(dst, 'wb') as out:
+                out.write(header)
+                _copy_range(mm, start, end, out)
+            chunks.append(dst)
+    return chunks
+
+
+def _gzip_writer(path: Path) -> T.BinaryIO:
+    return T.cast(T.BinaryIO, gzip.open(path, 'wb', compresslevel=1))
+
+
+def _gzip_size(path: Path) -> int:
+    """Uncompressed size of a gzip file, in a streaming pass.
+
+    The ISIZE trailer can't be trusted: it's the size modulo 2^32 of
+    the last member only, and BGZF files end with an empty member.
+    """
+    size = 0
+    with gzip.open(path, 'rb') as src:
+        while block := src.read(COPY_BLOCK_BYTES):
+            size += len(block)
+    return size
+
+
+def _split_gzip(
+        path: Path, spec: ShardSpec, out_paths: T.Callable[[int], Path],
+        ) -> list[Path]:
+    """Split a gzip file in one pass, the chunks are gzip files too."""
+    total = _gzip_size(path)
+    n = n_chunks(spec, total)
+    target = max(1, total // n)
+    fmt = spec.record_format
+    chunks: list[Path] = []
+    header = b""
+    out: T.BinaryIO | None = None
+    written = written_lines = 0
+    with gzip.open(path, 'rb') as src:
+        for index, line in enumerate(src):
+            if (out is None) and (len(chunks) == 0) and \
+                    _is_header(line, spec, index):
+                header += line
+                continue
+            if (out is not None) and (written >= target) and \
+                    (len(chunks) < n):
+                if fmt == "fasta":
+                    boundary = line.startswith(b">")
+                elif fmt == "fastq":
+                    boundary = written_lines % 4 == 0
+                else:
+                    # a record per line
+                    boundary = True
+                if boundary:
+                    out.close()
+                    out = None
+            if out is None:
+                chunks.append(out_paths(len(chunks)))
+                out = _gzip_writer(chunks[-1])
+                out.write(header)
+                written, written_lines = 0, 0
+            out.write(line)
+            written += len(line)
+            written_lines += 1
+    if out is not None:
+        out.close()
+    if len(chunks) == 0:
+        chunks.append(out_paths(0))
+        with _gzip_writer(chunks[0]) as out:
+            out.write(header)
+    return chunks
+
+
+def split_file(path: Path, spec: ShardSpec, out_dir: Path) -> list[Path]:
+    """Split the file into chunks on the record boundaries,
+    without loading it into memory.
+
+    Plain files are mapped and cut at the offsets near the even
+    split points, gzip files are split in one streaming pass.
+
+    :return: Paths of the chunks, `<out_dir>/chunk-<i>/<file name>`.
+    """
+    def out_paths(i: int) -> Path:
+        p = out_dir / f"chunk-{i}" / path.name
+        p.parent.mkdir(parents=True, exist_ok=True)
+        return p
+
+    if _is_gzip(path):
+        return _split_gzip(path, spec, out_paths)
+    return _split_plain(path, spec, out_paths)
+
+
+def _sort_key(key: list[str] | None) -> T.Callable[[T.Any], T.Any] | None:
+    """Key of the lines for `sorted` merge, like `sort -k`:
+    1-based column numbers, with a 'n' suffix for numeric columns."""
+    if not key:
+        return None
+    cols = [
+        (int(str(k).rstrip("n")) - 1, str(k).endswith("n")) for k in key]
+
+    def func(line: bytes) -> tuple:
+        fields = line.rstrip(b"\n").split(b"\t")
+        return tuple(
+            float(fields[i]) if numeric else fields[i]
+            for i, numeric in cols)
+    return func
+
+
+def merge_outputs(
+        parts: list[Path], dst: Path, merge: str | dict,
+        run_command: T.Callable[[str], T.Any]):
+    """Merge the outputs of the chunks.
+
+    :param merge: The `merge` option of the output argument:
+    'concat', 'sorted', or a mapping with a `strategy` and the options:
+    `header` (number of the header lines kept once) and `key` of the
+    sorted merge. Other strings are custom merge commands,
+    like "python merge.py {inputs} {output}".
+    :param run_command: Run a custom merge command.
+    """
+    options: dict[str, T.Any] = dict(merge) if isinstance(merge, dict) \
+        else {"strategy": merge}
+    strategy = options.get("strategy", "concat")
+    parts = [p for p in parts if p.exists()]
+    if strategy not in MERGE_STRATEGIES:
+        run_command(strategy.format(
+            inputs=" ".join(shlex.quote(str(p)) for p in parts),
+            output=shlex.quote(str(dst))))
+        return
+    if any(p.is_dir() for p in parts):
+        raise ValueError(
+            f"Can not {strategy} the output dirs, use a merge command.")
+    n_header = options.get("header", 0)
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    if (strategy == "concat") and (n_header == 0):
+        # concatenated gzip members are a valid gzip file
+        with open(dst, 'wb') as out:
+            for p in parts:
+                with open(p, 'rb') as part:
+                    shutil.copyfileobj(part, out, COPY_BLOCK_BYTES)
+        return
+    files = [_open(p, 'rb') for p in parts]
+    try:
+        headers = [[f.readline() for _ in range(n_header)] for f in files]
+        with _open(dst, 'wb') as merged:
+            merged.writelines(headers[0] if headers else [])
+            if strategy == "concat":
+                for f in files:
+                    shutil.copyfileobj(f, merged, COPY_BLOCK_BYTES)
+            else:
+                merged.writelines(heapq.merge(
+                    *files, key=_sort_key(options.get("key"))))
+    finally:
+        for f in files:
+            f.close()
@@ -0,0 +1,178 @@
+from pathlib import Path
+import hashlib
+import json
+import os
+import platform
+import re
+import sys
+import time
+
+from ..utils.log import console
+from ..utils.user_setting import DEFAULT_SETTING_PATH
+from .build_profile import default_pkgs_dirs
+
+
+DEFAULT_SOLVE_CACHE_PATH = DEFAULT_SETTING_PATH.parent / "solve-cache"
+DEFAULT_SOLVE_CACHE_MAX_ENTRIES = 200
+# A hit skips the solver, so conda doesn't refresh the repodata and the
+# stamps can't change, the entries expire to pick up the new packages.
+DEFAULT_SOLVE_CACHE_MAX_AGE = 24 * 3600.0
+_SOLVED_AT_PREFIX = "# mrbios-solved-at: "
+
+# Header of the legacy repodata cache file, like:
+# {"_url": "...", "_etag": "...", "_mod": "...", ...
+_LEGACY_HEADER_PATTERN = re.compile(rb'"(_url|_etag|_mod)"\s*:\s*"([^"]*)"')
+
+
+def _read_repodata_state(path: Path) -> dict | None:
+    """Read the url, etag and last modified time of a cached repodata."""
+    try:
+        if path.name.endswith((".info.json", ".state.json")):
+            with open(path) as f:
+                info = json.load(f)
+            return {k: info.get(k) for k in ("url", "etag", "mod")}
+        with open(path, 'rb') as f:
+            head = f.read(1024)
+    except (OSError, json.JSONDecodeError):
+        return None
+    fields = {
+        k.decode()[1:]: v.decode()
+        for k, v in _LEGACY_HEADER_PATTERN.findall(head)
+    }
+    if "url" not in fields:
+        return None
+    return fields
+
+
+def _match_channel(url: str, channels: list[str]) -> bool:
+    if len(channels) == 0:
+        return True
+    for c in channels:
+        c = c.rstrip("/")
+        if url.startswith(c) or (f"/{c}/" in url):
+            return True
+    return False
+
+
+def repodata_stamp(
+        channels: list[str],
+        pkgs_dirs: list[Path] | None = None) -> list[str]:
+    """Stamps of the cached repodata of the channels.
+
+    The stamps are the ETag and Last-Modified of the repodata files,
+    so they change when the channel publishes new packages.
+    """
+    if pkgs_dirs is None:
+        pkgs_dirs = default_pkgs_dirs()
+    stamps = set()
+    for d in pkgs_dirs:
+        cache_dir = d / "cache"
+        if not cache_dir.is_dir():
+            continue
+        for path in cache_dir.glob("*.json"):
+            state = _read_repodata_state(path)
+            if (state is None) or (state.get("url") is None):
+                continue
+            if _match_channel(state["url"], channels):
+                stamps.add(
+                    f"{state['url']} {state.get('etag')} {state.get('mod')}")
+    return sorted(stamps)
+
+
+def solve_key(
+        channels: list[str], deps: list[str],
+        stamp: list[str]) -> str:
+    """Key of the solve result, channels keep their order
+    because it's the priority."""
+    content = json.dumps({
+        "channels": channels,
+        "deps": sorted(deps),
+        "platform": f"{sys.platform}-{platform.machine()}",
+        "repodata": stamp,
+    }, sort_keys=True)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+class SolveCache():
+    """Cache of the solver results, shared by all projects.
+
+    Each entry is a conda explicit spec file named by the solve key,
+    envs with the same channels and deps can be created from it
+    without running the solver. The mtime of an entry is updated when
+    it's reused, `evict` removes the least recently used entries first.
+    The solve time is written in the entry, the entries older than
+    `max_age` are solved again.
+
+    :param path: Root of the cache.
+    :param max_entries: Max number of the entries.
+    :param max_age: Seconds an entry is valid after the solve.
+    """
+    def __init__(
+            self, path: Path = DEFAULT_SOLVE_CACHE_PATH,
+            max_entries: int = DEFAULT_SOLVE_CACHE_MAX_ENTRIES,
+            max_age: float = DEFAULT_SOLVE_CACHE_MAX_AGE):
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self.max_age = max_age
+
+    def entry_path(self, key: str) -> Path:
+        return self.path / f"{key}.txt"
+
+    @staticmethod
+    def solved_at(path: Path) -> float | None:
+        """Solve time of the entry, from its first line."""
+        try:
+            with open(path) as f:
+                line = f.readline()
+            return float(line[len(_SOLVED_AT_PREFIX):]) \
+                if line.startswith(_SOLVED_AT_PREFIX) else None
+        except (OSError, ValueError):
+            return None
+
+    def get(self, key: str) -> Path | None:
+        """Get the explicit spec file of the key,
+        None if missing or expired."""
+        path = self.entry_path(key)
+        if not path.exists():
+            return None
+        solved_at = self.solved_at(path)
+        if (solved_at is None) or (time.time() - solved_at > self.max_age):
+            path.unlink(missing_ok=True)
+            return None
+        os.utime(path)
+        return path
+
+    def put(self, key: str, explicit: str):
+        if "@EXPLICIT" not in explicit:
+            return
+        self.path.mkdir(parents=True, exist_ok=True)
+        path = self.entry_path(key)
+        tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        tmp.write_text(f"{_SOLVED_AT_PREFIX}{time.time()}\n{explicit}")
+        os.replace(tmp, path)
+        self.evict()
+
+    def entries(self) -> list[Path]:
+        if not self.path.exists():
+            return []
+        return list(self.path.glob("*.txt"))
+
+    def evict(self) -> list[Path]:
+        """Remove the least recently used entries until
+        the number of entries is under the cap.
+
+        :return: The removed entries.
+        """
+        entries = sorted(
+            self.entries(), key=lambda e: e.stat().st_mtime, reverse=True)
+        removed = entries[self.max_entries:]
+        for e in removed:
+            e.unlink(missing_ok=True)
+        if len(removed) > 0:
+            console.log(
+                f"Evict {len(removed)} entries from the solve cache "
+                f"[path]{self.path}[/path]")
+        return removed
+
+
+solve_cache = SolveCache()
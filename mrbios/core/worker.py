@@ -0,0 +1,437 @@
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+import subprocess as subp
+import threading
+import atexit
+import json
+import sys
+import urllib.parse
+import typing as T
+
+from ..utils.log import console
+from .run_stats import RunUsage, ProcessMonitor
+from .resource_pool import set_process_affinity
+
+
+# Program of the Python worker, run under the env.
+# Read a JSON request per line from stdin, call the entry function
+# of the script module and write a JSON response per line.
+# The responses are written to the original stdout, the output of the
+# scripts is sent to stderr or the output file of the request.
+# A start line is written before the script runs.
+# Only the script dir of the current call is on sys.path, the modules
+# of the other script dirs are put aside, so the helper modules with
+# the same name don't collide. The modules of a script dir are reloaded
+# when any file in it changed, no bytecode is written into the script
+# dirs.
+PY_WORKER_PROGRAM = r"""
+import importlib
+import importlib.util
+import json
+import os
+import sys
+import traceback
+
+sys.dont_write_bytecode = True
+proto = os.fdopen(os.dup(1), "w")
+os.dup2(2, 1)
+modules = {}
+dir_stamps = {}
+dir_modules = {}
+active_dir = None
+n_loaded = 0
+
+
+def dir_stamp(script_dir):
+    stamp = []
+    for root, dirs, files in os.walk(script_dir):
+        dirs[:] = [d for d in dirs if d != "__pycache__"]
+        for name in files:
+            p = os.path.join(root, name)
+            try:
+                st = os.stat(p)
+            except OSError:
+                continue
+            stamp.append((p, st.st_mtime_ns, st.st_size))
+    return sorted(stamp)
+
+
+def pop_modules(script_dir):
+    prefix = os.path.join(script_dir, "")
+    popped = {}
+    for name, mod in list(sys.modules.items()):
+        file = getattr(mod, "__file__", None)
+        if file and os.path.abspath(file).startswith(prefix):
+            popped[name] = sys.modules.pop(name)
+    return popped
+
+
+def activate(script_dir):
+    global active_dir
+    if active_dir == script_dir:
+        return
+    if active_dir is not None:
+        dir_modules[active_dir] = pop_modules(active_dir)
+        while active_dir in sys.path:
+            sys.path.remove(active_dir)
+    sys.modules.update(dir_modules.pop(script_dir, {}))
+    sys.path.insert(0, script_dir)
+    importlib.invalidate_caches()
+    active_dir = script_dir
+
+
+def evict(script_dir):
+    pop_modules(script_dir)
+    prefix = os.path.join(script_dir, "")
+    for path in [p for p in modules if p.startswith(prefix)]:
+        del modules[path]
+    importlib.invalidate_caches()
+
+
+def load(path):
+    global n_loaded
+    script_dir = os.path.dirname(path)
+    activate(script_dir)
+    stamp = dir_stamp(script_dir)
+    if dir_stamps.get(script_dir) != stamp:
+        evict(script_dir)
+        dir_stamps[script_dir] = stamp
+    if path in modules:
+        return modules[path]
+    n_loaded += 1
+    name = "mrbios_script_" + str(n_loaded)
+    spec = importlib.util.spec_from_file_location(name, path)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    modules[path] = mod
+    return mod
+
+
+def call(req):
+    os.chdir(req["cwd"])
+    func = getattr(load(req["module"]), req["entry"])
+    try:
+        func(**req["kwargs"])
+    except SystemExit as e:
+        code = e.code
+        return code if isinstance(code, int) else (0 if code is None else 1)
+    return 0
+
+
+for line in sys.stdin:
+    req = json.loads(line)
+    saved = None
+    if req.get("output"):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        saved = (os.dup(1), os.dup(2))
+        fd = os.open(req["output"], os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+        os.dup2(fd, 1)
+        os.dup2(fd, 2)
+        os.close(fd)
+    proto.write("\x1eMRBIOS-START\n")
+    proto.flush()
+    try:
+        res = {"ok": True, "code": call(req)}
+    except Exception:
+        res = {"ok": False, "code": 1, "error": traceback.format_exc()}
+    finally:
+        if saved is not None:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved[0], 1)
+            os.dup2(saved[1], 2)
+            os.close(saved[0])
+            os.close(saved[1])
+    proto.write(json.dumps(res) + "\n")
+    proto.flush()
+"""
+
+
+# Program of the R worker, run with `Rscript -e`.
+# Request: URL-encoded fields separated by tabs:
+# output file, working dir, script path, arguments..., END.
+# The script is sourced in a new environment per call with the arguments
+# returned by `commandArgs`, also to the packages reading them, like
+# optparse, the packages loaded by the previous calls stay attached.
+# `quit` and `q` end the script instead of the session.
+# A start line is written before the script runs, the reply line starts
+# with the marker, followed by the return code and the memory used in Mb.
+R_WORKER_PROGRAM = r"""
+.mrbios_quit <- function(save = "default", status = 0, runLast = TRUE) {
+  stop(structure(
+    class = c("mrbios_quit", "condition"),
+    list(message = "quit", call = NULL, status = status)))
+}
+# rebind a base function, also seen by the packages
+.mrbios_bind <- function(name, value) {
+  for (ns in list(baseenv(), .BaseNamespaceEnv)) {
+    unlockBinding(name, ns)
+    assign(name, value, envir = ns)
+    lockBinding(name, ns)
+  }
+}
+# also for the packages calling quit, like optparse with --help
+.mrbios_bind("quit", .mrbios_quit)
+.mrbios_bind("q", .mrbios_quit)
+.mrbios_command_args <- commandArgs
+.mrbios_script_args <- function(trailingOnly = FALSE) {
+  if (trailingOnly) return(.mrbios_args)
+  c("R", "--no-echo", paste0("--file=", .mrbios_file), "--args",
+    .mrbios_args)
+}
+.mrbios_con <- file("stdin")
+open(.mrbios_con)
+.mrbios_args <- character(0)
+.mrbios_file <- ""
+while (length(.mrbios_line <- readLines(.mrbios_con, n = 1)) > 0) {
+  .mrbios_f <- unname(vapply(
+    strsplit(.mrbios_line, "\t", fixed = TRUE)[[1]], URLdecode, ""))
+  .mrbios_f <- .mrbios_f[-length(.mrbios_f)]
+  .mrbios_file <- .mrbios_f[3]
+  .mrbios_args <- .mrbios_f[-(1:3)]
+  cat("\x1eMRBIOS-START\n")
+  flush(stdout())
+  .mrbios_out <- file(.mrbios_f[1], open = "a")
+  sink(.mrbios_out)
+  sink(.mrbios_out, type = "message")
+  .mrbios_code <- tryCatch({
+    setwd(.mrbios_f[2])
+    .mrbios_env <- new.env(parent = globalenv())
+    .mrbios_env$quit <- .mrbios_quit
+    .mrbios_env$q <- .mrbios_quit
+    .mrbios_bind("commandArgs", .mrbios_script_args)
+    source(.mrbios_file, local = .mrbios_env)
+    0L
+  }, mrbios_quit = function(e) {
+    as.integer(e$status)
+  }, error = function(e) {
+    message("Error: ", conditionMessage(e))
+    1L
+  }, finally = .mrbios_bind("commandArgs", .mrbios_command_args))
+  sink(type = "message")
+  sink()
+  close(.mrbios_out)
+  cat("\x1eMRBIOS", .mrbios_code, sum(gc()[, 2]), sep = "\t")
+  cat("\n")
+  flush(stdout())
+}
+"""
+R_REPLY_MARKER = "\x1eMRBIOS\t"
+START_MARKER = "\x1eMRBIOS-START"
+
+
+class WorkerCrashed(RuntimeError):
+    """The worker process exited unexpectedly.
+
+    :param started: The script had started running when the worker
+    exited, it's not safe to run it again.
+    """
+    def __init__(self, msg: str, started: bool = False):
+        super().__init__(msg)
+        self.started = started
+
+
+class Worker():
+    """Long-lived process serving JSON requests over pipes,
+    one request at a time.
+
+    :param cmd: Command to start the worker.
+    :param environ: Environ of the worker.
+    """
+    def __init__(self, cmd: list[str], environ: dict[str, str] | None = None):
+        self.cmd = cmd
+        self.proc = subp.Popen(
+            cmd, env=environ, stdin=subp.PIPE, stdout=subp.PIPE,
+            text=True, bufsize=1)
+        self.n_calls = 0
+        # Close the worker instead of reusing it after the current call.
+        self.retire = False
+        # Memory used after the first call, reported by the worker.
+        self.base_memory_mb: float | None = None
+
+    @property
+    def is_alive(self) -> bool:
+        return self.proc.poll() is None
+
+    def send_line(self, line: str, marker: str = "") -> str:
+        """Send a request line and read the reply line,
+        lines without the marker are printed and skipped.
+
+        :raises WorkerCrashed: When the worker exited.
+        """
+        stdin = T.cast(T.TextIO, self.proc.stdin)
+        stdout = T.cast(T.TextIO, self.proc.stdout)
+        started = False
+        try:
+            stdin.write(line + "\n")
+            stdin.flush()
+            while True:
+                reply = stdout.readline()
+                if reply.startswith(START_MARKER):
+                    started = True
+                    continue
+                if (not reply) or reply.startswith(marker):
+                    break
+                sys.stderr.write(reply)
+        except (BrokenPipeError, OSError) as e:
+            raise WorkerCrashed(str(e), started)
+        if not reply:
+            self.proc.wait()
+            raise WorkerCrashed(
+                f"Worker exited with code {self.proc.returncode}.", started)
+        self.n_calls += 1
+        return reply[len(marker):].rstrip("\n")
+
+    def request(self, msg: dict) -> dict:
+        """Send a JSON request and wait for the response."""
+        return json.loads(self.send_line(json.dumps(msg, default=str)))
+
+    def close(self):
+        if self.is_alive:
+            T.cast(T.TextIO, self.proc.stdin).close()
+            try:
+                self.proc.wait(timeout=5)
+            except subp.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+
+
+class WorkerPool():
+    """Idle workers of the current process, keyed by the env.
+
+    A worker is taken out of the pool during a call, so concurrent calls
+    use different workers, new workers are started on demand.
+    """
+    def __init__(self) -> None:
+        self._idle: dict[str, list[Worker]] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def acquire(self, key: str, factory: T.Callable[[], Worker]):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            worker = idle.pop() if len(idle) > 0 else None
+        if (worker is None) or (not worker.is_alive):
+            worker = factory()
+        try:
+            yield worker
+        except BaseException:
+            worker.close()
+            raise
+        else:
+            if worker.retire:
+                worker.close()
+                return
+            with self._lock:
+                self._idle[key].append(worker)
+
+    def shutdown(self):
+        with self._lock:
+            workers = [w for ws in self._idle.values() for w in ws]
+            self._idle.clear()
+        for w in workers:
+            w.close()
+
+
+worker_pool = WorkerPool()
+atexit.register(worker_pool.shutdown)
+
+
+def _measure(
+        worker: Worker, usage: RunUsage | None,
+        cpus: list[int] | None = None) -> T.ContextManager:
+    """Bind the worker to the CPUs and measure the call."""
+    if cpus is not None:
+        set_process_affinity(worker.proc.pid, cpus)
+    if usage is None:
+        return nullcontext()
+    usage.mode = "worker"
+    return ProcessMonitor(worker.proc.pid, usage)
+
+
+def call_py_worker(
+        key: str, start_cmd: list[str], environ: dict[str, str],
+        module: Path, entry: str, kwargs: dict,
+        output: Path | None = None, usage: RunUsage | None = None,
+        cpus: list[int] | None = None, cwd: Path | None = None) -> int:
+    """Call the entry function of the script module in a warm
+    Python worker of the env.
+
+    :param key: Key of the worker, workers of the same key are reused.
+    :param start_cmd: Command to start the Python interpreter of the env.
+    :param output: File to capture the output of the call.
+    :param usage: Measure the resources used by the call into it.
+    :param cpus: Bind the worker to the CPUs during the call.
+    :param cwd: Working dir of the call, default is the current dir.
+    :return: Return code of the call.
+    :raises WorkerCrashed: When the worker exited during the call.
+    """
+    def factory() -> Worker:
+        console.log(f"Start Python worker of [note]{key}[/note]")
+        return Worker(start_cmd + ["-u", "-c", PY_WORKER_PROGRAM], environ)
+
+    with worker_pool.acquire(key, factory) as worker, \
+            _measure(worker, usage, cpus):
+        res = worker.request({
+            "module": str(module.absolute()),
+            "entry": entry,
+            "kwargs": kwargs,
+            "cwd": str(cwd or Path.cwd()),
+            "output": None if output is None else str(output),
+        })
+    if not res["ok"]:
+        console.log("[error]Script raised an error:[/error]")
+        console.log(res["error"], markup=False)
+    return res["code"]
+
+
+class RecyclePolicy(T.NamedTuple):
+    """When to replace a worker with a fresh one.
+
+    :param max_calls: Max number of the calls served by a worker.
+    :param max_memory_growth_mb: Max growth of the memory used
+    since the first call.
+    """
+    max_calls: int = 200
+    max_memory_growth_mb: float = 2048.0
+
+
+def call_r_worker(
+        key: str, start_cmd: list[str], environ: dict[str, str],
+        script: Path, args: list[str], output: Path,
+        policy: RecyclePolicy = RecyclePolicy(),
+        usage: RunUsage | None = None,
+        cpus: list[int] | None = None, cwd: Path | None = None) -> int:
+    """Source the R script with the arguments in a resident R session
+    of the env.
+
+    :param key: Key of the worker, workers of the same key are reused.
+    :param start_cmd: Command to start `Rscript` of the env.
+    :param output: File to capture the output of the call.
+    :param usage: Measure the resources used by the call into it.
+    :param cpus: Bind the worker to the CPUs during the call.
+    :param cwd: Working dir of the call, default is the current dir.
+    :return: Return code of the call.
+    :raises WorkerCrashed: When the worker exited during the call.
+    """
+    def factory() -> Worker:
+        console.log(f"Start R worker of [note]{key}[/note]")
+        return Worker(start_cmd + ["-e", R_WORKER_PROGRAM], environ)
+
+    fields = [str(output), str(cwd or Path.cwd()), str(script.absolute())] + \
+        args + ["END"]
+    line = "\t".join(urllib.parse.quote(f, safe="") for f in fields)
+    with worker_pool.acquire(key, factory) as worker:
+        with _measure(worker, usage, cpus):
+            reply = worker.send_line(line, R_REPLY_MARKER)
+        code, mem = reply.split("\t")
+        mem_mb = float(mem)
+        if worker.base_memory_mb is None:
+            worker.base_memory_mb = mem_mb
+        if (worker.n_calls >= policy.max_calls) or \
+                (mem_mb - worker.base_memory_mb >
+                 policy.max_memory_growth_mb):
+            console.log(f"Recycle the R worker of [note]{key}[/note]")
+            worker.retire = True
+    return int(code)
@@ -1,5 +1,14 @@
+from contextlib import contextmanager
+import threading
+import typing as T
+
 from rich.console import Console
+from rich.markup import escape
+from rich.progress import (
+    Progress, SpinnerColumn, TextColumn, TimeElapsedColumn,
+)
 from rich.prompt import Confirm, Prompt
+from rich.table import Table
 from rich.theme import Theme
 
 
@@ -18,6 +27,7 @@ class CustomConsole():
     def __init__(self):
         self.console = Console(theme=self.theme)
         self.use_log_as_print = False
+        self._local = threading.local()
 
     def log(self, msg: str = "", **kwargs):
         if self.use_log_as_print:
@@ -25,14 +35,55 @@ class CustomConsole():
         else:
             self.console.log(msg, **kwargs)
 
-    def print(self, msg: str = "", **kwargs):
+    def print(self, msg: str | Table = "", **kwargs):
         self.console.print(msg, **kwargs)
 
     def status(self, *args, **kwargs):
         return self.console.status(*args, **kwargs)
 
+    @contextmanager
+    def tail_to(self, sink: T.Callable[[str], None]):
+        """Send the live tail lines of the current thread to the sink,
+        e.g. a row of the progress display."""
+        self._local.sink = sink
+        try:
+            yield
+        finally:
+            self._local.sink = None
+
+    @contextmanager
+    def tail(self, title: str):
+        """Show the last line of a running command, yield a function
+        to update the line. The lines are shown as plain text,
+        the title is markup."""
+        sink = getattr(self._local, "sink", None)
+        if sink is not None:
+            yield sink
+            return
+        with self.console.status(title) as status:
+            def show(line: str):
+                status.update(f"{title}: {escape(line[:100])}")
+            yield show
+
+    def progress(self) -> Progress:
+        """Live multi-row progress display, one row per job."""
+        return Progress(
+            SpinnerColumn(finished_text="-"),
+            TextColumn("[note]{task.description}[/note]"),
+            TextColumn("{task.fields[status]}"),
+            TimeElapsedColumn(),
+            console=self.console,
+        )
+
+    def table(self, title: str, columns: list[str]) -> Table:
+        """Table for summary reports, print it with `console.print`."""
+        table = Table(title=title, title_justify="left")
+        for col in columns:
+            table.add_column(col)
+        return table
+
 
 console = CustomConsole()
 
 
-__all__ = ["console", "Confirm", "Prompt"]
+__all__ = ["console", "escape", "Confirm", "Prompt"]
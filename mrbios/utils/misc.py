@@ -1,6 +1,22 @@
 import shutil
 import datetime
+import json
+import os
+import threading
+import typing as T
 from pathlib import Path
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None  # type: ignore
+
+
+NETWORK_FS_TYPES = (
+    "nfs", "nfs4", "cifs", "smb3", "smbfs", "lustre", "gpfs", "beegfs",
+    "ceph", "glusterfs", "fuse.sshfs", "9p",
+)
 
 
 def command_exist(command: str) -> bool:
@@ -19,3 +35,56 @@ def file_has_changed_after(
     if not file_path.exists():
         raise FileNotFoundError(f"File not found: {file_path}")
     return file_path.stat().st_mtime > time_point.timestamp()
+
+
+@contextmanager
+def file_lock(path: str | Path) -> T.Iterator[None]:
+    """Exclusive lock shared between threads and processes,
+    based on `flock` of a lock file. No-op on platforms without `fcntl`."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def dump_json_atomic(value: T.Any, path: str | Path):
+    """Write json to a temporary file then rename it to the target path,
+    so concurrent readers never see a partial file."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(
+        f".{path.name}.{os.getpid()}-{threading.get_ident()}.tmp")
+    with open(tmp, 'w') as f:
+        json.dump(value, f, indent=4)
+    os.replace(tmp, path)
+
+
+def fs_type(path: str | Path, mounts: str = "/proc/mounts") -> str | None:
+    """Type of the file system the path is on, None when unknown."""
+    path = os.path.realpath(path)
+    best, fstype = "", None
+    try:
+        with open(mounts) as f:
+            for line in f:
+                items = line.split()
+                if len(items) < 3:
+                    continue
+                mnt = items[1].replace("\\040", " ")
+                inside = (path == mnt) or \
+                    path.startswith(mnt.rstrip("/") + "/")
+                if inside and (len(mnt) >= len(best)):
+                    best, fstype = mnt, items[2]
+    except OSError:
+        return None
+    return fstype
+
+
+def is_network_fs(path: str | Path) -> bool:
+    """Check if the path is on a network file system, like NFS."""
+    return fs_type(path) in NETWORK_FS_TYPES
@@ -1,12 +1,39 @@
 import shutil
 import io
+import json
+import os
+import time
+import sys
+import subprocess as subp
 from subprocess import CalledProcessError
+from datetime import datetime, timedelta
 
 import pytest
 
 from mrbios.cli import CLI
 from mrbios.utils.misc import command_exist
-from mrbios.core.env_build import RConfig
+from mrbios.utils.log import console
+from mrbios.core.env_build import (
+    RConfig, CondaConfig, CondaEnvBuild, PipConfig,
+    CondaBackend, MicromambaBackend, get_backend,
+)
+from mrbios.core.project import Project
+from mrbios.core.env_snapshot import EnvSnapshot
+from mrbios.core.env_registry import EnvRegistry
+from mrbios.core.build_pool import EnvBuildPool
+from mrbios.core.env_update import BuildDiff, github_spec_name
+from mrbios.core.env_lock import EnvLock
+from mrbios.core.env_cache import SharedEnvCache
+from mrbios.core.env_pack import pack_env, unpack_env
+from mrbios.core.r_cache import RPackageCache
+from mrbios.core.pip_install import installed_distributions, is_satisfied
+from mrbios.core.build_profile import (
+    BuildProfile, add_build_record, summarize_history,
+)
+from mrbios.core.r_install import parse_r_spec, RInstallResult
+from mrbios.core.build_log import BuildLog, BuildCommandError
+from mrbios.core.run_stats import wait_process
+from mrbios.core.solve_cache import SolveCache, solve_key, repodata_stamp
 
 
 def test_command_exist():
@@ -36,6 +63,8 @@ def test_build_env(monkeypatch, test_proj_path, cli: "CLI"):
     env_build.build_all()
     assert env_build._proj.get_envs()['test1'].is_built
     assert env_build._proj.get_envs()['test2'].is_built
+    assert len(env_test1.build_history) > 0
+    env_build.stats()
     env_build.run("pip install h5py", "test1")
     with pytest.raises(CalledProcessError):
         env_build.run("not_exist_command", "test1")
@@ -84,6 +113,14 @@ def test_RConfig():
     conf.get_cran_command()
     conf.get_bioconductor_command()
     conf.get_devtools_command()
+    program = conf.get_install_program()
+    assert "options(Ncpus" in program
+    assert (".mrbios_install('bioconductor', "
+            "c('GenomicRanges', 'DESeq2')") in program
+    assert (".mrbios_install('github', c('devtools', 'httr'), "
+            "c('hadley/devtools', 'hadley/httr'), c(NA, NA)") in program
+    assert parse_r_spec("Seurat (>= 4.0)") == ("Seurat", ">=", "4.0")
+    assert parse_r_spec("optparse") == ("optparse", None, None)
 
 
 def test_update_env(test_proj_path: str):
@@ -96,12 +133,370 @@ def test_update_env(test_proj_path: str):
     env_build.build_all()
     test1_env = project._proj.get_envs()['test1']
     test1_config = test1_env.build_config
+    state_hash = test1_env.state_hash
     test1_config.config['pip']['deps'] = ['h5py']
     test1_config.write_to_config_file(
         f"{test1_env.path}/build.yaml"
     )
     env_build.update_all()
     env_build.run("python -c 'import h5py'", "test1")
+    # the lock is recaptured
+    assert test1_env.state_hash != state_hash
     env_build.update("test2")
     env_build.clear_all()
     shutil.rmtree(test_proj_path)
+
+
+def test_env_snapshot(tmp_path):
+    conda_config = CondaConfig("base", {"direct_run": True})
+    snapshot = EnvSnapshot(tmp_path / ".env_snapshot.json", conda_config)
+    assert not snapshot.is_valid
+    environ = snapshot.get_environ()
+    assert snapshot.is_valid
+    assert "CONDA_PREFIX" in environ
+    assert environ == snapshot.get_environ()
+    conda_config.run_with_environ(["python", "--version"], environ)
+    snapshot.invalidate()
+    assert not snapshot.is_exist
+
+
+def test_env_registry(tmp_path):
+    registry = EnvRegistry(cache_path=tmp_path / "env_registry.json")
+    assert registry.is_built("base")
+    assert not registry.is_built("not_exist_env")
+    assert registry.cache_path.exists()
+    # load from the disk cache
+    registry2 = EnvRegistry(cache_path=tmp_path / "env_registry.json")
+    assert registry2.get_prefix("base") == registry.get_prefix("base")
+    registry.invalidate()
+    assert not registry.cache_path.exists()
+
+
+def test_env_build_pool():
+    def fail():
+        raise RuntimeError("build failed")
+
+    done = []
+    pool = EnvBuildPool(2)
+    errors = pool.run({
+        "env1": lambda: done.append("env1"),
+        "env2": fail,
+        "env3": lambda: done.append("env3"),
+    })
+    assert sorted(done) == ["env1", "env3"]
+    assert list(errors.keys()) == ["env2"]
+
+
+def test_build_diff():
+    old = {
+        "conda": {"channels": ["conda-forge"], "deps": ["python==3.10"]},
+        "pip": {"deps": ["fire", "ipdb"]},
+        "R": {"github": {"deps": ["hadley/devtools"]}},
+    }
+    new = {
+        "conda": {
+            "channels": ["conda-forge"],
+            "deps": ["python==3.10", "samtools"]},
+        "pip": {"deps": ["fire==0.5.0", "h5py"]},
+        "R": {"cran": {"deps": ["optparse"]}},
+    }
+    diff = BuildDiff(old, new)
+    assert not diff.need_rebuild
+    assert diff.conda.added == ["samtools"]
+    assert diff.pip.added == ["fire==0.5.0", "h5py"]
+    assert diff.pip.removed == ["ipdb"]
+    assert diff.r["cran"].added == ["optparse"]
+    assert diff.r["github"].removed == ["hadley/devtools"]
+    assert BuildDiff(old, old).is_empty
+    new["conda"]["deps"] = ["python==3.11"]
+    assert BuildDiff(old, new).need_rebuild
+    assert github_spec_name("hadley/devtools@v2.4.5") == "devtools"
+    assert github_spec_name("user/repo/sub/pkg@main") == "pkg"
+    with pytest.raises(ValueError, match="devtools"):
+        github_spec_name("devtools")
+
+
+def test_env_lock(tmp_path):
+    build = CondaEnvBuild("TestProj", {"name": "base"})
+    build.conda_config = CondaConfig("base", {})
+    lock = EnvLock(tmp_path / "lock", build)
+    assert not lock.is_exist
+    lock.capture()
+    assert lock.is_exist
+    with open(lock.explicit_path) as f:
+        assert "@EXPLICIT" in f.read()
+    assert not lock.pip_path.exists()
+    assert not lock.r_path.exists()
+
+
+def test_shared_env_cache(tmp_path):
+    config = {
+        "name": "test", "shared": True,
+        "conda": {"deps": ["python==3.10", "samtools"]},
+    }
+    build1 = CondaEnvBuild("Proj1", config)
+    build2 = CondaEnvBuild("Proj2", {
+        "name": "test2", "shared": "link",
+        "conda": {"deps": ["samtools", "python==3.10"]},
+    })
+    assert build1.config_hash == build2.config_hash
+    assert build1.conda_config.env_name == build2.conda_config.env_name
+    cache = SharedEnvCache(tmp_path)
+    hash_ = build1.config_hash
+    env_path = tmp_path / "Proj1" / "Environments" / "test"
+    cache.add_user(hash_, build1.env_name, env_path)
+    assert cache.has_user(hash_, build1.env_name)
+    env_path.mkdir(parents=True)
+    build1.write_to_config_file(env_path / "build.yaml")
+    cache.gc()
+    assert cache.has_user(hash_, build1.env_name)
+    cache.remove_user(build1.env_name)
+    assert not cache.has_user(hash_, build1.env_name)
+    cache.gc()
+    assert cache.load() == {}
+
+
+def test_update_shared_env(monkeypatch, tmp_path):
+    cache = SharedEnvCache(tmp_path / "shared")
+    monkeypatch.setattr("mrbios.core.env_build.shared_env_cache", cache)
+    monkeypatch.setattr(CondaConfig, "is_built", property(lambda s: True))
+    proj = Project(tmp_path / "proj")
+    proj.create()
+    proj.add_env("py-env", "py-env")
+    env = proj.get_envs()["py-env"]
+    build = env.build_config
+    build.config["shared"] = "link"
+    build.write_to_config_file(env.path / "build.yaml")
+    build = env.build_config
+    assert not env.is_built
+    cache.add_user(build.config_hash, build.env_name, env.path)
+    assert env.is_built
+    info = env.meta_info
+    info["build-time"] = str(datetime.now() - timedelta(seconds=10))
+    info["build-spec"] = build.config
+    env.meta_info = info
+    old_hash = build.config_hash
+    old_name = build.conda_config.env_name
+    # edit the deps after the build
+    build.config["pip"] = {"deps": ["h5py"]}
+    build.write_to_config_file(env.path / "build.yaml")
+    new_build = env.build_config
+    assert new_build.config_hash != old_hash
+    assert env.is_built
+    # still an alias of the shared env it was built with
+    assert new_build.conda_config.env_name == old_name
+    cache.gc()
+    assert cache.has_user(old_hash, build.env_name)
+    calls = []
+    monkeypatch.setattr(
+        type(env), "_update_from_diff", lambda s: calls.append("diff"))
+    monkeypatch.setattr(
+        type(env), "build", lambda s, *a, **kw: calls.append("build"))
+    env.update()
+    assert calls == ["diff"]
+
+
+def test_pack_unpack_env(monkeypatch, tmp_path):
+    monkeypatch.setattr(
+        "mrbios.core.env_pack.ENVIRONMENTS_TXT_PATH",
+        tmp_path / "environments.txt")
+    prefix = tmp_path / "envs" / "a_long_prefix_for_test"
+    (prefix / "conda-meta").mkdir(parents=True)
+    (prefix / "bin").mkdir()
+    (prefix / "lib").mkdir()
+    old = str(prefix).encode()
+    with open(prefix / "conda-meta" / "pkg-1.0-0.json", "w") as f:
+        json.dump({"paths_data": {"paths": [
+            {"_path": "lib/libx.so", "prefix_placeholder": "/opt/x",
+             "file_mode": "binary"},
+            {"_path": "lib/x.cfg", "prefix_placeholder": "/opt/x",
+             "file_mode": "text"},
+        ]}}, f)
+    (prefix / "lib" / "libx.so").write_bytes(b"\x01" + old + b"/lib\0\x02")
+    (prefix / "lib" / "x.cfg").write_bytes(b"path=" + old + b"/share\n")
+    (prefix / "bin" / "tool").write_bytes(b"#!" + old + b"/bin/python\n")
+    archive = tmp_path / "env.tar.gz"
+    pack_env(prefix, "test-env", archive)
+    assert archive.exists()
+    monkeypatch.setattr("mrbios.core.env_pack.envs_dirs", lambda: [])
+    # conda can't find the env by name outside the envs dirs
+    with pytest.raises(ValueError):
+        unpack_env(archive, tmp_path / "opt" / "short")
+    assert not (tmp_path / "opt").exists()
+    dest = tmp_path / "e" / "envs" / "short"
+    assert unpack_env(archive, dest) == dest.absolute()
+    new = str(dest.absolute()).encode()
+    libx = (dest / "lib" / "libx.so").read_bytes()
+    assert len(libx) == len(old) + 7
+    assert libx.startswith(b"\x01" + new + b"/lib\0")
+    assert (dest / "lib" / "x.cfg").read_bytes() == \
+        b"path=" + new + b"/share\n"
+    assert (dest / "bin" / "tool").read_bytes().startswith(b"#!" + new)
+    assert str(dest.absolute()) in \
+        (tmp_path / "environments.txt").read_text()
+    with pytest.raises(IOError):
+        unpack_env(archive, dest)
+    # a longer prefix can't be relocated, nothing is left at the target
+    long_dest = tmp_path / "e" / "envs" / ("a_much_longer_prefix" * 3)
+    with pytest.raises(ValueError):
+        unpack_env(archive, long_dest)
+    assert not long_dest.exists()
+    assert [p.name for p in (tmp_path / "e" / "envs").iterdir()] == \
+        ["short"]
+
+
+def test_r_package_cache(tmp_path):
+    assert RPackageCache.from_config(None) is None
+    cache = RPackageCache.from_config({
+        "path": str(tmp_path), "max_size_gb": 1.5 / 1024**3})
+    assert cache is not None
+    key_dir = tmp_path / "R-4.1.2-x86_64-conda-linux-gnu"
+    for i, name in enumerate(["a_1.0", "b_1.0", "c_1.0"]):
+        entry = key_dir / name / name.split("_")[0]
+        entry.mkdir(parents=True)
+        (entry / "DESCRIPTION").write_bytes(b"x")
+        os.utime(key_dir / name, (i, i))
+    removed = cache.evict()
+    assert [e.name for e in removed] == ["a_1.0", "b_1.0"]
+    assert [e.name for e in cache.entries()] == ["c_1.0"]
+
+
+def test_pip_config(tmp_path):
+    conf = PipConfig(
+        {"deps": ["fire"], "installer": "uv", "wheelhouse": True},
+        tmp_path / ".wheelhouse")
+    assert conf.wheelhouse == tmp_path / ".wheelhouse"
+    cmd = conf.get_install_command(wheelhouse=conf.wheelhouse)
+    assert cmd[:3] == ["uv", "pip", "install"]
+    assert "--no-index" in cmd
+    assert conf.get_wheel_command(["fire"], tmp_path)[:2] == ["pip", "wheel"]
+    site = tmp_path / "lib" / "python3.10" / "site-packages"
+    dist_info = site / "Fire-0.5.0.dist-info"
+    dist_info.mkdir(parents=True)
+    (dist_info / "METADATA").write_text("Name: Fire\nVersion: 0.5.0\n\n")
+    dists = installed_distributions(tmp_path)
+    assert dists == {"fire": "0.5.0"}
+    assert is_satisfied("fire", dists)
+    assert is_satisfied("fire>=0.4", dists)
+    assert not is_satisfied("fire==0.4.0", dists)
+    assert not is_satisfied("h5py", dists)
+
+
+def test_conda_backend(monkeypatch):
+    conda, micromamba = CondaBackend(), MicromambaBackend()
+    assert conda.run_cmd("e", ["ls"])[:2] == ["conda", "run"]
+    assert micromamba.run_cmd("e", ["ls"]) == \
+        ["micromamba", "run", "-n", "e", "ls"]
+    assert conda.clone_cmd("e", "src") is not None
+    assert micromamba.clone_cmd("e", "src") is None
+    assert "export" in micromamba.list_explicit_cmd("e")
+    assert micromamba.create_cmd("create", "e", ["bioconda"], ["python"]) \
+        == ["micromamba", "create", "-n", "e", "-c", "bioconda",
+            "python", "--yes"]
+    monkeypatch.setattr(
+        "mrbios.core.env_build.command_exist",
+        lambda c: c == "micromamba")
+    assert isinstance(get_backend("auto"), MicromambaBackend)
+    assert isinstance(get_backend("conda"), MicromambaBackend)
+    config = CondaConfig("e", {"install_command": "auto"})
+    assert config.backend.manager == "micromamba"
+    assert config.registry.list_cmd[0] == "micromamba"
+
+
+def test_build_profile(tmp_path):
+    profile = BuildProfile(pkgs_dirs=[tmp_path])
+    with profile.phase("conda create", count_download=True):
+        (tmp_path / "a-1.0-0.conda").write_bytes(b"0" * 100)
+    with profile.phase("R"):
+        profile.add_r_results([
+            RInstallResult("DESeq2", "bioconductor", "installed", 30.0, ""),
+            RInstallResult("ggplot2", "cran", "installed", 10.0, ""),
+        ])
+    assert [p["name"] for p in profile.phases] == ["conda create", "R"]
+    assert profile.phases[0]["bytes"] == 100
+    assert "bytes" not in profile.phases[1]
+    # the CPU time of the commands run in the phase
+    with profile.phase("busy"):
+        wait_process(subp.Popen([
+            sys.executable, "-c", "sum(range(3 * 10**7))"]), profile.usage)
+    assert profile.phases[2]["cpu"] > 0
+    # the downloads of the overlapped phases are unknown
+    other = BuildProfile(pkgs_dirs=[tmp_path])
+    with profile.phase("conda install", count_download=True), \
+            other.phase("conda install", count_download=True):
+        (tmp_path / "b-1.0-0.conda").write_bytes(b"0" * 100)
+    assert "bytes" not in profile.phases[3]
+    assert "bytes" not in other.phases[0]
+    meta: dict = {}
+    for _ in range(60):
+        add_build_record(meta, profile.to_record("build"))
+    assert len(meta["build-history"]) == 50
+    stats = summarize_history(
+        {"e1": meta["build-history"], "e2": []}, top=1)
+    assert len(stats.phases) == 1
+    assert stats.packages[0][1] == "DESeq2"
+    assert len(stats.trend) == 50
+
+
+def test_solve_cache(tmp_path):
+    cache_dir = tmp_path / "pkgs" / "cache"
+    cache_dir.mkdir(parents=True)
+    url = "https://conda.anaconda.org/conda-forge/linux-64/repodata.json"
+    with open(cache_dir / "a.info.json", 'w') as f:
+        json.dump({"url": url, "etag": "e1", "mod": "m1"}, f)
+    (cache_dir / "b.json").write_text(
+        '{"_url": "https://conda.anaconda.org/bioconda/noarch", '
+        '"_etag": "e2", "_mod": "m2", "packages": {}}')
+    pkgs_dirs = [tmp_path / "pkgs"]
+    stamp = repodata_stamp(["conda-forge"], pkgs_dirs)
+    assert stamp == [f"{url} e1 m1"]
+    assert len(repodata_stamp([], pkgs_dirs)) == 2
+    key = solve_key(["conda-forge"], ["python", "numpy"], stamp)
+    assert key == solve_key(["conda-forge"], ["numpy", "python"], stamp)
+    assert key != solve_key(["conda-forge"], ["numpy"], stamp)
+    assert key != solve_key(["conda-forge"], ["python", "numpy"], [])
+    cache = SolveCache(tmp_path / "solve", max_entries=2)
+    assert cache.get(key) is None
+    cache.put(key, "@EXPLICIT\nhttps://example.com/a.conda\n")
+    assert "@EXPLICIT" in cache.get(key).read_text()
+    for i in range(3):
+        cache.put(f"k{i}", "@EXPLICIT\n")
+    assert len(cache.entries()) == 2
+    assert cache.get(key) is None
+    # expired entries are solved again
+    assert cache.get("k2") is not None
+    cache.max_age = 0
+    time.sleep(0.01)
+    assert cache.get("k2") is None
+    assert not cache.entry_path("k2").exists()
+
+
+def test_build_log(tmp_path):
+    logs_dir = tmp_path / "logs"
+    log = BuildLog.start(logs_dir, "build", max_bytes=1000, tail_lines=3)
+    lines = []
+    with console.tail_to(lines.append):
+        log.run(["python", "-c", "for i in range(500): print(i)"])
+    assert list(log.tail) == ["497", "498", "499"]
+    assert len(lines) == 500
+    with pytest.raises(BuildCommandError) as e:
+        log.run(["python", "-c", "print('oops'); exit(3)"])
+    assert e.value.tail[-1] == "oops"
+    assert str(log.path) in str(e.value)
+    # the output is not markup
+    log.run(["python", "-c", "print('[/opt/conda]')"])
+    assert log.tail[-1] == "[/opt/conda]"
+
+    # the command is killed when the display fails
+    def fail(line):
+        raise RuntimeError(line)
+    with console.tail_to(fail), pytest.raises(RuntimeError):
+        log.run(["python", "-c", "print('x', flush=True); "
+                 "import time; time.sleep(60)"])
+    log.close()
+    parts = list(logs_dir.glob(log.path.name + ".*.gz"))
+    assert 0 < len(parts) <= 5
+    for _ in range(12):
+        BuildLog.start(logs_dir, "build", keep=3).write(b"x")
+    assert len(list(logs_dir.glob("*.log"))) == 1
+    assert len(list(logs_dir.glob("*.log.gz"))) == 3
@@ -1,9 +1,44 @@
 import shutil
+import shlex
+import gzip
+import json
+import subprocess
 import os
+import asyncio
+import time
+import sys
+from subprocess import CalledProcessError
 from pathlib import Path
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from cmd2func import cmd2func
 
 from mrbios.cli import CLI, EnvBuild
 from mrbios.core.env_build import CondaEnvBuild
+from mrbios.core.project import Project
+from mrbios.core.runner import (
+    interface_cache, ScriptRunner, CompiledInterface,
+)
+from mrbios.core.shard import ShardSpec, split_file, merge_outputs
+from mrbios.core.resource_pool import (
+    ResourcePool, parse_memory, bind_cpus, available_cpus,
+)
+from mrbios.core.scratch import ScratchSpace, move_atomic
+from mrbios.core.run_cache import RunCache
+from mrbios.core.batch import BatchRun, load_batch_params
+from mrbios.core.async_run import RunHandle
+from mrbios.core.run_stats import (
+    RunUsage, wait_process, summarize_runs, percentile,
+)
+from mrbios.core.run_history import (
+    RunHistory, export_runs, summarize_runs_by, parse_time,
+)
+from mrbios.core.worker import (
+    call_py_worker, call_r_worker, worker_pool, WorkerCrashed, RecyclePolicy,
+)
+from mrbios.utils.misc import command_exist, fs_type
 
 
 
@@ -72,3 +107,694 @@ def test_R_script_run(cli: "CLI", test_proj_path: str):
     )
     assert test_out.exists()
     clear_stuff(env_build, test_out, test_proj_path)
+
+
+def test_run_cache(tmp_path):
+    cache = RunCache(tmp_path / "cache", max_size_gb=1e-6)
+    script_dir = tmp_path / "script"
+    script_dir.mkdir()
+    (script_dir / "run.py").write_text("print('hello')")
+    in_file = tmp_path / "in.txt"
+    in_file.write_text("input")
+    out_file = tmp_path / "out.txt"
+    out_dir = tmp_path / "out_dir"
+    args = {"input": str(in_file), "out": str(out_file), "dir": str(out_dir)}
+    outputs = ["out", "dir"]
+    key = cache.make_key(script_dir, args, outputs, "env")
+    assert key == cache.make_key(
+        script_dir, dict(args, out="other.txt"), outputs, "env")
+    assert key != cache.make_key(script_dir, args, outputs, "env2")
+    assert cache.get(key) is None
+    out_file.write_text("result")
+    (out_dir / "sub").mkdir(parents=True)
+    (out_dir / "sub" / "a.txt").write_text("a")
+    cache.put(key, args, outputs)
+    out_file.unlink()
+    shutil.rmtree(out_dir)
+    entry = cache.get(key)
+    assert entry is not None
+    cache.restore(entry, args)
+    assert out_file.read_text() == "result"
+    assert (out_dir / "sub" / "a.txt").read_text() == "a"
+    # the restored outputs are writable copies of the objects
+    assert out_file.stat().st_nlink == 1
+    out_file.write_text("new")
+    assert cache.object_path(entry["outputs"]["out"]["hash"]).read_text() \
+        == "result"
+    cache.prepare_outputs(args, outputs)
+    assert out_file.exists()
+    in_file.write_text("changed")
+    assert key != cache.make_key(script_dir, args, outputs, "env")
+    # a 1KB cap, both entries fit
+    key2 = cache.make_key(script_dir, args, outputs, "env")
+    out_file.write_text("result2")
+    cache.put(key2, args, outputs)
+    assert len(cache.evict(dry_run=True)) == 0
+    assert len(cache.evict(max_size_gb=0)) == 2
+    assert cache.get(key) is None
+    assert list(cache.objects_path.glob("*/*")) == []
+
+
+class FakeRunner():
+    output_names = ["out"]
+
+    def __init__(self, calls: list):
+        self.calls = calls
+        self.log = None
+
+    def run(self, name, out):
+        self.calls.append(name)
+        self.log.run(["echo", name])
+        if name == "bad":
+            raise CalledProcessError(2, ["run"])
+        Path(out).write_text(name)
+
+
+def test_batch_run(tmp_path):
+    params = tmp_path / "params.tsv"
+    params.write_text(
+        "name\tout\n"
+        f"a\t{tmp_path / 'a.txt'}\n"
+        f"bad\t{tmp_path / 'bad.txt'}\n"
+        f"b\t{tmp_path / 'b.txt'}\n")
+    rows = load_batch_params(params)
+    assert rows[0] == {"name": "a", "out": str(tmp_path / "a.txt")}
+    calls: list = []
+    summary = tmp_path / "summary.tsv"
+    batch = BatchRun(lambda: FakeRunner(calls), rows, summary, n_jobs=2)
+    results = batch.run()
+    assert [results[i]["status"] for i in range(3)] == \
+        ["done", "failed", "done"]
+    assert results[1]["exit_code"] == 2
+    assert (tmp_path / "b.txt").read_text() == "b"
+    assert "bad" in Path(results[1]["log"]).read_text()
+    # resume, only the failed row runs again
+    calls.clear()
+    batch = BatchRun(lambda: FakeRunner(calls), rows, summary)
+    batch.run()
+    assert calls == ["bad"]
+    yaml_params = tmp_path / "params.yaml"
+    yaml_params.write_text("- {name: a, out: a.txt}\n")
+    assert load_batch_params(yaml_params) == [{"name": "a", "out": "a.txt"}]
+
+
+def alive_in_group(pgid: int) -> list[int]:
+    pids = []
+    for stat in Path("/proc").glob("[0-9]*/stat"):
+        try:
+            fields = stat.read_text().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[2]) == pgid and fields[0] != "Z":
+            pids.append(int(stat.parent.name))
+    return pids
+
+
+def test_run_handle():
+    async def stream():
+        handle = await RunHandle.start([
+            "sh", "-c", "echo a; echo b; echo err >&2; exit 3"])
+        lines = [line async for line in handle.stdout()]
+        errs = [line async for line in handle.stderr()]
+        return lines, errs, await handle.wait()
+    assert asyncio.run(stream()) == (["a", "b"], ["err"], 3)
+
+    async def timeout():
+        handle = await RunHandle.start(
+            ["sh", "-c", "sleep 30 & sleep 30"], timeout=0.5)
+        with pytest.raises(TimeoutError):
+            await handle.wait()
+        return handle
+    handle = asyncio.run(timeout())
+    assert handle.timed_out
+    assert alive_in_group(handle.pid) == []
+
+    async def read_only():
+        # the timeout applies without awaiting `wait`
+        handle = await RunHandle.start(
+            ["sh", "-c", "echo start; sleep 30"], timeout=0.5)
+        lines = [line async for line in handle.stdout()]
+        await handle.proc.wait()
+        return lines, handle.timed_out
+    assert asyncio.run(read_only()) == (["start"], True)
+
+    async def cancel():
+        handle = await RunHandle.start(["sleep", "30"])
+        task = asyncio.ensure_future(handle.wait())
+        await asyncio.sleep(0.2)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await handle.proc.wait()
+        return handle.returncode
+    assert asyncio.run(cancel()) == -9
+
+
+def test_py_worker(tmp_path):
+    module = tmp_path / "run.py"
+    module.write_text(
+        "import os\n"
+        "def main(name, out):\n"
+        "    print('pid', os.getpid())\n"
+        "    if name == 'crash':\n"
+        "        os._exit(1)\n"
+        "    if name == 'error':\n"
+        "        raise ValueError(name)\n"
+        "    with open(out, 'w') as f:\n"
+        "        f.write(name)\n")
+    cmd = [sys.executable]
+
+    def call(name, output=None):
+        return call_py_worker(
+            "test", cmd, dict(os.environ), module, "main",
+            {"name": name, "out": tmp_path / "out.txt"}, output)
+    assert call("a") == 0
+    assert (tmp_path / "out.txt").read_text() == "a"
+    output = tmp_path / "output.log"
+    assert call("b", output) == 0
+    pid = output.read_text().split()[1]
+    assert call("c", output) == 0
+    # the same worker serves the calls
+    assert output.read_text().split()[3] == pid
+    assert call("error") == 1
+    with pytest.raises(WorkerCrashed) as e:
+        call("crash")
+    # not safe to rerun the script
+    assert e.value.started
+    assert call("d") == 0
+    # the helper modules are reloaded when they changed
+    script_dir = tmp_path / "script"
+    script_dir.mkdir()
+    (script_dir / "helper.py").write_text("VALUE = '1'\n")
+    (script_dir / "run.py").write_text(
+        "import helper\n"
+        "def main(out):\n"
+        "    open(out, 'w').write(helper.VALUE)\n")
+    out = tmp_path / "helper.txt"
+    for value in ["1", "22"]:
+        (script_dir / "helper.py").write_text(f"VALUE = '{value}'\n")
+        assert call_py_worker(
+            "test", cmd, dict(os.environ), script_dir / "run.py", "main",
+            {"out": out}) == 0
+        assert out.read_text() == value
+    assert not (script_dir / "__pycache__").exists()
+    # the helper modules of another script dir don't collide
+    other_dir = tmp_path / "other"
+    other_dir.mkdir()
+    (other_dir / "helper.py").write_text("VALUE = 'other'\n")
+    shutil.copy(script_dir / "run.py", other_dir / "run.py")
+    for d, value in [(other_dir, "other"), (script_dir, "22")] * 2:
+        assert call_py_worker(
+            "test", cmd, dict(os.environ), d / "run.py", "main",
+            {"out": out}) == 0
+        assert out.read_text() == value
+    worker_pool.shutdown()
+
+
+FAKE_R_WORKER = """
+import sys, os
+from urllib.parse import unquote
+mem = 100
+for line in sys.stdin:
+    f = [unquote(x) for x in line.rstrip("\\n").split("\\t")][:-1]
+    with open(f[0], "a") as out:
+        out.write(" ".join(f[3:]) + " " + str(os.getpid()))
+    print("noise")
+    mem += 600
+    print("\\x1eMRBIOS\\t0\\t" + str(mem), flush=True)
+"""
+
+
+def test_r_worker_recycle(tmp_path):
+    fake = tmp_path / "fake_r.py"
+    fake.write_text(FAKE_R_WORKER)
+    cmd = [sys.executable, str(fake)]
+    policy = RecyclePolicy(max_calls=10, max_memory_growth_mb=1000)
+    pids = []
+    for i in range(4):
+        output = tmp_path / f"out{i}.log"
+        code = call_r_worker(
+            "test-r", cmd, dict(os.environ), tmp_path / "run.R",
+            ["--name", "a b", ""], output, policy)
+        assert code == 0
+        text = output.read_text()
+        assert text.startswith("--name a b ")
+        pids.append(text.split()[-1])
+    # recycled after the memory grew more than 1000Mb
+    assert pids[0] == pids[1] == pids[2] != pids[3]
+    worker_pool.shutdown()
+
+
+@pytest.mark.skipif(not command_exist("Rscript"), reason="R not installed")
+def test_r_worker(tmp_path):
+    script = tmp_path / "run.R"
+    script.write_text(
+        "args <- commandArgs(TRUE)\n"
+        "# the form used by optparse and the other packages\n"
+        "stopifnot(identical(args, base::commandArgs(trailingOnly = TRUE)))\n"
+        "cat(args[2], Sys.getpid(), '\\n')\n"
+        "if (args[2] == 'error') stop('oops')\n"
+        "if (args[2] == 'quit') quit(status = 3)\n")
+    outputs = []
+    codes = {"error": 1, "quit": 3}
+    for name in ["a", "b", "error", "quit", "c"]:
+        output = tmp_path / f"{name}.log"
+        code = call_r_worker(
+            "test-R", ["Rscript"], dict(os.environ), script,
+            ["--name", name], output)
+        assert code == codes.get(name, 0)
+        outputs.append(output.read_text().split())
+    # quit ends the script, not the session
+    assert outputs[0][1] == outputs[1][1] == outputs[4][1]
+    assert "oops" in outputs[2]
+    worker_pool.shutdown()
+
+
+def test_interface_cache(tmp_path):
+    proj = Project(tmp_path / "proj")
+    proj.create()
+    proj.add_env("py-env", "py-env")
+    proj.add_task("TestTask", "Test")
+    proj.add_script("TestTask", "TestScript", "py-script", "Test")
+    script = proj.get_scripts("TestTask")["TestScript"]
+    interface_cache.clear()
+    r1, r2 = script.runner, script.runner
+    assert r1.compiled is r2.compiled
+    assert "run.py" in r1.get_local_files()
+    assert r1.command_template == r2.command_template
+    # a new file in the script dir
+    (script.path / "utils.py").write_text("")
+    r3 = script.runner
+    assert r3.compiled is not r1.compiled
+    assert "utils.py" in r3.get_local_files()
+    # interface changed
+    interface = script.path / "interface.yaml"
+    st = interface.stat()
+    interface.write_text(interface.read_text().replace("run.py", "utils.py"))
+    os.utime(interface, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    r4 = script.runner
+    assert r4.compiled is not r3.compiled
+    assert "utils.py" in r4.command_template
+
+
+def test_run_stats(tmp_path):
+    # the grandchild holds ~64MB, the child burns some CPU
+    code = (
+        "import subprocess, sys\n"
+        "p = subprocess.Popen([sys.executable, '-c', "
+        "'import time; b = bytearray(64 * 2**20); time.sleep(0.6)'])\n"
+        "sum(range(3 * 10**6))\n"
+        "p.wait()\n"
+    )
+    usage = RunUsage()
+    proc = subprocess.Popen([sys.executable, "-c", code])
+    assert wait_process(proc, usage) == 0
+    assert proc.returncode == 0
+    assert usage.max_rss > 64 * 2**20
+    assert usage.user + usage.sys > 0
+    assert usage.wall >= 0.6
+    assert usage.overhead is not None
+    records = [usage.to_record(0), RunUsage().to_record(1)]
+    rows = {name: qs for name, _, qs, _ in summarize_runs(records)}
+    assert rows["peak rss"][2] > 64
+    assert percentile([1, 2, 3, 4], 50) == 2.5
+
+
+def test_run_history(tmp_path, monkeypatch):
+    history = RunHistory(tmp_path / "history.sqlite")
+    usage = RunUsage()
+    usage.wall, usage.max_rss = 2.0, 2**20
+
+    def record(i: int):
+        script = "T/a" if i % 2 == 0 else "T/b"
+        run_id = history.start(script, {"i": i}, "env", {"out": f"{i}.txt"})
+        if i < 39:
+            history.finish(run_id, 1 if i % 10 == 0 else 0, usage)
+
+    with ThreadPoolExecutor(8) as executor:
+        list(executor.map(record, range(40)))
+    assert len(history.query()) == 40
+    assert len(history.query(status="running")) == 1
+    failed = history.query(status="failed", script="T/*")
+    failed_ids = sorted(json.loads(r["args"])["i"] for r in failed)
+    assert failed_ids == [0, 10, 20, 30]
+    assert len(history.query(script="T/a", limit=5)) == 5
+    assert history.query(since="1h", until="2999-01-01") != []
+    assert history.query(since=datetime.now().isoformat()) == []
+    assert parse_time("2d") < parse_time("1d")
+    rows = summarize_runs_by(history.query(status="done,failed"))
+    assert {r[:3] for r in rows} == {("T/a", 20, 4), ("T/b", 19, 0)}
+    assert rows[0][3] == 2.0
+    export_runs(history.query(), tmp_path / "runs.tsv")
+    assert len((tmp_path / "runs.tsv").read_text().splitlines()) == 41
+    assert history.prune(max_rows=10) == 30
+    assert history.prune(max_rows=10) == 0
+    assert history.prune(max_age_days=0) == 10
+    assert history.journal_mode == "WAL"
+    # no WAL on a network file system
+    mounts = tmp_path / "mounts"
+    mounts.write_text(
+        "/dev/sda1 / ext4 rw 0 0\n"
+        f"server:/export {tmp_path / 'nfs'} nfs4 rw 0 0\n")
+    assert fs_type(tmp_path / "nfs" / "proj", str(mounts)) == "nfs4"
+    assert fs_type(tmp_path, str(mounts)) == "ext4"
+    monkeypatch.setattr(
+        "mrbios.core.run_history.is_network_fs", lambda p: True)
+    nfs_history = RunHistory(tmp_path / "nfs.sqlite")
+    nfs_history.start("T/a", {})
+    mode = nfs_history.conn.execute("PRAGMA journal_mode").fetchone()[0]
+    assert mode == "delete"
+
+
+def test_shard_split_merge(tmp_path):
+    # quality lines starting with '@' should not be taken as headers
+    reads = [
+        f"@r{i}\nACGT{'A' * (i % 7)}\n+\n@@II{'I' * (i % 7)}\n"
+        for i in range(1000)
+    ]
+    fq = tmp_path / "reads.fq"
+    fq.write_text("".join(reads))
+    spec = ShardSpec.from_config(
+        {"by": "records", "format": "fastq", "chunks": 3})
+    chunks = split_file(fq, spec, tmp_path / "fq")
+    assert len(chunks) == 3
+    texts = [c.read_text() for c in chunks]
+    assert "".join(texts) == fq.read_text()
+    assert all(t.startswith("@r") and t.count("\n") % 4 == 0 for t in texts)
+    # gzip input, split in a streaming pass
+    fq_gz = tmp_path / "reads.fq.gz"
+    with gzip.open(fq_gz, "wt") as f:
+        f.write("".join(reads))
+    chunks = split_file(fq_gz, spec, tmp_path / "fq_gz")
+    assert len(chunks) == 3
+    merged = tmp_path / "merged.fq.gz"
+    merge_outputs(chunks, merged, "concat", print)
+    with gzip.open(merged, "rt") as f:
+        assert f.read() == "".join(reads)
+    # the header lines are copied to every chunk
+    vcf = tmp_path / "calls.vcf"
+    header = "##fileformat=VCFv4.2\n#CHROM\tPOS\n"
+    body = "".join(f"chr1\t{i}\n" for i in range(100))
+    vcf.write_text(header + body)
+    spec = ShardSpec.from_config({"by": "lines", "format": "vcf", "chunks": 4})
+    chunks = split_file(vcf, spec, tmp_path / "vcf")
+    assert all(c.read_text().startswith(header) for c in chunks)
+    merge_outputs(
+        chunks, tmp_path / "calls.merged.vcf",
+        {"strategy": "concat", "header": 2}, print)
+    assert (tmp_path / "calls.merged.vcf").read_text() == header + body
+    # BGZF-like gzip: several members and an empty EOF member
+    vcf_gz = tmp_path / "calls.vcf.gz"
+    with open(vcf_gz, "wb") as f:
+        lines = (header + body).splitlines(keepends=True)
+        for i in range(0, len(lines), 10):
+            f.write(gzip.compress("".join(lines[i:i + 10]).encode()))
+        f.write(gzip.compress(b""))
+    spec = ShardSpec.from_config(
+        {"by": "records", "format": "vcf", "chunks": 4})
+    chunks = split_file(vcf_gz, spec, tmp_path / "vcf_gz")
+    assert len(chunks) == 4
+    texts = [gzip.decompress(c.read_bytes()).decode() for c in chunks]
+    assert all(t.startswith(header) for t in texts)
+    assert "".join(t[len(header):] for t in texts) == body
+    # sorted merge, by the 1st column then the 2nd column numerically
+    parts = []
+    for i, lines in enumerate([["a\t2", "b\t1"], ["a\t10", "c\t0"]]):
+        parts.append(tmp_path / f"part{i}.tsv")
+        parts[-1].write_text("".join(line + "\n" for line in lines))
+    merge_outputs(
+        parts, tmp_path / "sorted.tsv",
+        {"strategy": "sorted", "key": ["1", "2n"]}, print)
+    assert (tmp_path / "sorted.tsv").read_text().split() == \
+        ["a", "2", "a", "10", "b", "1", "c", "0"]
+    cmds: list[str] = []
+    merge_outputs(parts, tmp_path / "m.txt", "cat {inputs} > {output}",
+                  cmds.append)
+    assert cmds[0].startswith("cat ") and str(parts[1]) in cmds[0]
+
+
+class FakeEnv():
+    name = "fake-env"
+
+    def run_command(
+            self, command, direct=None, log=None, usage=None,
+            extra_environ=None, cwd=None):
+        proc = subprocess.Popen(
+            command, env=dict(os.environ, **(extra_environ or {})), cwd=cwd)
+        code = wait_process(proc, usage)
+        if code != 0:
+            raise subprocess.CalledProcessError(code, command)
+
+    def prepare_command(self, command, direct=None):
+        return command, dict(os.environ)
+
+
+def test_sharded_run(tmp_path):
+    script_dir = tmp_path / "proj" / "Tasks" / "T" / "upper"
+    script_dir.mkdir(parents=True)
+    (script_dir / "upper.py").write_text(
+        "import sys\n"
+        "with open(sys.argv[1]) as fi, open(sys.argv[2], 'w') as fo:\n"
+        "    fo.write(fi.read().upper())\n")
+    config = {
+        "env": "fake-env",
+        "command": "python upper.py {input} {out}",
+        "inputs": {
+            "input": {"type": "str", "shard": {"chunks": 4}},
+            "out": {"type": "str", "output": True},
+        },
+    }
+    template = f"{sys.executable} {script_dir / 'upper.py'} {{input}} {{out}}"
+    compiled = CompiledInterface(
+        config, ["upper.py"], template, FakeEnv(), cmd2func(template, config))
+    runner = ScriptRunner(config, script_dir, compiled)
+    in_file = tmp_path / "in.txt"
+    in_file.write_text("".join(f"line {i}\n" for i in range(100)))
+    out_file = tmp_path / "out.txt"
+    assert runner.run(input=str(in_file), out=str(out_file)) == 0
+    assert out_file.read_text() == in_file.read_text().upper()
+    # the chunks are removed
+    assert not any(p.name.startswith(".shard-") for p in tmp_path.iterdir())
+    runs = runner.history.query(script="T/upper")
+    assert len(runs) == 5
+    assert all(r["status"] == "done" for r in runs)
+    # the whole run is recorded with the usage of the chunks
+    parent = [r for r in runs if r["mode"] == "sharded"]
+    assert len(parent) == 1
+    assert parent[0]["cpu"] >= max(
+        r["cpu"] for r in runs if r["mode"] != "sharded")
+    # the run function of the GUIs also runs the chunks
+    out_file.unlink()
+    assert runner.get_run_func()(str(in_file), str(out_file)) == 0
+    assert out_file.read_text() == in_file.read_text().upper()
+    assert len(runner.history.query(script="T/upper")) == 10
+    with pytest.raises(ValueError):
+        asyncio.run(runner.arun(input=str(in_file), out=str(out_file)))
+
+
+def test_resource_pool(tmp_path):
+    pool = ResourcePool(tmp_path / "pool", cpus=[0, 1, 2, 3], memory=2**30)
+    assert parse_memory("512M") == 2**29 and parse_memory(1) == 2**30
+    with pool.acquire(3, 2**29) as res:
+        assert res.cpus == [0, 1, 2]
+        assert res.environ["OMP_NUM_THREADS"] == "3"
+        assert pool.try_acquire(2) is None
+        # not enough memory
+        assert pool.try_acquire(1, 2**30) is None
+        with pool.acquire(1) as res2:
+            assert res2.cpus == [3]
+    assert len(pool.reservations()) == 0
+    # the reservations of a killed process are released
+    code = (
+        "import sys, time; from pathlib import Path\n"
+        "from mrbios.core.resource_pool import ResourcePool\n"
+        "pool = ResourcePool(Path(sys.argv[1]), cpus=[0, 1, 2, 3])\n"
+        "res = pool.try_acquire(2)\n"
+        "print(res.cpus, flush=True)\n"
+        "time.sleep(60)\n"
+    )
+    proc = subprocess.Popen(
+        [sys.executable, "-c", code, str(pool.path)],
+        stdout=subprocess.PIPE, text=True)
+    assert proc.stdout.readline().strip() == "[0, 1]"
+    assert pool.try_acquire(3) is None
+    proc.kill()
+    proc.wait()
+    res = pool.try_acquire(4)
+    assert res is not None
+    res.release()
+    cpu = available_cpus()[0]
+    before = os.sched_getaffinity(0)
+    with bind_cpus([cpu]):
+        out = subprocess.check_output([
+            sys.executable, "-c", "import os; print(os.sched_getaffinity(0))"
+        ], text=True)
+    assert out.strip() == str({cpu})
+    assert os.sched_getaffinity(0) == before
+
+
+def test_run_with_threads(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        "mrbios.core.runner.resource_pool",
+        ResourcePool(tmp_path / "pool", cpus=available_cpus()[:1]))
+    monkeypatch.delenv("OMP_NUM_THREADS", raising=False)
+    script_dir = tmp_path / "proj" / "Tasks" / "T" / "threads"
+    script_dir.mkdir(parents=True)
+    config = {
+        "env": "fake-env",
+        "threads": 1,
+        "memory": "10M",
+        "command": "python -c {code}",
+        "inputs": {"code": {"type": "str"}},
+    }
+    template = f"{sys.executable} -c {{code}}"
+    compiled = CompiledInterface(
+        config, [], template, FakeEnv(), cmd2func(template, config))
+    runner = ScriptRunner(config, script_dir, compiled)
+    out = tmp_path / "out.txt"
+    code = (
+        "import os; open('%s', 'w').write("
+        "os.environ.get('OMP_NUM_THREADS', '-') + ' ' + "
+        "str(len(os.sched_getaffinity(0))))" % out)
+    runner.run(code=shlex.quote(code))
+    assert out.read_text() == "1 1"
+    # memory only, no CPU binding and thread limits
+    del config["threads"]
+    runner.run(code=shlex.quote(code))
+    assert out.read_text() == f"- {len(os.sched_getaffinity(0))}"
+
+
+def test_scratch_run(tmp_path):
+    script_dir = tmp_path / "proj" / "Tasks" / "T" / "scratch"
+    script_dir.mkdir(parents=True)
+    root = tmp_path / "scratch"
+    (script_dir / "run.py").write_text(
+        "import os, sys\n"
+        f"assert os.getcwd().startswith({str(root)!r})\n"
+        "assert os.path.exists(sys.argv[1] + '.idx')\n"
+        "open('tmp.txt', 'w').write('intermediate')\n"
+        "with open(sys.argv[1]) as fi, open(sys.argv[2], 'w') as fo:\n"
+        "    fo.write(fi.read().upper())\n"
+        "open(sys.argv[2] + '.log', 'w').write('log')\n"
+        "sys.exit(int(sys.argv[3]))\n")
+    config = {
+        "env": "fake-env",
+        "scratch": {"dir": str(root), "link": "hardlink"},
+        "command": "python run.py {input} {out} {code}",
+        "inputs": {
+            "input": {"type": "str"},
+            "out": {"type": "str", "output": True},
+            "code": {"type": "int", "default": 0},
+        },
+    }
+    template = (
+        f"{sys.executable} {script_dir / 'run.py'} {{input}} {{out}} {{code}}")
+    compiled = CompiledInterface(
+        config, ["run.py"], template, FakeEnv(), cmd2func(template, config))
+    runner = ScriptRunner(config, script_dir, compiled)
+    data = tmp_path / "data"
+    data.mkdir()
+    (data / "in.txt").write_text("abc")
+    (data / "in.txt.idx").write_text("")
+    out = tmp_path / "res" / "out.txt"
+    assert runner.run(input=str(data / "in.txt"), out=str(out)) == 0
+    assert out.read_text() == "ABC"
+    assert (out.parent / "out.txt.log").exists()
+    assert not (tmp_path / "tmp.txt").exists()
+    space = ScratchSpace(root)
+    assert [p.name for p in space.base.iterdir()] == ["scratch.lock"]
+    # the outputs of a failed run are dropped
+    out2 = tmp_path / "res" / "out2.txt"
+    with pytest.raises(CalledProcessError):
+        runner.run(input=str(data / "in.txt"), out=str(out2), code=1)
+    assert not out2.exists()
+    assert [p.name for p in space.base.iterdir()] == ["scratch.lock"]
+    # the dirs of the dead processes are removed
+    (space.base / "run-0-0-0").mkdir()
+    d = space.create()
+    assert d is not None
+    assert sorted(p.name for p in space.base.iterdir()) == \
+        sorted(["scratch.lock", d.path.name])
+    # over the quota
+    (d.path / "big").write_bytes(b"x" * 8192)
+    assert ScratchSpace(root, quota=4096).create() is None
+    d.remove()
+    d = ScratchSpace(root, quota=4096).create()
+    assert d is not None
+    # the recent usage is reused, it's a soft limit
+    (d.path / "big").write_bytes(b"x" * 8192)
+    assert space.usage(max_age=3600) < 4096
+    d2 = ScratchSpace(root, quota=4096).create()
+    assert d2 is not None
+    assert space.usage() >= 4096
+    assert ScratchSpace(root, quota=4096).create() is None
+    d.remove()
+    d2.remove()
+    # replace an output dir
+    (tmp_path / "new").mkdir()
+    (tmp_path / "new" / "a").write_text("new")
+    (tmp_path / "old").mkdir()
+    (tmp_path / "old" / "b").write_text("old")
+    move_atomic(tmp_path / "new", tmp_path / "old")
+    assert [p.name for p in (tmp_path / "old").iterdir()] == ["a"]
+    assert not (tmp_path / "new").exists()
+
+
+def test_arun_records(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        "mrbios.core.runner.resource_pool",
+        ResourcePool(tmp_path / "pool", cpus=available_cpus()[:1]))
+    script_dir = tmp_path / "proj" / "Tasks" / "T" / "async"
+    script_dir.mkdir(parents=True)
+    root = tmp_path / "scratch"
+    config = {
+        "env": "fake-env",
+        "threads": 1,
+        "scratch": str(root),
+        "command": "python -c {code} {out}",
+        "inputs": {
+            "code": {"type": "str"},
+            "out": {"type": "str", "output": True},
+        },
+    }
+    template = f"{sys.executable} -c {{code}} {{out}}"
+    compiled = CompiledInterface(
+        config, [], template, FakeEnv(), cmd2func(template, config))
+    runner = ScriptRunner(config, script_dir, compiled)
+    out = tmp_path / "out.txt"
+    code = (
+        "import os, sys; open(sys.argv[1], 'w').write("
+        "os.environ['OMP_NUM_THREADS'] + ' ' + os.getcwd())")
+
+    async def run():
+        handle = await runner.arun(code=shlex.quote(code), out=str(out))
+        return await handle.wait()
+    assert asyncio.run(run()) == 0
+    threads, cwd = out.read_text().split()
+    assert threads == "1" and cwd.startswith(str(root))
+    assert [p.name for p in ScratchSpace(root).base.iterdir()] == \
+        ["scratch.lock"]
+    runs = runner.history.query(script="T/async")
+    assert len(runs) == 1
+    assert runs[0]["status"] == "done" and runs[0]["wall"] > 0
+
+    # activating the env doesn't block the event loop
+    class SlowEnv(FakeEnv):
+        def prepare_command(self, command, direct=None):
+            time.sleep(0.3)
+            return super().prepare_command(command, direct)
+    runner.env = SlowEnv()
+    ticks = []
+
+    async def tick():
+        while True:
+            ticks.append(1)
+            await asyncio.sleep(0.01)
+
+    async def run_with_ticks():
+        task = asyncio.create_task(tick())
+        code = await run()
+        task.cancel()
+        return code
+    assert asyncio.run(run_with_ticks()) == 0
+    assert len(ticks) > 10